@@ -296,7 +296,7 @@ var event_fixtures = {
     subscription__peer_add: {
         type: 'subscription',
         op: 'peer_add',
-        user_id: 555,
+        user_ids: [555],
         subscriptions: [
             {
                 name: 'devel',
@@ -357,6 +357,17 @@ var event_fixtures = {
         messages: [5, 999],
     },
 
+    update_message_flags__read_stream: {
+        type: 'update_message_flags',
+        operation: 'add',
+        flag: 'read',
+        messages: [],
+        all: false,
+        max_id: 999,
+        stream_id: 42,
+        topic: null,
+    },
+
     update_message_flags__starred: {
         type: 'update_message_flags',
         operation: 'add',
@@ -722,6 +733,18 @@ run(function (override, capture, args) {
     assert_same(args.message_id, 999);
 });
 
+run(function (override, capture, args) {
+    // update_message_flags__read_stream
+    var event = event_fixtures.update_message_flags__read_stream;
+    override('message_store', 'get_messages_in_flag_range', function () {
+        return [{id: 5}, {id: 999}];
+    });
+    override('message_store', 'get', capture(['message_id']));
+    override('unread', 'mark_messages_as_read', noop);
+    dispatch(event);
+    assert_same(args.message_id, 999);
+});
+
 run(function (override, capture, args) {
     // update_message_flags__starred
     var event = event_fixtures.update_message_flags__starred;
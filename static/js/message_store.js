@@ -14,6 +14,28 @@ exports.get = function get(message_id) {
     return stored_messages[message_id];
 };
 
+// Returns the messages we have locally that are covered by a
+// range-based update_message_flags event: every message up to
+// event.max_id, restricted to event.stream_id (and event.topic)
+// unless the event applies to all messages.
+exports.get_messages_in_flag_range = function (event) {
+    return _.filter(stored_messages, function (message) {
+        if (message.id > event.max_id) {
+            return false;
+        }
+        if (event.all) {
+            return true;
+        }
+        if (message.type !== 'stream' || message.stream_id !== event.stream_id) {
+            return false;
+        }
+        if (event.topic) {
+            return message.subject.toLowerCase() === event.topic.toLowerCase();
+        }
+        return true;
+    });
+};
+
 exports.get_pm_emails = function (message) {
     var recipient;
     var i;
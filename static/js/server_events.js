@@ -156,12 +156,14 @@ function dispatch_normal_event(event) {
         } else if (event.op === 'peer_add') {
             // TODO: remove email shim here and fix called functions
             //       to use user_ids
-            person = people.get_person_from_user_id(event.user_id);
-            email = person.email;
-            _.each(event.subscriptions, function (sub) {
-                stream_data.add_subscriber(sub, event.user_id);
-                $(document).trigger('peer_subscribe.zulip',
-                                    {stream_name: sub, user_email: email});
+            _.each(event.user_ids, function (user_id) {
+                person = people.get_person_from_user_id(user_id);
+                email = person.email;
+                _.each(event.subscriptions, function (sub) {
+                    stream_data.add_subscriber(sub, user_id);
+                    $(document).trigger('peer_subscribe.zulip',
+                                        {stream_name: sub, user_email: email});
+                });
             });
         } else if (event.op === 'peer_remove') {
             // TODO: remove email shim here and fix called functions
@@ -213,14 +215,20 @@ function dispatch_normal_event(event) {
 
     case 'update_message_flags':
         var new_value = event.operation === "add";
+        var message_ids = event.messages;
+        if (event.max_id !== undefined) {
+            // Bulk updates (all messages, or a whole stream/topic)
+            // are sent as a range rather than a list of message ids.
+            message_ids = _.pluck(message_store.get_messages_in_flag_range(event), 'id');
+        }
         switch (event.flag) {
         case 'starred':
-            _.each(event.messages, function (message_id) {
+            _.each(message_ids, function (message_id) {
                 ui.update_starred(message_id, new_value);
             });
             break;
         case 'read':
-            var msgs_to_update = _.map(event.messages, function (message_id) {
+            var msgs_to_update = _.map(message_ids, function (message_id) {
                 return message_store.get(message_id);
             });
             unread.mark_messages_as_read(msgs_to_update, {from: "server"});
@@ -71,6 +71,10 @@ parser.add_option('--enable-tornado-logging', dest='enable_tornado_logging',
                   action="store_true",
                   default=False, help='Enable access logs from tornado proxy server.')
 
+parser.add_option('--autoscale-queues', dest='autoscale_queues',
+                  action="store_true",
+                  default=False, help='Run autoscaled pools of queue worker processes.')
+
 (options, arguments) = parser.parse_args()
 
 if not options.force:
@@ -153,7 +157,8 @@ cmds = [['./tools/compile-handlebars-templates', 'forever'],
         manage_args + ['127.0.0.1:%d' % (django_port,)],
         ['env', 'PYTHONUNBUFFERED=1', './manage.py', 'runtornado'] +
         manage_args + ['127.0.0.1:%d' % (tornado_port,)],
-        ['./tools/run-dev-queue-processors'] + manage_args,
+        ['./tools/run-dev-queue-processors'] + manage_args +
+        (['--autoscale'] if options.autoscale_queues else []),
         ['env', 'PGHOST=127.0.0.1',  # Force password authentication using .pgpass
          './puppet/zulip/files/postgresql/process_fts_updates']]
 if options.test:
@@ -31,19 +31,20 @@ from zerver.models import Realm, RealmEmoji, Stream, UserProfile, UserActivity,
     MAX_MESSAGE_LENGTH, get_client, get_stream, get_recipient, get_huddle, \
     get_user_profile_by_id, PreregistrationUser, get_display_recipient, \
     get_realm, bulk_get_recipients, \
-    email_allowed_for_realm, email_to_username, display_recipient_cache_key, \
+    email_allowed_for_realm, email_to_username, display_recipient_remote_cache_key, \
     get_user_profile_by_email, get_stream_cache_key, \
     UserActivityInterval, get_active_user_dicts_in_realm, get_active_streams, \
     realm_filters_for_realm, RealmFilter, receives_offline_notifications, \
     ScheduledJob, get_owned_bot_dicts, \
     get_old_unclaimed_attachments, get_cross_realm_emails, receives_online_notifications, \
-    Reaction
+    Reaction, StreamTopic
 
 from zerver.lib.alert_words import alert_words_in_realm
 from zerver.lib.avatar import get_avatar_url, avatar_url
 
 from django.db import transaction, IntegrityError, connection
-from django.db.models import F, Q
+from django.db.models import F, Q, Count, Max, Value
+from django.db.models.functions import Greatest
 from django.db.models.query import QuerySet
 from django.core.exceptions import ValidationError
 from importlib import import_module
@@ -65,16 +66,20 @@ from zerver.lib.queue import queue_json_publish
 from django.utils import timezone
 from zerver.lib.create_user import create_user
 from zerver.lib import bugdown
-from zerver.lib.cache import cache_with_key, cache_set, \
+from zerver.lib.cache import cache_with_key, cache_get, cache_set, \
     user_profile_by_email_cache_key, cache_set_many, \
-    cache_delete, cache_delete_many
+    cache_delete, cache_delete_many, generic_bulk_cached_fetch, \
+    stream_subscriber_ids_cache_key, delete_stream_subscriber_ids_caches, \
+    bump_realm_state_version, get_realm_state_version, realm_state_block_cache_key, \
+    cache_get_many, get_realm_state_log_position, next_realm_state_log_position, \
+    realm_state_log_event_cache_key
 from zerver.decorator import statsd_increment
 from zerver.lib.utils import log_statsd_event, statsd
 from zerver.lib.html_diff import highlight_html_differences
 from zerver.lib.alert_words import user_alert_words, add_user_alert_words, \
     remove_user_alert_words, set_user_alert_words
-from zerver.lib.push_notifications import num_push_devices_for_user, \
-    send_apple_push_notification, send_android_push_notification
+from zerver.lib.push_notifications import send_apple_push_notification, \
+    send_android_push_notification
 from zerver.lib.notifications import clear_followup_emails_queue
 from zerver.lib.narrow import check_supported_events_narrow_filter
 from zerver.lib.request import JsonableError
@@ -82,7 +87,8 @@ from zerver.lib.session_user import get_session_user
 from zerver.lib.upload import attachment_url_re, attachment_url_to_path_id, \
     claim_attachment, delete_message_image
 from zerver.lib.str_utils import NonBinaryStr, force_str
-from zerver.tornado.event_queue import request_event_queue, get_user_events, send_event
+from zerver.tornado.event_queue import request_event_queue, get_user_events, send_event, \
+    send_events
 
 import DNS
 import ujson
@@ -91,6 +97,7 @@ import traceback
 import re
 import datetime
 import os
+import struct
 import platform
 import logging
 import itertools
@@ -168,7 +175,122 @@ def realm_user_count(realm):
     # type: (Realm) -> int
     return UserProfile.objects.filter(realm=realm, is_active=True, is_bot=False).count()
 
-def get_topic_history_for_stream(user_profile, recipient):
+def add_messages_to_topic_index(messages):
+    # type: (Iterable[Message]) -> None
+    """Incrementally records newly sent stream messages in the
+    StreamTopic index; this is called from do_send_messages inside its
+    transaction."""
+    topics = {} # type: Dict[Tuple[int, Text], Dict[str, Any]]
+    for message in messages:
+        if message.recipient.type != Recipient.STREAM:
+            continue
+        key = (message.recipient_id, message.topic_name().lower())
+        if key not in topics:
+            topics[key] = dict(topic_name=message.topic_name(), max_message_id=message.id, count=0)
+        topic = topics[key]
+        if message.id >= topic['max_message_id']:
+            topic['topic_name'] = message.topic_name()
+            topic['max_message_id'] = message.id
+        topic['count'] += 1
+
+    for (recipient_id, topic_key), topic in topics.items():
+        def update_existing_row():
+            # type: () -> int
+            return StreamTopic.objects.filter(recipient_id=recipient_id, topic_key=topic_key).update(
+                topic_name=topic['topic_name'],
+                max_message_id=Greatest(F('max_message_id'), Value(topic['max_message_id'])),
+                message_count=F('message_count') + topic['count'])
+
+        if update_existing_row():
+            continue
+        try:
+            with transaction.atomic():
+                StreamTopic.objects.create(recipient_id=recipient_id,
+                                           topic_key=topic_key,
+                                           topic_name=topic['topic_name'],
+                                           max_message_id=topic['max_message_id'],
+                                           message_count=topic['count'])
+        except IntegrityError:
+            # Another process created the row since we checked.
+            update_existing_row()
+
+def update_topic_index(recipient, topic_names):
+    # type: (Recipient, Iterable[Text]) -> None
+    """Recomputes the StreamTopic rows for the given topics from the
+    Message table.  Used when messages move out of a topic (topic
+    edits) or are deleted, where an incremental update isn't
+    possible."""
+    for topic_key in set(topic_name.lower() for topic_name in topic_names):
+        stats = Message.objects.filter(recipient=recipient, subject__iexact=topic_key) \
+                               .aggregate(Max('id'), Count('id'))
+        if stats['id__count'] == 0:
+            StreamTopic.objects.filter(recipient=recipient, topic_key=topic_key).delete()
+            continue
+        latest_topic_name = Message.objects.get(id=stats['id__max']).topic_name()
+        StreamTopic.objects.update_or_create(recipient=recipient,
+                                             topic_key=topic_key,
+                                             defaults=dict(topic_name=latest_topic_name,
+                                                           max_message_id=stats['id__max'],
+                                                           message_count=stats['id__count']))
+
+def rebuild_topic_index(recipient):
+    # type: (Recipient) -> int
+    """Rebuilds the StreamTopic rows for a stream from scratch; used by
+    the backfill_topic_index management command.  Returns the number
+    of topics."""
+    query = '''
+        INSERT INTO zerver_streamtopic
+            (recipient_id, topic_key, topic_name, max_message_id, message_count)
+        SELECT
+            recipient_id,
+            lower(subject),
+            (array_agg(subject ORDER BY id DESC))[1],
+            max(id),
+            count(*)
+        FROM zerver_message
+        WHERE recipient_id = %s
+        GROUP BY recipient_id, lower(subject)
+    '''
+    with transaction.atomic():
+        StreamTopic.objects.filter(recipient=recipient).delete()
+        cursor = connection.cursor()
+        cursor.execute(query, [recipient.id])
+        count = cursor.rowcount
+        cursor.close()
+    return count
+
+def get_topic_history_for_stream(user_profile, recipient, stream):
+    # type: (UserProfile, Recipient, Stream) -> List[Tuple[str, int]]
+    if stream.invite_only:
+        # Users don't get access to the history of private streams, so
+        # we can only show topics of messages this user received.
+        return get_received_topic_history_for_stream(user_profile, recipient)
+
+    # For public streams, the topic list comes from the StreamTopic
+    # index, and we only need to look at the user's unread messages
+    # on the stream to compute the unread counts.
+    query = '''
+        SELECT lower("zerver_message"."subject"), count(*)
+        FROM "zerver_usermessage"
+        INNER JOIN "zerver_message" ON (
+            "zerver_usermessage"."message_id" = "zerver_message"."id"
+        ) WHERE (
+            "zerver_usermessage"."user_profile_id" = %s AND
+            "zerver_message"."recipient_id" = %s AND
+            ("zerver_usermessage"."flags" & 1) = 0
+        )
+        GROUP BY lower("zerver_message"."subject")
+    '''
+    cursor = connection.cursor()
+    cursor.execute(query, [user_profile.id, recipient.id])
+    unread_counts = dict(cursor.fetchall()) # type: Dict[str, int]
+    cursor.close()
+
+    topics = StreamTopic.objects.filter(recipient=recipient).order_by('-max_message_id') \
+                                .values_list('topic_key', 'topic_name')
+    return [(topic_name, unread_counts.get(topic_key, 0)) for (topic_key, topic_name) in topics]
+
+def get_received_topic_history_for_stream(user_profile, recipient):
     # type: (UserProfile, Recipient) -> List[Tuple[str, int]]
 
     # We tested the below query on some large prod datasets, and we never
@@ -358,7 +480,7 @@ def notify_created_user(user_profile):
                              is_admin=user_profile.is_realm_admin,
                              full_name=user_profile.full_name,
                              is_bot=user_profile.is_bot))
-    send_event(event, active_user_ids(user_profile.realm))
+    send_realm_state_event(user_profile.realm, event, active_user_ids(user_profile.realm))
 
 def notify_created_bot(user_profile):
     # type: (UserProfile) -> None
@@ -619,6 +741,7 @@ def do_deactivate_user(user_profile, log=True, _cascade=True):
 
     user_profile.is_active = False
     user_profile.save(update_fields=["is_active"])
+    delete_subscriber_ids_caches_for_user(user_profile)
 
     delete_user_sessions(user_profile)
 
@@ -632,7 +755,7 @@ def do_deactivate_user(user_profile, log=True, _cascade=True):
                  person=dict(email=user_profile.email,
                              user_id=user_profile.id,
                              full_name=user_profile.full_name))
-    send_event(event, active_user_ids(user_profile.realm))
+    send_realm_state_event(user_profile.realm, event, active_user_ids(user_profile.realm))
 
     if user_profile.is_bot:
         event = dict(type="realm_bot", op="remove",
@@ -679,6 +802,7 @@ def do_deactivate_stream(stream, log=True):
     # Remove the old stream information from remote cache.
     old_cache_key = get_stream_cache_key(old_name, stream.realm)
     cache_delete(old_cache_key)
+    delete_stream_subscriber_ids_caches([stream.id])
 
     if not was_invite_only:
         stream_dict = stream.to_dict()
@@ -746,8 +870,8 @@ def log_message(message):
     if not message.sending_client.name.startswith("test:"):
         log_event(message.to_log_dict())
 
-def render_incoming_message(message, content, message_users, realm):
-    # type: (Message, Text, Set[UserProfile], Realm) -> Text
+def render_incoming_message(message, content, message_users, realm, message_user_ids=None):
+    # type: (Message, Text, Optional[Set[UserProfile]], Realm, Optional[Set[int]]) -> Text
     realm_alert_words = alert_words_in_realm(realm)
     try:
         rendered_content = render_markdown(
@@ -756,6 +880,7 @@ def render_incoming_message(message, content, message_users, realm):
             realm=realm,
             realm_alert_words=realm_alert_words,
             message_users=message_users,
+            message_user_ids=message_user_ids,
         )
     except BugdownRenderingException:
         raise JsonableError(_('Unable to render message'))
@@ -875,6 +1000,8 @@ def do_send_messages(messages):
             ums.extend(ums_to_create)
         UserMessage.objects.bulk_create(ums)
 
+        add_messages_to_topic_index([message['message'] for message in messages])
+
         # Claim attachments in message
         for message in messages:
             if Message.content_has_attachment(message['message'].content):
@@ -1432,18 +1559,54 @@ def bulk_get_subscriber_user_ids(stream_dicts, user_profile, sub_dict):
             continue
         target_stream_dicts.append(stream_dict)
 
-    subscriptions = Subscription.objects.select_related("recipient").filter(
-        recipient__type=Recipient.STREAM,
-        recipient__type_id__in=[stream["id"] for stream in target_stream_dicts],
-        user_profile__is_active=True,
-        active=True).values("user_profile_id", "recipient__type_id")
-
     result = dict((stream["id"], []) for stream in stream_dicts) # type: Dict[int, List[int]]
-    for sub in subscriptions:
-        result[sub["recipient__type_id"]].append(sub["user_profile_id"])
-
+    result.update(bulk_get_stream_subscriber_ids([stream["id"] for stream in target_stream_dicts]))
     return result
 
+# The subscriber lists of streams are cached per stream as packed
+# arrays of user ids, which are much smaller than pickled lists for
+# streams with thousands of subscribers.
+def encode_subscriber_ids(user_ids):
+    # type: (List[int]) -> bytes
+    return struct.pack("<%dI" % (len(user_ids),), *user_ids)
+
+def decode_subscriber_ids(packed_user_ids):
+    # type: (bytes) -> List[int]
+    return list(struct.unpack("<%dI" % (len(packed_user_ids) // 4,), packed_user_ids))
+
+def bulk_get_stream_subscriber_ids(stream_ids):
+    # type: (Iterable[int]) -> Dict[int, List[int]]
+    """Returns the ids of the active users subscribed to each of the
+    given streams.  This does no access checking.  The cache entries
+    are flushed by the functions that change subscriptions or whether
+    users are active; see delete_subscriber_ids_caches_for_user."""
+    def query_function(stream_ids):
+        # type: (List[int]) -> List[Tuple[int, List[int]]]
+        subscriber_ids = dict((stream_id, []) for stream_id in stream_ids) # type: Dict[int, List[int]]
+        subscriptions = Subscription.objects.filter(
+            recipient__type=Recipient.STREAM,
+            recipient__type_id__in=stream_ids,
+            user_profile__is_active=True,
+            active=True).values_list("recipient__type_id", "user_profile_id")
+        for (stream_id, user_profile_id) in subscriptions:
+            subscriber_ids[stream_id].append(user_profile_id)
+        return [(stream_id, sorted(user_ids)) for (stream_id, user_ids) in subscriber_ids.items()]
+
+    return generic_bulk_cached_fetch(stream_subscriber_ids_cache_key,
+                                     query_function,
+                                     list(stream_ids),
+                                     extractor=decode_subscriber_ids,
+                                     setter=encode_subscriber_ids,
+                                     id_fetcher=lambda row: row[0],
+                                     cache_transformer=lambda row: row[1])
+
+def delete_subscriber_ids_caches_for_user(user_profile):
+    # type: (UserProfile) -> None
+    stream_ids = Subscription.objects.filter(user_profile=user_profile,
+                                             recipient__type=Recipient.STREAM,
+                                             active=True).values_list("recipient__type_id", flat=True)
+    delete_stream_subscriber_ids_caches(stream_ids)
+
 def get_subscribers_query(stream, requesting_user):
     # type: (Stream, UserProfile) -> QuerySet
     # TODO: Make a generic stub for QuerySet
@@ -1472,9 +1635,10 @@ def get_subscribers(stream, requesting_user=None):
 
 def get_subscriber_emails(stream, requesting_user=None):
     # type: (Stream, Optional[UserProfile]) -> List[Text]
-    subscriptions_query = get_subscribers_query(stream, requesting_user)
-    subscriptions = subscriptions_query.values('user_profile__email')
-    return [subscription['user_profile__email'] for subscription in subscriptions]
+    validate_user_access_to_subscribers(requesting_user, stream)
+    user_ids = bulk_get_stream_subscriber_ids([stream.id])[stream.id]
+    email_dict = get_emails_from_user_ids(user_ids)
+    return [email_dict[user_id] for user_id in user_ids]
 
 def maybe_get_subscriber_emails(stream, user_profile):
     # type: (Stream, UserProfile) -> List[Text]
@@ -1487,15 +1651,15 @@ def maybe_get_subscriber_emails(stream, user_profile):
         subscribers = []
     return subscribers
 
-def notify_subscriptions_added(user_profile, sub_pairs, stream_emails, no_log=False):
-    # type: (UserProfile, Iterable[Tuple[Subscription, Stream]], Callable[[Stream], List[Text]], bool) -> None
+def get_subscriptions_added_event(user_profile, sub_pairs, stream_emails, no_log=False):
+    # type: (UserProfile, Iterable[Tuple[Subscription, Stream]], Callable[[Stream], List[Text]], bool) -> Dict[str, Any]
     if not no_log:
         log_event({'type': 'subscription_added',
                    'user': user_profile.email,
                    'names': [stream.name for sub, stream in sub_pairs],
                    'domain': user_profile.realm.domain})
 
-    # Send a notification to the user who subscribed.
+    # The notification for the user who subscribed.
     payload = [dict(name=stream.name,
                     stream_id=stream.id,
                     in_home_view=subscription.in_home_view,
@@ -1508,9 +1672,8 @@ def notify_subscriptions_added(user_profile, sub_pairs, stream_emails, no_log=Fa
                     pin_to_top=subscription.pin_to_top,
                     subscribers=stream_emails(stream))
                for (subscription, stream) in sub_pairs]
-    event = dict(type="subscription", op="add",
-                 subscriptions=payload)
-    send_event(event, [user_profile.id])
+    return dict(type="subscription", op="add",
+                subscriptions=payload)
 
 def get_peer_user_ids_for_stream_change(stream, altered_users, subscribed_users):
     # type: (Stream, Iterable[UserProfile], Iterable[UserProfile]) -> Set[int]
@@ -1557,10 +1720,15 @@ def bulk_add_subscriptions(streams, users):
     for stream in streams:
         stream_map[recipients_map[stream.id].id] = stream
 
+    user_map = dict((user_profile.id, user_profile) for user_profile in users) # type: Dict[int, UserProfile]
+
+    # We only need each user's existing stream subscriptions (for
+    # picking colors and finding subscriptions to reactivate), so we
+    # fetch them all in one query, without joining in the users.
     subs_by_user = defaultdict(list) # type: Dict[int, List[Subscription]]
-    all_subs_query = Subscription.objects.select_related("user_profile")
-    for sub in all_subs_query.filter(user_profile__in=users,
-                                     recipient__type=Recipient.STREAM):
+    for sub in Subscription.objects.filter(user_profile__in=users,
+                                           recipient__type=Recipient.STREAM):
+        sub.user_profile = user_map[sub.user_profile_id]
         subs_by_user[sub.user_profile_id].append(sub)
 
     already_subscribed = [] # type: List[Tuple[UserProfile, Stream]]
@@ -1599,11 +1767,13 @@ def bulk_add_subscriptions(streams, users):
         Subscription.objects.bulk_create([sub for (sub, stream) in subs_to_add])
         Subscription.objects.filter(id__in=[sub.id for (sub, stream) in subs_to_activate]).update(active=True)
         occupied_streams_after = list(get_occupied_streams(user_profile.realm))
+    delete_stream_subscriber_ids_caches(set(stream.id for (sub, stream) in subs_to_add + subs_to_activate))
 
     new_occupied_streams = [stream for stream in
                             set(occupied_streams_after) - set(occupied_streams_before)
                             if not stream.invite_only]
     if new_occupied_streams:
+        bump_realm_state_version(user_profile.realm_id)
         event = dict(type="stream", op="occupy",
                      streams=[stream.to_dict()
                               for stream in new_occupied_streams])
@@ -1616,24 +1786,35 @@ def bulk_add_subscriptions(streams, users):
     # the following code and we want to minize DB queries
     all_subs_by_stream = query_all_subs_by_stream(streams=streams)
 
+    # Every new subscriber to a stream gets the same subscriber list,
+    # so we compute each stream's list only once.
+    subscriber_emails_by_stream = {} # type: Dict[int, List[Text]]
+
     def fetch_stream_subscriber_emails(stream):
         # type: (Stream) -> List[Text]
         if stream.realm.is_zephyr_mirror_realm and not stream.invite_only:
             return []
-        users = all_subs_by_stream[stream.id]
-        return [u.email for u in users]
+        if stream.id not in subscriber_emails_by_stream:
+            subscriber_emails_by_stream[stream.id] = [u.email for u in all_subs_by_stream[stream.id]]
+        return subscriber_emails_by_stream[stream.id]
 
     sub_tuples_by_user = defaultdict(list) # type: Dict[int, List[Tuple[Subscription, Stream]]]
-    new_streams = set() # type: Set[Tuple[int, int]]
     for (sub, stream) in subs_to_add + subs_to_activate:
-        sub_tuples_by_user[sub.user_profile.id].append((sub, stream))
-        new_streams.add((sub.user_profile.id, stream.id))
+        sub_tuples_by_user[sub.user_profile_id].append((sub, stream))
+
+    new_users_by_stream = defaultdict(list) # type: Dict[int, List[UserProfile]]
+    for user_profile in users:
+        for (sub, stream) in sub_tuples_by_user[user_profile.id]:
+            new_users_by_stream[stream.id].append(user_profile)
+
+    # We now send several types of events to notify browsers; all of
+    # them are delivered to Tornado together, in a single notice.
+    notices = [] # type: List[Dict[str, Any]]
 
-    # We now send several types of events to notify browsers.  The
-    # first batch is notifications to users on invite-only streams
+    # The first batch is notifications to users on invite-only streams
     # that the stream exists.
     for stream in streams:
-        new_users = [user for user in users if (user.id, stream.id) in new_streams]
+        new_users = new_users_by_stream[stream.id]
 
         # Users newly added to invite-only streams need a `create`
         # notification, since they didn't have the invite-only stream
@@ -1641,7 +1822,7 @@ def bulk_add_subscriptions(streams, users):
         if stream.invite_only:
             event = dict(type="stream", op="create",
                          streams=[stream.to_dict()])
-            send_event(event, [user.id for user in new_users])
+            notices.append(dict(event=event, users=[user.id for user in new_users]))
 
     # The second batch is events for the users themselves that they
     # were subscribed to the new streams.
@@ -1649,16 +1830,20 @@ def bulk_add_subscriptions(streams, users):
         if len(sub_tuples_by_user[user_profile.id]) == 0:
             continue
         sub_pairs = sub_tuples_by_user[user_profile.id]
-        notify_subscriptions_added(user_profile, sub_pairs, fetch_stream_subscriber_emails)
+        event = get_subscriptions_added_event(user_profile, sub_pairs, fetch_stream_subscriber_emails)
+        notices.append(dict(event=event, users=[user_profile.id]))
 
-    # The second batch is events for other users who are tracking the
+    # The third batch is events for other users who are tracking the
     # subscribers lists of streams in their browser; everyone for
     # public streams and only existing subscribers for private streams.
+    # We send one event per stream, listing all the new subscribers.
     for stream in streams:
         if stream.realm.is_zephyr_mirror_realm and not stream.invite_only:
             continue
 
-        new_users = [user for user in users if (user.id, stream.id) in new_streams]
+        new_users = new_users_by_stream[stream.id]
+        if not new_users:
+            continue
 
         peer_user_ids = get_peer_user_ids_for_stream_change(
             stream=stream,
@@ -1667,11 +1852,12 @@ def bulk_add_subscriptions(streams, users):
         )
 
         if peer_user_ids:
-            for added_user in new_users:
-                event = dict(type="subscription", op="peer_add",
-                             subscriptions=[stream.name],
-                             user_id=added_user.id)
-                send_event(event, peer_user_ids)
+            event = dict(type="subscription", op="peer_add",
+                         subscriptions=[stream.name],
+                         user_ids=[user.id for user in new_users])
+            notices.append(dict(event=event, users=list(peer_user_ids)))
+
+    send_events(notices)
 
     return ([(user_profile, stream) for (user_profile, recipient_id, stream) in new_subs] +
             [(sub.user_profile, stream) for (sub, stream) in subs_to_activate],
@@ -1722,11 +1908,13 @@ def bulk_remove_subscriptions(users, streams):
         Subscription.objects.filter(id__in=[sub.id for (sub, stream_name) in
                                             subs_to_deactivate]).update(active=False)
         occupied_streams_after = list(get_occupied_streams(user_profile.realm))
+    delete_stream_subscriber_ids_caches(set(stream.id for (sub, stream) in subs_to_deactivate))
 
     new_vacant_streams = [stream for stream in
                           set(occupied_streams_before) - set(occupied_streams_after)
                           if not stream.invite_only]
     if new_vacant_streams:
+        bump_realm_state_version(user_profile.realm_id)
         event = dict(type="stream", op="vacate",
                      streams=[stream.to_dict()
                               for stream in new_vacant_streams])
@@ -1802,6 +1990,7 @@ def do_activate_user(user_profile, log=True, join_date=timezone.now()):
     user_profile.tos_version = settings.TOS_VERSION
     user_profile.save(update_fields=["is_active", "date_joined", "password",
                                      "is_mirror_dummy", "tos_version"])
+    delete_subscriber_ids_caches_for_user(user_profile)
 
     if log:
         domain = user_profile.realm.domain
@@ -1817,6 +2006,7 @@ def do_reactivate_user(user_profile):
     # so it doesn't reset their password, etc.
     user_profile.is_active = True
     user_profile.save(update_fields=["is_active"])
+    delete_subscriber_ids_caches_for_user(user_profile)
 
     domain = user_profile.realm.domain
     log_event({'type': 'user_reactivated',
@@ -1852,8 +2042,8 @@ def do_change_full_name(user_profile, full_name, log=True):
     payload = dict(email=user_profile.email,
                    user_id=user_profile.id,
                    full_name=user_profile.full_name)
-    send_event(dict(type='realm_user', op='update', person=payload),
-               active_user_ids(user_profile.realm))
+    send_realm_state_event(user_profile.realm, dict(type='realm_user', op='update', person=payload),
+                           active_user_ids(user_profile.realm))
     if user_profile.is_bot:
         send_event(dict(type='realm_bot', op='update', bot=payload),
                    bot_owner_userids(user_profile))
@@ -1910,10 +2100,11 @@ def do_change_avatar_source(user_profile, avatar_source, log=True):
             user_id=user_profile.id
         )
 
-        send_event(dict(type='realm_user',
-                        op='update',
-                        person=payload),
-                   active_user_ids(user_profile.realm))
+        send_realm_state_event(user_profile.realm,
+                               dict(type='realm_user',
+                                    op='update',
+                                    person=payload),
+                               active_user_ids(user_profile.realm))
 
 def _default_stream_permision_check(user_profile, stream):
     # type: (UserProfile, Optional[Stream]) -> None
@@ -2005,7 +2196,7 @@ def do_change_is_admin(user_profile, value, permission='administer'):
                      person=dict(email=user_profile.email,
                                  user_id=user_profile.id,
                                  is_admin=value))
-        send_event(event, active_user_ids(user_profile.realm))
+        send_realm_state_event(user_profile.realm, event, active_user_ids(user_profile.realm))
 
 def do_change_bot_type(user_profile, value):
     # type: (UserProfile, int) -> None
@@ -2038,7 +2229,8 @@ def do_rename_stream(stream, new_name, log=True):
     if old_cache_key != new_cache_key:
         cache_delete(old_cache_key)
         cache_set(new_cache_key, stream)
-    cache_set(display_recipient_cache_key(recipient.id), stream.name)
+    cache_set(display_recipient_remote_cache_key(recipient.id, Recipient.STREAM, stream.id),
+              stream.name)
 
     # Delete cache entries for everything else, which is cheaper and
     # clearer than trying to set them. display_recipient is the out of
@@ -2334,7 +2526,7 @@ def notify_default_streams(realm):
         type="default_streams",
         default_streams=streams_to_dicts_sorted(get_default_streams_for_realm(realm))
     )
-    send_event(event, active_user_ids(realm))
+    send_realm_state_event(realm, event, active_user_ids(realm))
 
 def do_add_default_stream(stream):
     # type: (Stream) -> None
@@ -2388,6 +2580,114 @@ def do_update_user_activity_interval(user_profile, log_time):
     UserActivityInterval.objects.create(user_profile=user_profile, start=log_time,
                                         end=effective_end)
 
+def do_update_user_activity_intervals(log_times_by_user):
+    # type: (Dict[int, List[datetime.datetime]]) -> None
+    """Batched version of do_update_user_activity_interval, taking the
+    activity times for each user ID.  Touches each user's latest
+    interval at most once, and writes all the changes with one UPDATE
+    and one INSERT."""
+    if not log_times_by_user:
+        return
+    interval_length = datetime.timedelta(minutes=15)
+
+    last_intervals = {} # type: Dict[int, UserActivityInterval]
+    for interval in UserActivityInterval.objects.filter(
+            user_profile_id__in=list(log_times_by_user.keys())).order_by(
+                'user_profile_id', '-end').distinct('user_profile_id'):
+        last_intervals[interval.user_profile_id] = interval
+
+    intervals_to_update = {} # type: Dict[int, UserActivityInterval]
+    intervals_to_create = [] # type: List[UserActivityInterval]
+    for user_profile_id, log_times in log_times_by_user.items():
+        last = last_intervals.get(user_profile_id)
+        # Same rules as do_update_user_activity_interval, applied to
+        # the times in order.
+        for log_time in sorted(log_times):
+            effective_end = log_time + interval_length
+            if last is not None and ((log_time <= last.end and log_time >= last.start) or
+                                     (effective_end <= last.end and effective_end >= last.start)):
+                last.end = max(last.end, effective_end)
+                last.start = min(last.start, log_time)
+                if last.id is not None:
+                    intervals_to_update[last.id] = last
+            else:
+                last = UserActivityInterval(user_profile_id=user_profile_id, start=log_time,
+                                            end=effective_end)
+                intervals_to_create.append(last)
+
+    with transaction.atomic():
+        if intervals_to_update:
+            query = '''
+                UPDATE zerver_useractivityinterval
+                SET start = new_interval.start, "end" = new_interval."end"
+                FROM (VALUES %s) AS new_interval(id, start, "end")
+                WHERE zerver_useractivityinterval.id = new_interval.id
+            ''' % (", ".join(["(%s, %s::timestamptz, %s::timestamptz)"] * len(intervals_to_update)),)
+            params = [] # type: List[Any]
+            for interval in intervals_to_update.values():
+                params.extend([interval.id, interval.start, interval.end])
+            cursor = connection.cursor()
+            cursor.execute(query, params)
+            cursor.close()
+        UserActivityInterval.objects.bulk_create(intervals_to_create)
+
+def do_update_user_activities(activities):
+    # type: (Dict[Tuple[int, int, Text], Tuple[int, datetime.datetime]]) -> None
+    """Batched version of do_update_user_activity.  `activities` maps
+    (user_profile_id, client_id, query) to the number of new requests
+    and the time of the latest one.  Existing rows are updated with one
+    UPDATE, and missing ones created with one INSERT."""
+    if not activities:
+        return
+
+    existing_ids = {} # type: Dict[Tuple[int, int, Text], int]
+    rows = UserActivity.objects.filter(
+        user_profile_id__in=set(key[0] for key in activities),
+        client_id__in=set(key[1] for key in activities),
+        query__in=set(key[2] for key in activities)).values_list('id', 'user_profile_id', 'client_id', 'query')
+    for (activity_id, user_profile_id, client_id, query) in rows:
+        if (user_profile_id, client_id, query) in activities:
+            existing_ids[(user_profile_id, client_id, query)] = activity_id
+
+    with transaction.atomic():
+        if existing_ids:
+            sql = '''
+                UPDATE zerver_useractivity
+                SET count = zerver_useractivity.count + new_activity.count,
+                    last_visit = GREATEST(zerver_useractivity.last_visit, new_activity.last_visit)
+                FROM (VALUES %s) AS new_activity(id, count, last_visit)
+                WHERE zerver_useractivity.id = new_activity.id
+            ''' % (", ".join(["(%s, %s, %s::timestamptz)"] * len(existing_ids)),)
+            params = [] # type: List[Any]
+            for key, activity_id in existing_ids.items():
+                (count, last_visit) = activities[key]
+                params.extend([activity_id, count, last_visit])
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
+            cursor.close()
+
+        new_activities = [UserActivity(user_profile_id=user_profile_id, client_id=client_id,
+                                       query=query, count=count, last_visit=last_visit)
+                          for ((user_profile_id, client_id, query), (count, last_visit))
+                          in activities.items()
+                          if (user_profile_id, client_id, query) not in existing_ids]
+        try:
+            with transaction.atomic():
+                UserActivity.objects.bulk_create(new_activities)
+        except IntegrityError:
+            # Another worker created some of these rows since we
+            # looked; fall back to handling them one at a time.
+            for activity in new_activities:
+                (row, created) = UserActivity.objects.get_or_create(
+                    user_profile_id=activity.user_profile_id,
+                    client_id=activity.client_id,
+                    query=activity.query,
+                    defaults={'last_visit': activity.last_visit, 'count': activity.count})
+                if not created:
+                    row.count += activity.count
+                    row.last_visit = max(row.last_visit, activity.last_visit)
+                    row.save(update_fields=["last_visit", "count"])
+
 @statsd_increment('user_activity')
 def do_update_user_activity(user_profile, client, query, log_time):
     # type: (UserProfile, Client, Text, datetime.datetime) -> None
@@ -2509,8 +2809,41 @@ def do_update_pointer(user_profile, pointer, update_flags=False):
     event = dict(type='pointer', pointer=pointer)
     send_event(event, [user_profile.id])
 
+# Flag updates that can touch an unbounded number of UserMessage rows
+# (bankruptcy, marking a stream or topic as read) are applied in
+# message_id ranges of at most this many rows, each in its own short
+# transaction, so that we never hold row locks on all of a heavy
+# user's UserMessage rows at once.
+UPDATE_MESSAGE_FLAGS_BATCH_SIZE = 5000
+
+# Stream and topic flag updates also list the affected message ids,
+# for clients which can't apply a max_id range themselves, unless
+# there are more than this many; see ClientDescriptor.expand_event.
+UPDATE_MESSAGE_FLAGS_EVENT_MAX_IDS = 1000
+
+def update_message_flags_in_batches(msgs, flag_update, batch_size=UPDATE_MESSAGE_FLAGS_BATCH_SIZE):
+    # type: (QuerySet, Any, int) -> int
+    """Applies msgs.update(flags=flag_update) by walking the rows in
+    message_id order, at most batch_size rows per transaction.
+    Returns the number of rows updated."""
+    count = 0
+    lower_bound = 0
+    while True:
+        remaining = msgs.filter(message_id__gt=lower_bound)
+        upper_bound = list(remaining.order_by('message_id').values_list(
+            'message_id', flat=True)[batch_size - 1:batch_size])
+        if upper_bound:
+            remaining = remaining.filter(message_id__lte=upper_bound[0])
+        with transaction.atomic():
+            count += remaining.update(flags=flag_update)
+        if not upper_bound:
+            return count
+        lower_bound = upper_bound[0]
+        logging.info("update_message_flags: %s rows updated so far (through message %s)" %
+                     (count, lower_bound))
+
 def do_update_message_flags(user_profile, operation, flag, messages, all, stream_obj, topic_name):
-    # type: (UserProfile, Text, Text, Sequence[int], bool, Optional[Stream], Optional[Text]) -> int
+    # type: (UserProfile, Text, Text, Optional[Sequence[int]], bool, Optional[Stream], Optional[Text]) -> int
     flagattr = getattr(UserMessage.flags, flag)
 
     if all:
@@ -2551,20 +2884,47 @@ def do_update_message_flags(user_profile, operation, flag, messages, all, stream
     # are kind of magical; they are actually just testing the one bit.
     if operation == 'add':
         msgs = msgs.filter(flags=~flagattr)
-        if stream_obj:
-            messages = list(msgs.values_list('message__id', flat=True))
-        count = msgs.update(flags=F('flags').bitor(flagattr))
+        flag_update = F('flags').bitor(flagattr)
     elif operation == 'remove':
         msgs = msgs.filter(flags=flagattr)
-        if stream_obj:
-            messages = list(msgs.values_list('message__id', flat=True))
-        count = msgs.update(flags=F('flags').bitand(~flagattr))
+        flag_update = F('flags').bitand(~flagattr)
 
     event = {'type': 'update_message_flags',
              'operation': operation,
              'flag': flag,
              'messages': messages,
              'all': all}
+
+    if all or stream_obj is not None:
+        # The event tells clients to apply the change to every message
+        # in the range (all messages, or those in the stream/topic) up
+        # to max_id, which is the newest message we're updating.  We only
+        # update the messages up to max_id, so that messages sent while
+        # we're working through the batches aren't left out of the event.
+        max_id = msgs.aggregate(Max('message_id'))['message_id__max']
+        event['messages'] = []
+        if max_id is None:
+            count = 0
+        else:
+            msgs = msgs.filter(message_id__lte=max_id)
+            if not all:
+                # Clients which don't know about max_id (the mobile apps
+                # and other API clients) get these ids instead of the
+                # range, or are told to reload if there are too many;
+                # bankruptcy has always sent an empty list.
+                message_ids = msgs.values_list('message_id', flat=True)
+                message_ids = list(message_ids[:UPDATE_MESSAGE_FLAGS_EVENT_MAX_IDS + 1])
+                if len(message_ids) <= UPDATE_MESSAGE_FLAGS_EVENT_MAX_IDS:
+                    event['messages'] = message_ids
+            count = update_message_flags_in_batches(msgs, flag_update,
+                                                    UPDATE_MESSAGE_FLAGS_BATCH_SIZE)
+            event['max_id'] = max_id
+        if not all:
+            event['stream_id'] = stream_obj.id
+            event['topic'] = topic_name
+    else:
+        count = msgs.update(flags=flag_update)
+
     log_event(event)
     send_event(event, [user_profile.id])
 
@@ -2598,8 +2958,8 @@ def truncate_topic(topic):
     return truncate_content(topic, MAX_SUBJECT_LENGTH, "...")
 
 
-def update_user_message_flags(message, ums):
-    # type: (Message, Iterable[UserMessage]) -> None
+def update_user_message_flags(message, ums, save=True):
+    # type: (Message, Iterable[UserMessage], bool) -> None
     wildcard = message.mentions_wildcard
     mentioned_ids = message.mentions_user_ids
     ids_with_alert_words = message.user_ids_with_alert_words
@@ -2628,8 +2988,9 @@ def update_user_message_flags(message, ums):
         is_me_message = getattr(message, 'is_me_message', False)
         update_flag(um, is_me_message, UserMessage.flags.is_me_message)
 
-    for um in changed_ums:
-        um.save(update_fields=['flags'])
+    if save:
+        for um in changed_ums:
+            um.save(update_fields=['flags'])
 
 def update_to_dict_cache(changed_messages):
     # type: (List[Message]) -> List[int]
@@ -2648,28 +3009,51 @@ def update_to_dict_cache(changed_messages):
 
 # We use transaction.atomic to support select_for_update in the attachment codepath.
 @transaction.atomic
-def do_update_embedded_data(user_profile, message, content, rendered_content):
-    # type: (UserProfile, Message, Optional[Text], Optional[Text]) -> None
-    event = {
-        'type': 'update_message',
-        'sender': user_profile.email,
-        'message_id': message.id}  # type: Dict[str, Any]
-    changed_messages = [message]
+def bulk_update_embedded_data(rendered_messages):
+    # type: (List[Tuple[Message, Text]]) -> None
+    """Saves the new rendered_content of each of the messages (after
+    their link previews have been fetched), and notifies their
+    recipients, using a fixed number of queries and a single
+    notification to Tornado however many messages there are.  The
+    messages' `sender` should already be loaded."""
+    if not rendered_messages:
+        return
 
-    ums = UserMessage.objects.filter(message=message.id)
+    message_ids = [message.id for (message, rendered_content) in rendered_messages]
+    ums_by_message = defaultdict(list) # type: Dict[int, List[UserMessage]]
+    for um in UserMessage.objects.filter(message_id__in=message_ids):
+        ums_by_message[um.message_id].append(um)
 
-    if content is not None:
-        update_user_message_flags(message, ums)
-        message.content = content
+    changed_ums = [] # type: List[UserMessage]
+    for (message, rendered_content) in rendered_messages:
+        old_flags = dict((um.id, int(um.flags)) for um in ums_by_message[message.id])
+        update_user_message_flags(message, ums_by_message[message.id], save=False)
+        changed_ums.extend(um for um in ums_by_message[message.id] if int(um.flags) != old_flags[um.id])
         message.rendered_content = rendered_content
         message.rendered_content_version = bugdown_version
-        event["content"] = content
-        event["rendered_content"] = rendered_content
 
-    log_event(event)
-    message.save(update_fields=["content", "rendered_content"])
+    # Save the flags with one query per distinct new value.
+    ums_by_flags = defaultdict(list) # type: Dict[int, List[int]]
+    for um in changed_ums:
+        ums_by_flags[int(um.flags)].append(um.id)
+    for flags, um_ids in ums_by_flags.items():
+        UserMessage.objects.filter(id__in=um_ids).update(flags=flags)
 
-    event['message_ids'] = update_to_dict_cache(changed_messages)
+    query = '''
+        UPDATE zerver_message
+        SET rendered_content = new_message.rendered_content,
+            rendered_content_version = new_message.rendered_content_version
+        FROM (VALUES %s) AS new_message(id, rendered_content, rendered_content_version)
+        WHERE zerver_message.id = new_message.id
+    ''' % (", ".join(["(%s, %s, %s)"] * len(rendered_messages)),)
+    params = [] # type: List[Any]
+    for (message, rendered_content) in rendered_messages:
+        params.extend([message.id, rendered_content, bugdown_version])
+    cursor = connection.cursor()
+    cursor.execute(query, params)
+    cursor.close()
+
+    update_to_dict_cache([message for (message, rendered_content) in rendered_messages])
 
     def user_info(um):
         # type: (UserMessage) -> Dict[str, Any]
@@ -2677,7 +3061,19 @@ def do_update_embedded_data(user_profile, message, content, rendered_content):
             'id': um.user_profile_id,
             'flags': um.flags_list()
         }
-    send_event(event, list(map(user_info, ums)))
+
+    notices = [] # type: List[Dict[str, Any]]
+    for (message, rendered_content) in rendered_messages:
+        event = {
+            'type': 'update_message',
+            'sender': message.sender.email,
+            'message_id': message.id,
+            'content': message.content,
+            'rendered_content': rendered_content,
+            'message_ids': [message.id]}  # type: Dict[str, Any]
+        log_event(event)
+        notices.append(dict(event=event, users=list(map(user_info, ums_by_message[message.id]))))
+    send_events(notices)
 
 # We use transaction.atomic to support select_for_update in the attachment codepath.
 @transaction.atomic
@@ -2776,6 +3172,9 @@ def do_update_message(user_profile, message, subject, propagate_mode, content, r
                                 "rendered_content_version", "last_edit_time",
                                 "edit_history"])
 
+    if subject is not None and message.recipient.type == Recipient.STREAM:
+        update_topic_index(message.recipient, [orig_subject, subject])
+
     event['message_ids'] = update_to_dict_cache(changed_messages)
 
     def user_info(um):
@@ -2960,14 +3359,14 @@ def get_status_dict(requesting_user_profile):
     return UserPresence.get_status_dict_by_realm(requesting_user_profile.realm_id)
 
 
-def get_realm_user_dicts(user_profile):
-    # type: (UserProfile) -> List[Dict[str, Text]]
+def get_realm_user_dicts(realm):
+    # type: (Realm) -> List[Dict[str, Text]]
     return [{'email': userdict['email'],
              'user_id': userdict['id'],
              'is_admin': userdict['is_realm_admin'],
              'is_bot': userdict['is_bot'],
              'full_name': userdict['full_name']}
-            for userdict in get_active_user_dicts_in_realm(user_profile.realm)]
+            for userdict in get_active_user_dicts_in_realm(realm)]
 
 def get_cross_realm_dicts():
     # type: () -> List[Dict[str, Any]]
@@ -2979,18 +3378,100 @@ def get_cross_realm_dicts():
              'full_name': user.full_name}
             for user in users]
 
+# Event types which update the realm-wide part of the initial state;
+# these are recorded in the realm's state log, so that a client which
+# re-registers can be sent just the events it missed.
+REALM_STATE_EVENT_TYPES = ['default_streams', 'realm_domains', 'realm_emoji',
+                           'realm_filters', 'realm_user']
+REALM_STATE_LOG_SIZE = 1000
+REALM_STATE_LOG_TIMEOUT = 3600*24
+
+def format_state_version(epoch, seq):
+    # type: (Text, int) -> Text
+    return u"%s:%d" % (epoch, seq)
+
+def send_realm_state_event(realm, event, users):
+    # type: (Realm, Dict[str, Any], Iterable[int]) -> None
+    epoch, seq = next_realm_state_log_position(realm.id)
+    event['state_version'] = format_state_version(epoch, seq)
+    cache_set(realm_state_log_event_cache_key(realm.id, epoch, seq), event,
+              timeout=REALM_STATE_LOG_TIMEOUT)
+    send_event(event, users)
+
+def get_realm_state_events_since(realm, state_version):
+    # type: (Realm, Text) -> Optional[List[Dict[str, Any]]]
+    """Returns the events logged for the realm after `state_version`,
+    or None if they are no longer all available (in which case the
+    client needs a full register)."""
+    try:
+        epoch, seq_str = state_version.split(':')
+        seq = int(seq_str)
+    except ValueError:
+        return None
+
+    current_epoch, current_seq = get_realm_state_log_position(realm.id)
+    if epoch != current_epoch or seq > current_seq or current_seq - seq > REALM_STATE_LOG_SIZE:
+        return None
+
+    keys = [realm_state_log_event_cache_key(realm.id, epoch, i)
+            for i in range(seq + 1, current_seq + 1)]
+    cached = cache_get_many(keys)
+    if len(cached) != len(keys):
+        return None
+    return [cached[key][0] for key in keys]
+
+def get_realm_state_block(realm):
+    # type: (Realm) -> Dict[str, Any]
+    """Returns the parts of the initial state data which are the same
+    for every user in the realm.  The block is cached under the realm's
+    state version, which the flush_* signal handlers bump whenever any
+    of these change, so that a mass re-register after a restart only
+    computes it once per realm."""
+    cache_key = realm_state_block_cache_key(realm.id, get_realm_state_version(realm.id))
+    cached = cache_get(cache_key)
+    if cached is not None:
+        return cached[0]
+
+    if realm.is_zephyr_mirror_realm:
+        # Listing public streams is disabled for Zephyr mirroring realms.
+        public_streams = [] # type: List[Dict[str, Any]]
+    else:
+        public_streams = streams_to_dicts_sorted(
+            list(get_occupied_streams(realm).filter(invite_only=False)))
+
+    block = {
+        'realm_users': get_realm_user_dicts(realm),
+        'realm_emoji': realm.get_emoji(),
+        'realm_filters': realm_filters_for_realm(realm.id),
+        'realm_domains': get_realm_aliases(realm),
+        'realm_default_streams': streams_to_dicts_sorted(get_default_streams_for_realm(realm)),
+        'public_streams': public_streams,
+    } # type: Dict[str, Any]
+    cache_set(cache_key, block, timeout=3600*24)
+    return block
+
 # Fetch initial data.  When event_types is not specified, clients want
 # all event types.  Whenever you add new code to this function, you
 # should also add corresponding events for changes in the data
 # structures and new code to apply_events (and add a test in EventsRegisterTest).
-def fetch_initial_state_data(user_profile, event_types, queue_id):
-    # type: (UserProfile, Optional[Iterable[str]], str) -> Dict[str, Any]
+def fetch_initial_state_data(user_profile, event_types, queue_id, include_realm_state=True):
+    # type: (UserProfile, Optional[Iterable[str]], str, bool) -> Dict[str, Any]
     state = {'queue_id': queue_id} # type: Dict[str, Any]
 
     if event_types is None:
-        want = lambda msg_type: True
+        want_type = lambda msg_type: True
     else:
-        want = set(event_types).__contains__
+        want_type = set(event_types).__contains__
+
+    if include_realm_state:
+        want = want_type
+    else:
+        want = lambda msg_type: msg_type not in REALM_STATE_EVENT_TYPES and want_type(msg_type)
+
+    realm_state = {} # type: Dict[str, Any]
+    if any(want(event_type) for event_type in ['default_streams', 'realm_domains', 'realm_emoji',
+                                               'realm_filters', 'realm_user', 'stream']):
+        realm_state = get_realm_state_block(user_profile.realm)
 
     if want('alert_words'):
         state['alert_words'] = user_alert_words(user_profile)
@@ -3031,16 +3512,16 @@ def fetch_initial_state_data(user_profile, event_types, queue_id):
         state['realm_domain'] = user_profile.realm.domain
 
     if want('realm_domains'):
-        state['realm_domains'] = get_realm_aliases(user_profile.realm)
+        state['realm_domains'] = realm_state['realm_domains']
 
     if want('realm_emoji'):
-        state['realm_emoji'] = user_profile.realm.get_emoji()
+        state['realm_emoji'] = realm_state['realm_emoji']
 
     if want('realm_filters'):
-        state['realm_filters'] = realm_filters_for_realm(user_profile.realm_id)
+        state['realm_filters'] = realm_state['realm_filters']
 
     if want('realm_user'):
-        state['realm_users'] = get_realm_user_dicts(user_profile)
+        state['realm_users'] = realm_state['realm_users']
 
     if want('realm_bot'):
         state['realm_bots'] = get_owned_bot_dicts(user_profile)
@@ -3061,9 +3542,16 @@ def fetch_initial_state_data(user_profile, event_types, queue_id):
         pass
 
     if want('stream'):
-        state['streams'] = do_get_streams(user_profile)
+        # Public streams come from the shared block; only the private
+        # streams the user is subscribed to are fetched per user.
+        streams = realm_state['public_streams']
+        public_stream_ids = set(stream['stream_id'] for stream in streams)
+        streams.extend(stream for stream in do_get_streams(user_profile, include_public=False)
+                       if stream['stream_id'] not in public_stream_ids)
+        streams.sort(key=lambda elt: elt["name"])
+        state['streams'] = streams
     if want('default_streams'):
-        state['realm_default_streams'] = streams_to_dicts_sorted(get_default_streams_for_realm(user_profile.realm))
+        state['realm_default_streams'] = realm_state['realm_default_streams']
 
     if want('update_display_settings'):
         state['twenty_four_hour_time'] = user_profile.twenty_four_hour_time
@@ -3220,15 +3708,17 @@ def apply_events(state, events, user_profile):
                     if sub['name'].lower() == event['name'].lower():
                         sub[event['property']] = event['value']
             elif event['op'] == 'peer_add':
-                user_id = event['user_id']
-                for sub in state['subscriptions']:
-                    if (sub['name'] in event['subscriptions'] and
-                            user_id not in sub['subscribers']):
-                        sub['subscribers'].append(user_id)
-                for sub in state['never_subscribed']:
-                    if (sub['name'] in event['subscriptions'] and
-                            user_id not in sub['subscribers']):
-                        sub['subscribers'].append(user_id)
+                # Clients other than the webapp get one event per user_id.
+                user_ids = event['user_ids'] if 'user_ids' in event else [event['user_id']]
+                for user_id in user_ids:
+                    for sub in state['subscriptions']:
+                        if (sub['name'] in event['subscriptions'] and
+                                user_id not in sub['subscribers']):
+                            sub['subscribers'].append(user_id)
+                    for sub in state['never_subscribed']:
+                        if (sub['name'] in event['subscriptions'] and
+                                user_id not in sub['subscribers']):
+                            sub['subscribers'].append(user_id)
             elif event['op'] == 'peer_remove':
                 user_id = event['user_id']
                 for sub in state['subscriptions']:
@@ -3288,8 +3778,8 @@ def apply_events(state, events, user_profile):
 
 def do_events_register(user_profile, user_client, apply_markdown=True,
                        event_types=None, queue_lifespan_secs=0, all_public_streams=False,
-                       narrow=[]):
-    # type: (UserProfile, Client, bool, Optional[Iterable[str]], int, bool, Iterable[Sequence[Text]]) -> Dict[str, Any]
+                       narrow=[], state_version=None):
+    # type: (UserProfile, Client, bool, Optional[Iterable[str]], int, bool, Iterable[Sequence[Text]], Optional[Text]) -> Dict[str, Any]
     # Technically we don't need to check this here because
     # build_narrow_filter will check it, but it's nicer from an error
     # handling perspective to do it before contacting Tornado
@@ -3305,15 +3795,41 @@ def do_events_register(user_profile, user_client, apply_markdown=True,
     else:
         event_types_set = None
 
-    ret = fetch_initial_state_data(user_profile, event_types_set, queue_id)
+    # Events which change the realm-wide state carry the state_version
+    # they bring the client to; any logged after this point also reach
+    # the client through the queue we just allocated.
+    current_state_version = format_state_version(*get_realm_state_log_position(user_profile.realm_id))
+
+    # If the client already has the realm-wide state as of
+    # `state_version`, we send just the events it missed instead.
+    state_events = None # type: Optional[List[Dict[str, Any]]]
+    if state_version is not None:
+        state_events = get_realm_state_events_since(user_profile.realm, state_version)
+
+    ret = fetch_initial_state_data(user_profile, event_types_set, queue_id,
+                                   include_realm_state=state_events is None)
 
     # Apply events that came in while we were fetching initial data
     events = get_user_events(user_profile, queue_id, -1)
-    apply_events(ret, events, user_profile)
     if events:
         ret['last_event_id'] = events[-1]['id']
     else:
         ret['last_event_id'] = -1
+
+    if state_events is not None:
+        # We don't have the realm-wide state to apply these to, so
+        # the client gets them along with the logged ones.
+        logged_versions = set(event['state_version'] for event in state_events)
+        state_events.extend(event for event in events
+                            if event['type'] in REALM_STATE_EVENT_TYPES and
+                            event.get('state_version') not in logged_versions)
+        events = [event for event in events if event['type'] not in REALM_STATE_EVENT_TYPES]
+        if event_types_set is not None:
+            state_events = [event for event in state_events if event['type'] in event_types_set]
+        ret['state_events'] = state_events
+
+    apply_events(ret, events, user_profile)
+    ret['state_version'] = current_state_version
     return ret
 
 def do_send_confirmation_email(invitee, referrer):
@@ -3339,70 +3855,110 @@ def do_send_confirmation_email(invitee, referrer):
         subject_template_path=subject_template_path,
         body_template_path=body_template_path, host=referrer.realm.host)
 
+def get_push_badge_count(user_profile):
+    # type: (UserProfile) -> int
+    """The number of unread messages which would have generated a push
+    notification: private messages and mentions."""
+    return UserMessage.objects.filter(
+        user_profile=user_profile,
+        flags=~UserMessage.flags.read,
+    ).filter(
+        Q(flags=UserMessage.flags.mentioned) |
+        Q(flags=UserMessage.flags.wildcard_mentioned) |
+        Q(message__recipient__type__in=[Recipient.PERSONAL, Recipient.HUDDLE])
+    ).count()
+
+def get_push_alert(messages):
+    # type: (List[Message]) -> Text
+    """Determine what alert string to display based on the missed messages"""
+    if len(messages) > 1:
+        sender_names = [] # type: List[Text]
+        for message in messages:
+            if message.sender.full_name not in sender_names:
+                sender_names.append(message.sender.full_name)
+        return "%d new Zulip mentions and private messages from %s" % (
+            len(messages), ", ".join(sender_names))
+
+    message = messages[0]
+    sender_str = message.sender.full_name
+    if message.recipient.type == Recipient.HUDDLE:
+        return "New private group message from %s" % (sender_str,)
+    elif message.recipient.type == Recipient.PERSONAL:
+        return "New private message from %s" % (sender_str,)
+    elif message.recipient.type == Recipient.STREAM:
+        return "New mention from %s" % (sender_str,)
+    else:
+        return "New Zulip mentions and private messages from %s" % (sender_str,)
+
 @statsd_increment("push_notifications")
-def handle_push_notification(user_profile_id, missed_message):
-    # type: (int, Dict[str, Any]) -> None
-    try:
-        user_profile = get_user_profile_by_id(user_profile_id)
-        if not (receives_offline_notifications(user_profile) or receives_online_notifications(user_profile)):
-            return
+def handle_push_notifications(user_profile_id, missed_messages):
+    # type: (int, List[Dict[str, Any]]) -> None
+    """Sends a single push notification, to each of the user's devices,
+    covering all of the given missed messages that are still unread."""
+    user_profile = get_user_profile_by_id(user_profile_id)
+    if not (receives_offline_notifications(user_profile) or receives_online_notifications(user_profile)):
+        return
 
-        umessage = UserMessage.objects.get(user_profile=user_profile,
-                                           message__id=missed_message['message_id'])
-        message = umessage.message
-        if umessage.flags.read:
-            return
-        sender_str = message.sender.full_name
-
-        apple = num_push_devices_for_user(user_profile, kind=PushDeviceToken.APNS)
-        android = num_push_devices_for_user(user_profile, kind=PushDeviceToken.GCM)
-
-        if apple or android:
-            # TODO: set badge count in a better way
-            # Determine what alert string to display based on the missed messages
-            if message.recipient.type == Recipient.HUDDLE:
-                alert = "New private group message from %s" % (sender_str,)
-            elif message.recipient.type == Recipient.PERSONAL:
-                alert = "New private message from %s" % (sender_str,)
-            elif message.recipient.type == Recipient.STREAM:
-                alert = "New mention from %s" % (sender_str,)
-            else:
-                alert = "New Zulip mentions and private messages from %s" % (sender_str,)
-
-            if apple:
-                apple_extra_data = {'message_ids': [message.id]}
-                send_apple_push_notification(user_profile, alert, badge=1, zulip=apple_extra_data)
-
-            if android:
-                content = message.content
-                content_truncated = (len(content) > 200)
-                if content_truncated:
-                    content = content[:200] + "..."
-
-                android_data = {
-                    'user': user_profile.email,
-                    'event': 'message',
-                    'alert': alert,
-                    'zulip_message_id': message.id, # message_id is reserved for CCS
-                    'time': datetime_to_timestamp(message.pub_date),
-                    'content': content,
-                    'content_truncated': content_truncated,
-                    'sender_email': message.sender.email,
-                    'sender_full_name': message.sender.full_name,
-                    'sender_avatar_url': get_avatar_url(message.sender.avatar_source, message.sender.email),
-                }
-
-                if message.recipient.type == Recipient.STREAM:
-                    android_data['recipient_type'] = "stream"
-                    android_data['stream'] = get_display_recipient(message.recipient)
-                    android_data['topic'] = message.subject
-                elif message.recipient.type in (Recipient.HUDDLE, Recipient.PERSONAL):
-                    android_data['recipient_type'] = "private"
-
-                send_android_push_notification(user_profile, android_data)
-
-    except UserMessage.DoesNotExist:
-        logging.error("Could not find UserMessage with message_id %s" % (missed_message['message_id'],))
+    message_ids = set(missed_message['message_id'] for missed_message in missed_messages)
+    umessages = UserMessage.objects.filter(
+        user_profile=user_profile,
+        message__id__in=message_ids,
+    ).select_related('message', 'message__sender', 'message__recipient').order_by('message__id')
+    messages = [] # type: List[Message]
+    for umessage in umessages:
+        message_ids.discard(umessage.message_id)
+        if not umessage.flags.read:
+            messages.append(umessage.message)
+    for message_id in sorted(message_ids):
+        logging.error("Could not find UserMessage with message_id %s" % (message_id,))
+    if not messages:
+        return
+
+    devices = list(PushDeviceToken.objects.filter(user=user_profile))
+    apple_devices = [device for device in devices if device.kind == PushDeviceToken.APNS]
+    android_devices = [device for device in devices if device.kind == PushDeviceToken.GCM]
+    if not (apple_devices or android_devices):
+        return
+
+    alert = get_push_alert(messages)
+
+    if apple_devices:
+        apple_extra_data = {'message_ids': [message.id for message in messages]}
+        send_apple_push_notification(user_profile, alert, devices=apple_devices,
+                                     badge=get_push_badge_count(user_profile),
+                                     zulip=apple_extra_data)
+
+    if android_devices:
+        # The Android app displays the content of a single message, so
+        # we send the latest one, along with the IDs of all of them.
+        message = messages[-1]
+        content = message.content
+        content_truncated = (len(content) > 200)
+        if content_truncated:
+            content = content[:200] + "..."
+
+        android_data = {
+            'user': user_profile.email,
+            'event': 'message',
+            'alert': alert,
+            'zulip_message_id': message.id, # message_id is reserved for CCS
+            'zulip_message_ids': [m.id for m in messages],
+            'time': datetime_to_timestamp(message.pub_date),
+            'content': content,
+            'content_truncated': content_truncated,
+            'sender_email': message.sender.email,
+            'sender_full_name': message.sender.full_name,
+            'sender_avatar_url': get_avatar_url(message.sender.avatar_source, message.sender.email),
+        }
+
+        if message.recipient.type == Recipient.STREAM:
+            android_data['recipient_type'] = "stream"
+            android_data['stream'] = get_display_recipient(message.recipient)
+            android_data['topic'] = message.subject
+        elif message.recipient.type in (Recipient.HUDDLE, Recipient.PERSONAL):
+            android_data['recipient_type'] = "private"
+
+        send_android_push_notification(user_profile, android_data, devices=android_devices)
 
 def is_inactive(email):
     # type: (Text) -> None
@@ -3536,7 +4092,7 @@ def notify_realm_emoji(realm):
     event = dict(type="realm_emoji", op="update",
                  realm_emoji=realm.get_emoji())
     user_ids = [userdict['id'] for userdict in get_active_user_dicts_in_realm(realm)]
-    send_event(event, user_ids)
+    send_realm_state_event(realm, event, user_ids)
 
 def check_add_realm_emoji(realm, name, img_url, author=None):
     # type: (Realm, Text, Text, Optional[UserProfile]) -> None
@@ -3582,7 +4138,7 @@ def notify_realm_filters(realm):
     realm_filters = realm_filters_for_realm(realm.id)
     user_ids = [userdict['id'] for userdict in get_active_user_dicts_in_realm(realm)]
     event = dict(type="realm_filters", realm_filters=realm_filters)
-    send_event(event, user_ids)
+    send_realm_state_event(realm, event, user_ids)
 
 # NOTE: Regexes must be simple enough that they can be easily translated to JavaScript
 # RegExp syntax. In addition to JS-compatible syntax, the following features are available:
@@ -3624,14 +4180,14 @@ def do_add_realm_alias(realm, domain):
     event = dict(type="realm_domains", op="add",
                  alias=dict(domain=alias.domain,
                             ))
-    send_event(event, active_user_ids(realm))
+    send_realm_state_event(realm, event, active_user_ids(realm))
     return alias
 
 def do_remove_realm_alias(realm, domain):
     # type: (Realm, Text) -> None
     RealmAlias.objects.get(realm=realm, domain=domain).delete()
     event = dict(type="realm_domains", op="remove", domain=domain)
-    send_event(event, active_user_ids(realm))
+    send_realm_state_event(realm, event, active_user_ids(realm))
 
 def get_occupied_streams(realm):
     # type: (Realm) -> QuerySet
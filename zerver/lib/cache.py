@@ -9,9 +9,16 @@ from django.conf import settings
 from django.db.models import Q
 from django.core.cache.backends.base import BaseCache
 
-from typing import Any, Callable, Iterable, Optional, Union, TypeVar, Text
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union, TypeVar, Text
 
+from zerver.lib import cache_stats
+from zerver.lib.redis_utils import get_redis_client
 from zerver.lib.utils import statsd, statsd_key, make_safe_digest
+from collections import OrderedDict
+from six.moves import cPickle as pickle
+import logging
+import math
+import redis
 import subprocess
 import time
 import base64
@@ -21,6 +28,7 @@ import os
 import os.path
 import hashlib
 import six
+import ujson
 
 if False:
     from zerver.models import UserProfile, Realm, Message
@@ -51,12 +59,15 @@ def remote_cache_stats_start():
     remote_cache_time_start = time.time()
 
 def remote_cache_stats_finish():
-    # type: () -> None
+    # type: () -> float
+    """Returns how long this request took."""
     global remote_cache_total_time
     global remote_cache_total_requests
     global remote_cache_time_start
+    elapsed = time.time() - remote_cache_time_start
     remote_cache_total_requests += 1
-    remote_cache_total_time += (time.time() - remote_cache_time_start)
+    remote_cache_total_time += elapsed
+    return elapsed
 
 def get_or_create_key_prefix():
     # type: () -> Text
@@ -114,6 +125,181 @@ def get_cache_backend(cache_name):
         return djcache
     return caches[cache_name]
 
+# With settings.LOCAL_CACHE_ENABLED, each process also keeps the entries
+# from these key families (the part of the key before the first ':') in
+# a LocalCache, in front of memcached.  They should be small, hot, and
+# rarely changing.
+LOCAL_CACHE_KEY_FAMILIES = frozenset([
+    u'user_profile_by_id',
+    u'user_profile_by_email',
+    u'get_client',
+    u'stream_by_realm_and_name',
+    u'get_recipient',
+    u'realm_emoji',
+    u'all_realm_filters',
+    u'realm_generation',
+    u'stream_generation',
+])
+LOCAL_CACHE_MAX_ENTRIES = 10000
+LOCAL_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# Entries expire after this long, in case we missed an invalidation.
+LOCAL_CACHE_TIMEOUT = 60
+# How long we wait before trying to resubscribe to invalidations, after
+# losing our connection to redis.
+LOCAL_CACHE_RECONNECT_SECONDS = 1.0
+
+def key_family(key):
+    # type: (Text) -> Text
+    return key.split(u':', 1)[0]
+
+def local_cache_keys(keys, cache_name):
+    # type: (Iterable[Text], Optional[str]) -> List[Text]
+    if cache_name is not None:
+        return []
+    return [key for key in keys if key_family(key) in LOCAL_CACHE_KEY_FAMILIES]
+
+def local_cache_channel():
+    # type: () -> Text
+    return u'cache_invalidations:' + KEY_PREFIX
+
+class LocalCache(object):
+    """A bounded LRU cache in this process, which sits in front of
+    memcached for the LOCAL_CACHE_KEY_FAMILIES.
+
+    Writing or deleting one of those keys (with cache_set, cache_delete
+    and friends) broadcasts its invalidation to every process over redis
+    pub/sub.  We apply the invalidations other processes have broadcast
+    before every lookup; reading them is a non-blocking read from our
+    subscription's socket, rather than a round trip.  If we lose the
+    subscription, we clear the cache and don't use it until we've
+    resubscribed.  Values are kept pickled, as memcached keeps them, so
+    that each caller gets its own copy to modify."""
+
+    def __init__(self, channel, max_entries=LOCAL_CACHE_MAX_ENTRIES,
+                 max_bytes=LOCAL_CACHE_MAX_BYTES, timeout=LOCAL_CACHE_TIMEOUT):
+        # type: (Text, int, int, float) -> None
+        self.channel = channel
+        self.pid = os.getpid()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        # key -> (expiry time, pickled value), least recently used first
+        self.entries = OrderedDict() # type: Dict[Text, Tuple[float, bytes]]
+        self.bytes = 0
+        self.pubsub = None # type: Any
+        self.last_subscribe_attempt = 0.0
+
+    def get(self, key):
+        # type: (Text) -> Any
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        (expires, pickled) = entry
+        if expires < time.time():
+            self.bytes -= len(pickled)
+            return None
+        self.entries[key] = entry
+        return pickle.loads(pickled)
+
+    def set(self, key, val):
+        # type: (Text, Any) -> None
+        self.delete_many([key])
+        pickled = pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
+        if len(pickled) > self.max_bytes:
+            return
+        self.entries[key] = (time.time() + self.timeout, pickled)
+        self.bytes += len(pickled)
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            (_, (_, evicted)) = self.entries.popitem(last=False) # type: ignore # OrderedDict
+            self.bytes -= len(evicted)
+
+    def delete_many(self, keys):
+        # type: (Iterable[Text]) -> None
+        for key in keys:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= len(entry[1])
+
+    def clear(self):
+        # type: () -> None
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+    def process_invalidations(self):
+        # type: () -> bool
+        """Applies the invalidations broadcast since we last looked, and
+        returns whether the cache is usable."""
+        if self.pubsub is None and not self.subscribe():
+            return False
+        try:
+            while True:
+                message = self.pubsub.get_message()
+                if message is None:
+                    return True
+                if message['type'] == 'message':
+                    self.delete_many(ujson.loads(message['data']))
+        except redis.RedisError:
+            logging.warning("Lost the local cache's invalidation subscription; clearing it")
+            self.pubsub = None
+            self.clear()
+            return False
+
+    def subscribe(self):
+        # type: () -> bool
+        now = time.time()
+        if now - self.last_subscribe_attempt < LOCAL_CACHE_RECONNECT_SECONDS:
+            return False
+        self.last_subscribe_attempt = now
+        try:
+            pubsub = get_local_cache_redis_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(self.channel)
+            # Wait for the subscription to be confirmed, so that we
+            # can't miss invalidations for anything we cache after this.
+            pubsub.parse_response(block=True, timeout=LOCAL_CACHE_RECONNECT_SECONDS)
+        except redis.RedisError:
+            logging.warning("Could not subscribe to local cache invalidations")
+            return False
+        # We may have missed invalidations while we weren't subscribed.
+        self.clear()
+        self.pubsub = pubsub
+        return True
+
+local_cache = None # type: Optional[LocalCache]
+local_cache_redis_client = None # type: Optional[redis.StrictRedis]
+
+def get_local_cache_redis_client():
+    # type: () -> redis.StrictRedis
+    global local_cache_redis_client
+    if local_cache_redis_client is None:
+        local_cache_redis_client = get_redis_client()
+    return local_cache_redis_client
+
+def get_local_cache():
+    # type: () -> Optional[LocalCache]
+    """Returns this process's LocalCache, if it's enabled and usable."""
+    global local_cache
+    if not settings.LOCAL_CACHE_ENABLED:
+        return None
+    if local_cache is None or local_cache.pid != os.getpid() or \
+            local_cache.channel != local_cache_channel():
+        local_cache = LocalCache(local_cache_channel())
+    if not local_cache.process_invalidations():
+        return None
+    return local_cache
+
+def invalidate_local_caches(keys, cache_name):
+    # type: (Iterable[Text], Optional[str]) -> None
+    keys = local_cache_keys(keys, cache_name)
+    if not keys or not settings.LOCAL_CACHE_ENABLED:
+        return
+    if local_cache is not None:
+        local_cache.delete_many(keys)
+    try:
+        get_local_cache_redis_client().publish(local_cache_channel(), ujson.dumps(keys))
+    except redis.RedisError:
+        # Other processes will serve these entries until they expire.
+        logging.exception("Could not broadcast local cache invalidations")
+
 def get_cache_with_key(keyfunc, cache_name=None):
     # type: (Any, Optional[str]) -> Any
     """
@@ -136,8 +322,51 @@ def get_cache_with_key(keyfunc, cache_name=None):
 
     return decorator
 
-def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None):
-    # type: (Any, Optional[str], Optional[int], Optional[str]) -> Any
+# How long cache_with_key waits for another caller holding the lease on
+# a missing value to store it, before computing it anyway, and how often
+# it looks.
+LEASE_WAIT_SECONDS = 2.0
+LEASE_POLL_SECONDS = 0.05
+# How long an early refresh holds its lease, if the function has no
+# lease_timeout of its own.
+EARLY_REFRESH_LEASE_TIMEOUT = 10
+
+def cache_lease_key(key):
+    # type: (Text) -> Text
+    return key + u':lease'
+
+def cache_stale_key(key):
+    # type: (Text) -> Text
+    return key + u':stale'
+
+def cache_refresh_key(key):
+    # type: (Text) -> Text
+    return key + u':refresh'
+
+def acquire_cache_lease(key, cache_name, lease_timeout):
+    # type: (Text, Optional[str], int) -> bool
+    """Takes the lease on recomputing the value for `key`, unless another
+    caller holds it.  memcached's add is atomic, so only one caller can
+    get it; it expires after lease_timeout seconds, in case the caller
+    holding it dies."""
+    remote_cache_stats_start()
+    acquired = get_cache_backend(cache_name).add(KEY_PREFIX + cache_lease_key(key), True,
+                                                 timeout=lease_timeout)
+    remote_cache_stats_finish()
+    return acquired
+
+def should_refresh_early(refresh_info, early_refresh):
+    # type: (Tuple[float, float], float) -> bool
+    """Decides whether to recompute a value before it expires, with a
+    probability which rises as the expiry approaches, and is higher for
+    values which take longer to compute (the "XFetch" algorithm)."""
+    (expires, compute_time) = refresh_info
+    # 1 - random() is in (0, 1], so that we never take the log of 0.
+    return time.time() - compute_time * early_refresh * math.log(1 - random.random()) >= expires
+
+def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None,
+                   lease_timeout=None, serve_stale=False, early_refresh=None):
+    # type: (Any, Optional[str], Optional[int], Optional[str], Optional[int], bool, Optional[float]) -> Any
     # This function can't be typed perfectly because returning a generic function
     # isn't supported in mypy - https://github.com/python/mypy/issues/1551.
     """Decorator which applies Django caching to a function.
@@ -145,16 +374,83 @@ def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None)
        Decorator argument is a function which computes a cache key
        from the original function's arguments.  You are responsible
        for avoiding collisions with other uses of this decorator or
-       other uses of caching."""
+       other uses of caching.
+
+       For expensive functions with hot keys, the optional arguments
+       protect against a stampede of callers all recomputing the same
+       value when it expires or is flushed:
+
+       * lease_timeout: On a miss, only the caller which takes a lease
+         (held for at most this many seconds) recomputes the value; the
+         others wait up to LEASE_WAIT_SECONDS for it to be stored.
+       * serve_stale: Also keep a copy of the value which isn't flushed,
+         and return it while another caller holds the lease, rather than
+         waiting.  Only use this where briefly returning an outdated
+         value is OK.
+       * early_refresh: With a timeout, recompute the value before it
+         expires, with a probability which rises as the expiry
+         approaches; values are refreshed earlier the larger this is
+         (1.0 is a good default)."""
 
     def decorator(func):
         # type: (Callable[..., Any]) -> (Callable[..., Any])
+        def compute_and_store(key, args, kwargs):
+            # type: (Text, Any, Any) -> Any
+            start = time.time()
+            val = func(*args, **kwargs)
+            compute_time = time.time() - start
+
+            items = {key: (val,)}
+            if serve_stale:
+                items[cache_stale_key(key)] = (val,)
+            if early_refresh is not None and timeout is not None:
+                items[cache_refresh_key(key)] = ((time.time() + timeout, compute_time),)
+            cache_set_many(items, cache_name=cache_name, timeout=timeout)
+            return val
+
+        def compute_with_lease(key, args, kwargs):
+            # type: (Text, Any, Any) -> Any
+            try:
+                return compute_and_store(key, args, kwargs)
+            finally:
+                cache_delete(cache_lease_key(key), cache_name=cache_name)
+
+        def fetch_with_lease(key, metric_key, args, kwargs):
+            # type: (Text, str, Any, Any) -> Any
+            if acquire_cache_lease(key, cache_name, lease_timeout):
+                return compute_with_lease(key, args, kwargs)
+
+            if serve_stale:
+                val = cache_get(cache_stale_key(key), cache_name=cache_name)
+                if val is not None:
+                    statsd.incr("cache.%s.stale" % (metric_key,))
+                    return val[0]
+
+            # Tornado can't block its IOLoop waiting for another process.
+            if not settings.RUNNING_INSIDE_TORNADO:
+                start = time.time()
+                while time.time() - start < LEASE_WAIT_SECONDS:
+                    time.sleep(LEASE_POLL_SECONDS)
+                    val = cache_get(key, cache_name=cache_name)
+                    if val is not None:
+                        statsd.timing("cache.%s.lease_wait" % (metric_key,),
+                                      (time.time() - start) * 1000)
+                        return val[0]
+                statsd.incr("cache.%s.lease_timeout" % (metric_key,))
+            return compute_and_store(key, args, kwargs)
+
         @wraps(func)
         def func_with_caching(*args, **kwargs):
             # type: (*Any, **Any) -> Callable[..., Any]
             key = keyfunc(*args, **kwargs)
 
-            val = cache_get(key, cache_name=cache_name)
+            refresh_info = None
+            if early_refresh is not None and timeout is not None:
+                vals = cache_get_many([key, cache_refresh_key(key)], cache_name=cache_name)
+                val = vals.get(key)
+                refresh_info = vals.get(cache_refresh_key(key))
+            else:
+                val = cache_get(key, cache_name=cache_name)
 
             extra = ""
             if cache_name == 'database':
@@ -171,13 +467,17 @@ def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None)
             # Values are singleton tuples so that we can distinguish
             # a result of None from a missing key.
             if val is not None:
+                if refresh_info is not None and \
+                        should_refresh_early(refresh_info[0], early_refresh) and \
+                        acquire_cache_lease(key, cache_name, lease_timeout or EARLY_REFRESH_LEASE_TIMEOUT):
+                    statsd.incr("cache.%s.early_refresh" % (metric_key,))
+                    return compute_with_lease(key, args, kwargs)
                 return val[0]
 
-            val = func(*args, **kwargs)
-
-            cache_set(key, val, cache_name=cache_name, timeout=timeout)
+            if lease_timeout is not None:
+                return fetch_with_lease(key, metric_key, args, kwargs)
 
-            return val
+            return compute_and_store(key, args, kwargs)
 
         return func_with_caching
 
@@ -188,46 +488,86 @@ def cache_set(key, val, cache_name=None, timeout=None):
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     cache_backend.set(KEY_PREFIX + key, (val,), timeout=timeout)
-    remote_cache_stats_finish()
+    elapsed = remote_cache_stats_finish()
+    cache_stats.record_cache_sets({key: (val,)}, elapsed)
+    invalidate_local_caches([key], cache_name)
 
 def cache_get(key, cache_name=None):
     # type: (Text, Optional[str]) -> Any
+    local = None
+    if local_cache_keys([key], cache_name):
+        local = get_local_cache()
+        if local is not None:
+            ret = local.get(key)
+            if ret is not None:
+                cache_stats.record_local_cache_hits([key])
+                return ret
+
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     ret = cache_backend.get(KEY_PREFIX + key)
-    remote_cache_stats_finish()
+    elapsed = remote_cache_stats_finish()
+    cache_stats.record_cache_gets([key], {key: ret} if ret is not None else {}, elapsed)
+    if local is not None and ret is not None:
+        local.set(key, ret)
     return ret
 
 def cache_get_many(keys, cache_name=None):
     # type: (List[Text], Optional[str]) -> Dict[Text, Any]
-    keys = [KEY_PREFIX + key for key in keys]
+    result = {} # type: Dict[Text, Any]
+    local_keys = local_cache_keys(keys, cache_name)
+    local = None
+    if local_keys:
+        local = get_local_cache()
+        if local is not None:
+            for key in local_keys:
+                val = local.get(key)
+                if val is not None:
+                    result[key] = val
+            cache_stats.record_local_cache_hits(result.keys())
+            if len(result) == len(keys):
+                return result
+            keys = [key for key in keys if key not in result]
+
     remote_cache_stats_start()
-    ret = get_cache_backend(cache_name).get_many(keys)
-    remote_cache_stats_finish()
-    return dict([(key[len(KEY_PREFIX):], value) for key, value in ret.items()])
+    ret = get_cache_backend(cache_name).get_many([KEY_PREFIX + key for key in keys])
+    elapsed = remote_cache_stats_finish()
+    found = {} # type: Dict[Text, Any]
+    for key, value in ret.items():
+        key = key[len(KEY_PREFIX):]
+        found[key] = value
+        if local is not None and key in local_keys:
+            local.set(key, value)
+    cache_stats.record_cache_gets(keys, found, elapsed)
+    result.update(found)
+    return result
 
 def cache_set_many(items, cache_name=None, timeout=None):
     # type: (Dict[Text, Any], Optional[str], Optional[int]) -> None
     new_items = {}
     for key in items:
         new_items[KEY_PREFIX + key] = items[key]
-    items = new_items
     remote_cache_stats_start()
-    get_cache_backend(cache_name).set_many(items, timeout=timeout)
-    remote_cache_stats_finish()
+    get_cache_backend(cache_name).set_many(new_items, timeout=timeout)
+    elapsed = remote_cache_stats_finish()
+    cache_stats.record_cache_sets(items, elapsed)
+    invalidate_local_caches(items.keys(), cache_name)
 
 def cache_delete(key, cache_name=None):
     # type: (Text, Optional[str]) -> None
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete(KEY_PREFIX + key)
     remote_cache_stats_finish()
+    invalidate_local_caches([key], cache_name)
 
 def cache_delete_many(items, cache_name=None):
     # type: (Iterable[Text], Optional[str]) -> None
+    items = list(items)
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete_many(
         KEY_PREFIX + item for item in items)
     remote_cache_stats_finish()
+    invalidate_local_caches(items, cache_name)
 
 # Required Arguments are as follows:
 # * object_ids: The list of object ids to look up
@@ -295,6 +635,92 @@ def cache(func):
 
     return cache_with_key(keyfunc)(func)
 
+# Cache keys for data derived from a realm (or a stream) include its
+# generation, with with_realm_generation (or with_stream_generation) in
+# their key functions.  Bumping the generation then invalidates all of
+# those entries at once, however many there are; the old entries are
+# never read again, and expire in their own time.  Like the realm state
+# versions, generations are random rather than sequential, so that if
+# one is evicted, the entries cached under it can't come back.
+#
+# So that looking up a generation doesn't cost a round trip to
+# memcached before every lookup keyed by it, each generation is only
+# fetched once per request (see start_per_request_generations); with
+# the local cache, the generations are in LOCAL_CACHE_KEY_FAMILIES too.
+# Outside of requests, in queue workers and management commands, a
+# process can run for a long time, so we look generations up every
+# time there.
+
+# Generation key -> generation, for the current request, or None
+# outside of a request.
+per_request_generations = None # type: Optional[Dict[Text, Text]]
+
+def start_per_request_generations():
+    # type: () -> None
+    global per_request_generations
+    per_request_generations = {}
+
+def flush_per_request_generations():
+    # type: () -> None
+    global per_request_generations
+    per_request_generations = None
+
+def realm_generation_cache_key(realm_id):
+    # type: (int) -> Text
+    return u"realm_generation:%d" % (realm_id,)
+
+def stream_generation_cache_key(stream_id):
+    # type: (int) -> Text
+    return u"stream_generation:%d" % (stream_id,)
+
+def bump_generation(generation_key):
+    # type: (Text) -> Text
+    generation = u"%016x" % (random.getrandbits(64),)
+    cache_set(generation_key, generation, timeout=None)
+    if per_request_generations is not None:
+        per_request_generations[generation_key] = generation
+    return generation
+
+def get_generation(generation_key):
+    # type: (Text) -> Text
+    if per_request_generations is not None and generation_key in per_request_generations:
+        return per_request_generations[generation_key]
+    cached = cache_get(generation_key)
+    if cached is None:
+        return bump_generation(generation_key)
+    generation = cached[0]
+    if per_request_generations is not None:
+        per_request_generations[generation_key] = generation
+    return generation
+
+def bump_realm_generation(realm_id):
+    # type: (int) -> Text
+    return bump_generation(realm_generation_cache_key(realm_id))
+
+def get_realm_generation(realm_id):
+    # type: (int) -> Text
+    return get_generation(realm_generation_cache_key(realm_id))
+
+def bump_stream_generation(stream_id):
+    # type: (int) -> Text
+    return bump_generation(stream_generation_cache_key(stream_id))
+
+def get_stream_generation(stream_id):
+    # type: (int) -> Text
+    return get_generation(stream_generation_cache_key(stream_id))
+
+def with_realm_generation(key, realm_id, generation=None):
+    # type: (Text, int, Optional[Text]) -> Text
+    if generation is None:
+        generation = get_realm_generation(realm_id)
+    return u"%s:g%s" % (key, generation)
+
+def with_stream_generation(key, stream_id, generation=None):
+    # type: (Text, int, Optional[Text]) -> Text
+    if generation is None:
+        generation = get_stream_generation(stream_id)
+    return u"%s:g%s" % (key, generation)
+
 def display_recipient_cache_key(recipient_id):
     # type: (int) -> Text
     return u"display_recipient_dict:%d" % (recipient_id,)
@@ -316,7 +742,7 @@ def user_profile_by_id_cache_key(user_profile_id):
 active_user_dict_fields = ['id', 'full_name', 'short_name', 'email', 'is_realm_admin', 'is_bot'] # type: List[str]
 def active_user_dicts_in_realm_cache_key(realm):
     # type: (Realm) -> Text
-    return u"active_user_dicts_in_realm:%s" % (realm.id,)
+    return with_realm_generation(u"active_user_dicts_in_realm:%s" % (realm.id,), realm.id)
 
 active_bot_dict_fields = ['id', 'full_name', 'short_name',
                           'email', 'default_sending_stream__name',
@@ -325,17 +751,106 @@ active_bot_dict_fields = ['id', 'full_name', 'short_name',
                           'bot_owner__email', 'avatar_source'] # type: List[str]
 def active_bot_dicts_in_realm_cache_key(realm):
     # type: (Realm) -> Text
-    return u"active_bot_dicts_in_realm:%s" % (realm.id,)
+    return with_realm_generation(u"active_bot_dicts_in_realm:%s" % (realm.id,), realm.id)
 
-def get_stream_cache_key(stream_name, realm):
-    # type: (Text, Union[Realm, int]) -> Text
+def get_stream_cache_key(stream_name, realm, generation=None):
+    # type: (Text, Union[Realm, int], Optional[Text]) -> Text
+    """The cached Streams include their Realm, so their keys include the
+    realm's generation.  Pass the generation when computing many keys
+    for a realm, to save looking it up for each of them."""
     from zerver.models import Realm
     if isinstance(realm, Realm):
         realm_id = realm.id
     else:
         realm_id = realm
-    return u"stream_by_realm_and_name:%s:%s" % (
-        realm_id, make_safe_digest(stream_name.strip().lower()))
+    return with_realm_generation(u"stream_by_realm_and_name:%s:%s" % (
+        realm_id, make_safe_digest(stream_name.strip().lower())), realm_id, generation)
+
+def stream_subscriber_ids_cache_key(stream_id):
+    # type: (int) -> Text
+    return u"stream_subscriber_ids:%d" % (stream_id,)
+
+def delete_stream_subscriber_ids_caches(stream_ids):
+    # type: (Iterable[int]) -> None
+    cache_delete_many([stream_subscriber_ids_cache_key(stream_id)
+                       for stream_id in stream_ids])
+
+def realm_state_version_cache_key(realm_id):
+    # type: (int) -> Text
+    return u"realm_state_version:%d" % (realm_id,)
+
+def realm_state_block_cache_key(realm_id, version):
+    # type: (int, Text) -> Text
+    return u"realm_state_block:%d:%s" % (realm_id, version)
+
+def bump_realm_state_version(realm_id):
+    # type: (int) -> Text
+    """Marks the realm's cached state block (see get_realm_state_block
+    in actions.py) as stale.  Versions are random rather than
+    sequential, so that a block cached under a version which has since
+    been evicted from the cache can never be picked up again."""
+    version = u"%016x" % (random.getrandbits(64),)
+    cache_set(realm_state_version_cache_key(realm_id), version)
+    return version
+
+def get_realm_state_version(realm_id):
+    # type: (int) -> Text
+    version = cache_get(realm_state_version_cache_key(realm_id))
+    if version is None:
+        return bump_realm_state_version(realm_id)
+    return version[0]
+
+# The realm state log is a bounded log of the events which update the
+# realm-wide parts of the initial state, used for delta registers (see
+# get_realm_state_events_since in actions.py).  Each log has a random
+# epoch, so that if its sequence counter is evicted from the cache, a
+# fresh log is started rather than reusing old sequence numbers.
+
+def realm_state_log_epoch_cache_key(realm_id):
+    # type: (int) -> Text
+    return u"realm_state_log_epoch:%d" % (realm_id,)
+
+def realm_state_log_seq_cache_key(realm_id, epoch):
+    # type: (int, Text) -> Text
+    return u"realm_state_log_seq:%d:%s" % (realm_id, epoch)
+
+def realm_state_log_event_cache_key(realm_id, epoch, seq):
+    # type: (int, Text, int) -> Text
+    return u"realm_state_log_event:%d:%s:%d" % (realm_id, epoch, seq)
+
+def start_realm_state_log(realm_id):
+    # type: (int) -> Text
+    epoch = u"%016x" % (random.getrandbits(64),)
+    # The sequence counter is stored bare (not as a singleton tuple)
+    # so that it can be incremented atomically.
+    get_cache_backend(None).set(KEY_PREFIX + realm_state_log_seq_cache_key(realm_id, epoch), 0,
+                                timeout=None)
+    cache_set(realm_state_log_epoch_cache_key(realm_id), epoch, timeout=None)
+    return epoch
+
+def get_realm_state_log_position(realm_id):
+    # type: (int) -> Tuple[Text, int]
+    """Returns the (epoch, sequence number) of the last event logged
+    for the realm."""
+    epoch = cache_get(realm_state_log_epoch_cache_key(realm_id))
+    if epoch is None:
+        return (start_realm_state_log(realm_id), 0)
+    seq = get_cache_backend(None).get(KEY_PREFIX + realm_state_log_seq_cache_key(realm_id, epoch[0]))
+    if seq is None:
+        return (start_realm_state_log(realm_id), 0)
+    return (epoch[0], seq)
+
+def next_realm_state_log_position(realm_id):
+    # type: (int) -> Tuple[Text, int]
+    """Allocates the position for a new event in the realm's log."""
+    epoch = get_realm_state_log_position(realm_id)[0]
+    try:
+        seq = get_cache_backend(None).incr(KEY_PREFIX + realm_state_log_seq_cache_key(realm_id, epoch))
+    except ValueError:
+        # The counter was evicted since we read it.
+        epoch = start_realm_state_log(realm_id)
+        seq = get_cache_backend(None).incr(KEY_PREFIX + realm_state_log_seq_cache_key(realm_id, epoch))
+    return (epoch, seq)
 
 def delete_user_profile_caches(user_profiles):
     # type: (Iterable[UserProfile]) -> None
@@ -348,12 +863,19 @@ def delete_user_profile_caches(user_profiles):
 
 def delete_display_recipient_cache(user_profile):
     # type: (UserProfile) -> None
-    from zerver.models import Subscription  # We need to import here to avoid cyclic dependency.
-    recipient_ids = Subscription.objects.filter(user_profile=user_profile)
+    # We need to import here to avoid cyclic dependency.
+    from zerver.models import Recipient, Subscription
+    # Streams' display recipients are just their names, and are
+    # invalidated by bumping the stream's generation.
+    recipient_ids = Subscription.objects.filter(user_profile=user_profile) \
+                                        .exclude(recipient__type=Recipient.STREAM)
     recipient_ids = recipient_ids.values_list('recipient_id', flat=True)
     keys = [display_recipient_cache_key(rid) for rid in recipient_ids]
     cache_delete_many(keys)
 
+# The UserProfile fields in huddles' and personals' display recipients.
+display_recipient_fields = ['email', 'full_name', 'short_name', 'is_mirror_dummy'] # type: List[str]
+
 # Called by models.py to flush the user_profile cache whenever we save
 # a user_profile object
 def flush_user_profile(sender, **kwargs):
@@ -367,9 +889,10 @@ def flush_user_profile(sender, **kwargs):
             len(set(active_user_dict_fields + ['is_active', 'email']) &
                 set(kwargs['update_fields'])) > 0:
         cache_delete(active_user_dicts_in_realm_cache_key(user_profile.realm))
+        bump_realm_state_version(user_profile.realm_id)
 
-    if kwargs.get('updated_fields') is None or \
-            'email' in kwargs['update_fields']:
+    if kwargs.get('update_fields') is None or \
+            len(set(display_recipient_fields) & set(kwargs['update_fields'])) > 0:
         delete_display_recipient_cache(user_profile)
 
     # Invalidate our active_bots_in_realm info dict if any bot has
@@ -390,17 +913,18 @@ def flush_user_profile(sender, **kwargs):
 def flush_realm(sender, **kwargs):
     # type: (Any, **Any) -> None
     realm = kwargs['instance']
+    # The user profile caches are keyed by user, rather than by realm,
+    # so they have to be deleted one by one.
     users = realm.get_active_users()
     delete_user_profile_caches(users)
-
-    if realm.deactivated:
-        cache_delete(active_user_dicts_in_realm_cache_key(realm))
-        cache_delete(active_bot_dicts_in_realm_cache_key(realm))
-        cache_delete(realm_alert_words_cache_key(realm))
+    bump_realm_state_version(realm.id)
+    # Everything else we cache for the realm (including the Streams,
+    # with their copies of the Realm) is keyed by its generation.
+    bump_realm_generation(realm.id)
 
 def realm_alert_words_cache_key(realm):
     # type: (Realm) -> Text
-    return u"realm_alert_words:%s" % (realm.domain,)
+    return with_realm_generation(u"realm_alert_words:%s" % (realm.domain,), realm.id)
 
 # Called by models.py to flush the stream cache whenever we save a stream
 # object.
@@ -411,6 +935,10 @@ def flush_stream(sender, **kwargs):
     items_for_remote_cache = {}
     items_for_remote_cache[get_stream_cache_key(stream.name, stream.realm)] = (stream,)
     cache_set_many(items_for_remote_cache)
+    bump_realm_state_version(stream.realm_id)
+
+    if kwargs.get('update_fields') is None or 'name' in kwargs['update_fields']:
+        bump_stream_generation(stream.id)
 
     if kwargs.get('update_fields') is None or 'name' in kwargs['update_fields'] and \
        UserProfile.objects.filter(
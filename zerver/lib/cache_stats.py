@@ -0,0 +1,181 @@
+from __future__ import absolute_import
+from __future__ import division
+
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Text, Tuple
+
+from six.moves import cPickle as pickle
+
+from zerver.lib.redis_utils import get_redis_client
+from zerver.lib.utils import statsd, statsd_key
+
+import logging
+import random
+import redis
+import time
+
+# Accounting of the remote cache requests made with cache_get,
+# cache_get_many, cache_set and cache_set_many, by key family (the part
+# of the key before the first ':').  Each process accumulates its
+# statistics locally, and at most every FLUSH_INTERVAL_SECONDS sends
+# them to statsd and adds them to a redis hash shared by every process,
+# for `./manage.py cache_stats`.  The statistics for the current request
+# are also kept, for the slow request log line; in Tornado, which
+# handles several requests at once, those are only approximate.
+
+FLUSH_INTERVAL_SECONDS = 10.0
+
+# Measuring a value means pickling it again, so we only measure this
+# fraction of them, and scale up.
+BYTES_SAMPLE_RATE = 0.05
+
+CACHE_STATS_REDIS_KEY = "remote_cache_stats"
+
+# Besides counts of hits, misses, local cache hits, sets, and the
+# sampled values and their sizes, we keep the time spent in gets and
+# sets, in milliseconds.  A request for several keys counts an equal
+# share of its time against each of them.
+TIME_FIELDS = ['get_ms', 'set_ms']
+
+# family -> field -> value, since we last flushed them
+pending = {} # type: Dict[Text, Dict[str, float]]
+# family -> field -> value, since the current request started
+request_stats = {} # type: Dict[Text, Dict[str, float]]
+started = time.time()
+last_flush = started
+
+def add(family, field, value=1):
+    # type: (Text, str, float) -> None
+    for stats in (pending, request_stats):
+        family_stats = stats.setdefault(family, {})
+        family_stats[field] = family_stats.get(field, 0) + value
+
+def sample_bytes(family, prefix, values):
+    # type: (Text, str, Iterable[Any]) -> None
+    for value in values:
+        if random.random() < BYTES_SAMPLE_RATE:
+            add(family, '%s_sampled' % (prefix,))
+            add(family, '%s_bytes_sampled' % (prefix,),
+                len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+
+def group_by_family(keys):
+    # type: (Iterable[Text]) -> Dict[Text, List[Text]]
+    families = {} # type: Dict[Text, List[Text]]
+    for key in keys:
+        families.setdefault(key.split(u':', 1)[0], []).append(key)
+    return families
+
+def record_cache_gets(keys, found, elapsed):
+    # type: (List[Text], Mapping[Text, Any], float) -> None
+    """Records a remote request for `keys`, which took `elapsed` seconds
+    and returned `found`."""
+    if not keys:
+        return
+    share_ms = elapsed * 1000 / len(keys)
+    for family, family_keys in group_by_family(keys).items():
+        hits = [found[key] for key in family_keys if key in found]
+        add(family, 'hits', len(hits))
+        add(family, 'misses', len(family_keys) - len(hits))
+        add(family, 'get_ms', share_ms * len(family_keys))
+        sample_bytes(family, 'read', hits)
+    maybe_flush()
+
+def record_cache_sets(items, elapsed):
+    # type: (Mapping[Text, Any], float) -> None
+    if not items:
+        return
+    share_ms = elapsed * 1000 / len(items)
+    for family, family_keys in group_by_family(items.keys()).items():
+        add(family, 'sets', len(family_keys))
+        add(family, 'set_ms', share_ms * len(family_keys))
+        sample_bytes(family, 'write', [items[key] for key in family_keys])
+    maybe_flush()
+
+def record_local_cache_hits(keys):
+    # type: (Iterable[Text]) -> None
+    for family, family_keys in group_by_family(keys).items():
+        add(family, 'local_hits', len(family_keys))
+
+def maybe_flush():
+    # type: () -> None
+    if time.time() - last_flush >= FLUSH_INTERVAL_SECONDS:
+        flush()
+
+def flush():
+    # type: () -> None
+    global pending
+    global last_flush
+    last_flush = time.time()
+    if not pending:
+        return
+    flushing = pending
+    pending = {}
+
+    for family, family_stats in flushing.items():
+        metric = "remote_cache.%s" % (statsd_key(family, clean_periods=True),)
+        for field in ('hits', 'misses', 'local_hits', 'sets'):
+            if family_stats.get(field):
+                statsd.incr("%s.%s" % (metric, field), int(family_stats[field]))
+
+    try:
+        pipeline = get_redis_client().pipeline()
+        for family, family_stats in flushing.items():
+            for field, value in family_stats.items():
+                redis_field = "%s:%s" % (family, field)
+                if field in TIME_FIELDS:
+                    pipeline.hincrbyfloat(CACHE_STATS_REDIS_KEY, redis_field, value)
+                else:
+                    pipeline.hincrby(CACHE_STATS_REDIS_KEY, redis_field, int(value))
+        pipeline.hsetnx(CACHE_STATS_REDIS_KEY, 'since', started)
+        pipeline.execute()
+    except redis.RedisError:
+        # These statistics aren't worth failing a request over.
+        logging.warning("Could not record the remote cache statistics in redis")
+
+def get_cache_stats():
+    # type: () -> Tuple[Dict[Text, Dict[str, float]], Optional[float]]
+    """Returns the statistics for each family accumulated in redis, and
+    when they started."""
+    stats = {} # type: Dict[Text, Dict[str, float]]
+    since = None
+    for field, value in get_redis_client().hgetall(CACHE_STATS_REDIS_KEY).items():
+        field = field.decode('utf-8')
+        if field == 'since':
+            since = float(value)
+            continue
+        (family, family_field) = field.rsplit(u':', 1)
+        stats.setdefault(family, {})[family_field] = float(value)
+    return (stats, since)
+
+def clear_cache_stats():
+    # type: () -> None
+    get_redis_client().delete(CACHE_STATS_REDIS_KEY)
+
+def estimated_bytes(family_stats, prefix):
+    # type: (Mapping[str, float], str) -> float
+    """Scales up the sampled sizes of the values read or written."""
+    sampled = family_stats.get('%s_sampled' % (prefix,), 0)
+    if not sampled:
+        return 0
+    count = family_stats.get('hits' if prefix == 'read' else 'sets', 0)
+    return family_stats['%s_bytes_sampled' % (prefix,)] / sampled * count
+
+def start_request_cache_stats():
+    # type: () -> None
+    global request_stats
+    request_stats = {}
+
+def format_request_cache_stats(max_families=3):
+    # type: (int) -> str
+    """Summarizes the families the current request spent the most time
+    fetching, for the slow request log line."""
+    families = sorted(request_stats.items(),
+                      key=lambda item: -(item[1].get('get_ms', 0) + item[1].get('set_ms', 0)))
+    summaries = []
+    for family, family_stats in families[:max_families]:
+        hits = int(family_stats.get('hits', 0))
+        gets = hits + int(family_stats.get('misses', 0))
+        summaries.append("%s %d/%d %.0fms" % (
+            family, hits, gets, family_stats.get('get_ms', 0) + family_stats.get('set_ms', 0)))
+    if not summaries:
+        return ""
+    return " (mem keys: %s)" % (", ".join(summaries),)
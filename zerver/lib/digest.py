@@ -1,18 +1,19 @@
 from __future__ import absolute_import
-from typing import Any, Callable, Iterable, Tuple, Text
+from typing import Any, Callable, Dict, Iterable, List, Set, Tuple, Text
 
 from collections import defaultdict
 import datetime
+import heapq
 import six
 
-from django.db.models import Q, QuerySet
+from django.db.models import F, Q
 from django.template import loader
 from django.conf import settings
 
 from zerver.lib.notifications import build_message_list, hashchange_encode, \
     send_future_email, one_click_unsubscribe_link
-from zerver.models import UserProfile, UserMessage, Recipient, Stream, \
-    Subscription, get_active_streams
+from zerver.models import Message, Realm, UserProfile, UserMessage, Recipient, \
+    Stream, Subscription, get_active_streams
 from zerver.context_processors import common_context
 
 import logging
@@ -34,29 +35,29 @@ logger.addHandler(file_handler)
 # 3. New users
 # 4. Interesting stream traffic, as determined by the longest and most
 #    diversely comment upon topics.
-
-def gather_hot_conversations(user_profile, stream_messages):
-    # type: (UserProfile, QuerySet) -> List[Dict[str, Any]]
+#
+# Everything but the missed PMs and the traffic in invite-only streams
+# is the same for everyone in a realm (apart from which streams they
+# are subscribed to), so we gather it once per realm in a RealmDigest,
+# and each user's digest picks out the parts relevant to them.
+
+# enqueue_digest_emails queues a realm's users in events of this many,
+# and we load each chunk's users, subscriptions and PMs in a few queries.
+DIGEST_CHUNK_SIZE = 500
+
+# Show up to 4 missed PMs.
+PMS_LIMIT = 4
+# ...and up to 4 hot conversations, with up to 2 messages from each.
+HOT_CONVERSATIONS_LIMIT = 4
+TEASER_MESSAGES_LIMIT = 2
+
+ConversationKey = Tuple[int, Text] # (stream recipient id, subject)
+
+def choose_hot_conversations(conversation_length, conversation_diversity):
+    # type: (Dict[ConversationKey, int], Dict[ConversationKey, Set[Text]]) -> List[ConversationKey]
     # Gather stream conversations of 2 types:
     # 1. long conversations
     # 2. conversations where many different people participated
-    #
-    # Returns a list of dictionaries containing the templating
-    # information for each hot conversation.
-
-    conversation_length = defaultdict(int) # type: Dict[Tuple[int, Text], int]
-    conversation_diversity = defaultdict(set) # type: Dict[Tuple[int, Text], Set[Text]]
-    for user_message in stream_messages:
-        if not user_message.message.sent_by_human():
-            # Don't include automated messages in the count.
-            continue
-
-        key = (user_message.message.recipient.type_id,
-               user_message.message.subject)
-        conversation_diversity[key].add(
-            user_message.message.sender.full_name)
-        conversation_length[key] += 1
-
     diversity_list = list(conversation_diversity.items())
     diversity_list.sort(key=lambda entry: len(entry[1]), reverse=True)
 
@@ -69,59 +70,41 @@ def gather_hot_conversations(user_profile, stream_messages):
     for candidate, _ in length_list:
         if candidate not in hot_conversations:
             hot_conversations.append(candidate)
-        if len(hot_conversations) >= 4:
+        if len(hot_conversations) >= HOT_CONVERSATIONS_LIMIT:
             break
 
     # There was so much overlap between the diversity and length lists that we
     # still have < 4 conversations. Try to use remaining diversity items to pad
     # out the hot conversations.
     num_convos = len(hot_conversations)
-    if num_convos < 4:
-        hot_conversations.extend([elt[0] for elt in diversity_list[num_convos:4]])
-
-    hot_conversation_render_payloads = []
-    for h in hot_conversations:
-        stream_id, subject = h
-        users = list(conversation_diversity[h])
-        count = conversation_length[h]
-
-        # We'll display up to 2 messages from the conversation.
-        first_few_messages = [user_message.message for user_message in
-                              stream_messages.filter(
-                                  message__recipient__type_id=stream_id,
-                                  message__subject=subject)[:2]]
-
-        teaser_data = {"participants": users,
-                       "count": count - len(first_few_messages),
-                       "first_few_messages": build_message_list(
-                           user_profile, first_few_messages)}
-
-        hot_conversation_render_payloads.append(teaser_data)
-    return hot_conversation_render_payloads
-
-def gather_new_users(user_profile, threshold):
-    # type: (UserProfile, datetime.datetime) -> Tuple[int, List[Text]]
+    if num_convos < HOT_CONVERSATIONS_LIMIT:
+        hot_conversations.extend([elt[0] for elt in
+                                  diversity_list[num_convos:HOT_CONVERSATIONS_LIMIT]])
+    return hot_conversations
+
+def gather_new_users(realm, threshold):
+    # type: (Realm, datetime.datetime) -> Tuple[int, List[Text]]
     # Gather information on users in the realm who have recently
     # joined.
-    if user_profile.realm.is_zephyr_mirror_realm:
+    if realm.is_zephyr_mirror_realm:
         new_users = [] # type: List[UserProfile]
     else:
         new_users = list(UserProfile.objects.filter(
-            realm=user_profile.realm, date_joined__gt=threshold,
+            realm=realm, date_joined__gt=threshold,
             is_bot=False))
     user_names = [user.full_name for user in new_users]
 
     return len(user_names), user_names
 
-def gather_new_streams(user_profile, threshold):
-    # type: (UserProfile, datetime.datetime) -> Tuple[int, Dict[str, List[Text]]]
-    if user_profile.realm.is_zephyr_mirror_realm:
+def gather_new_streams(realm, threshold):
+    # type: (Realm, datetime.datetime) -> Tuple[int, Dict[str, List[Text]]]
+    if realm.is_zephyr_mirror_realm:
         new_streams = [] # type: List[Stream]
     else:
-        new_streams = list(get_active_streams(user_profile.realm).filter(
+        new_streams = list(get_active_streams(realm).filter(
             invite_only=False, date_created__gt=threshold))
 
-    base_url = u"%s/#narrow/stream/" % (user_profile.realm.uri,)
+    base_url = u"%s/#narrow/stream/" % (realm.uri,)
 
     streams_html = []
     streams_plain = []
@@ -134,6 +117,120 @@ def gather_new_streams(user_profile, threshold):
 
     return len(new_streams), {"html": streams_html, "plain": streams_plain}
 
+# One stream message, for counting conversations:
+# (message id, stream recipient id, subject, sender's name, client name)
+ConversationMessage = Tuple[int, int, Text, Text, Text]
+
+class StreamConversations(object):
+    """The conversations in some stream messages, in a single pass over
+    them: we count the (human) messages and participants in each
+    conversation, and remember each conversation's first messages.
+    For each stream, we keep only the conversations which could make a
+    user's top 4, so picking a user's hot conversations only looks at a
+    few candidates per stream they are subscribed to."""
+
+    def __init__(self, rows):
+        # type: (Iterable[ConversationMessage]) -> None
+        self.conversation_length = defaultdict(int) # type: Dict[ConversationKey, int]
+        self.conversation_diversity = defaultdict(set) # type: Dict[ConversationKey, Set[Text]]
+        self.teaser_message_ids = defaultdict(list) # type: Dict[ConversationKey, List[int]]
+        self.stream_candidates = {} # type: Dict[int, List[ConversationKey]]
+
+        conversations_by_stream = defaultdict(set) # type: Dict[int, Set[ConversationKey]]
+        for (message_id, recipient_id, subject, sender_name, client_name) in rows:
+            key = (recipient_id, subject)
+            if len(self.teaser_message_ids[key]) < TEASER_MESSAGES_LIMIT:
+                self.teaser_message_ids[key].append(message_id)
+            if not Message.is_human_client(client_name):
+                # Don't include automated messages in the count.
+                continue
+            self.conversation_diversity[key].add(sender_name)
+            self.conversation_length[key] += 1
+            conversations_by_stream[recipient_id].add(key)
+
+        # A user's top conversations by either measure are among the
+        # top conversations, by that measure, of their streams.
+        for recipient_id, keys in conversations_by_stream.items():
+            candidates = heapq.nlargest(HOT_CONVERSATIONS_LIMIT, keys,
+                                        key=lambda key: len(self.conversation_diversity[key]))
+            for key in heapq.nlargest(HOT_CONVERSATIONS_LIMIT, keys,
+                                      key=lambda key: self.conversation_length[key]):
+                if key not in candidates:
+                    candidates.append(key)
+            self.stream_candidates[recipient_id] = candidates
+
+class RealmDigest(object):
+    """The digest content shared by everyone in a realm, since `cutoff_date`.
+
+    Anyone subscribed to a public stream can read its history, so its
+    conversations are gathered once for the whole realm.  Invite-only
+    streams are left out: a subscriber only gets the messages sent
+    while they were subscribed, so their conversations are gathered
+    for each user, from their UserMessage rows (see
+    gather_private_stream_messages)."""
+
+    def __init__(self, realm, cutoff_date):
+        # type: (Realm, datetime.datetime) -> None
+        self.realm = realm
+        self.cutoff_date = cutoff_date
+
+        public_stream_recipient_ids = Recipient.objects.filter(
+            type=Recipient.STREAM,
+            type_id__in=Stream.objects.filter(realm=realm, invite_only=False).values('id')).values('id')
+        rows = Message.objects.filter(
+            recipient_id__in=public_stream_recipient_ids,
+            pub_date__gt=cutoff_date,
+        ).order_by('pub_date').values_list(
+            'id', 'recipient_id', 'subject', 'sender__full_name', 'sending_client__name')
+        self.public_conversations = StreamConversations(rows.iterator())
+        # Teaser message lists, by their message IDs.
+        self.teasers = {} # type: Dict[Tuple[int, ...], List[Dict[str, Any]]]
+
+        new_streams_count, new_streams = gather_new_streams(realm, cutoff_date)
+        new_users_count, new_users = gather_new_users(realm, cutoff_date)
+        self.new_streams_count = new_streams_count
+        self.new_users_count = new_users_count
+        self.template_payload = {
+            'new_streams': new_streams,
+            'new_streams_count': new_streams_count,
+            'new_users': new_users,
+        } # type: Dict[str, Any]
+
+    def hot_conversations(self, user_profile, stream_recipient_ids, private_conversations):
+        # type: (UserProfile, Iterable[int], StreamConversations) -> List[Dict[str, Any]]
+        """Returns the templating information for each of the hot
+        conversations in the given streams, from the realm's public
+        conversations and the user's own `private_conversations`."""
+        conversations = {} # type: Dict[ConversationKey, StreamConversations]
+        conversation_length = {} # type: Dict[ConversationKey, int]
+        conversation_diversity = {} # type: Dict[ConversationKey, Set[Text]]
+        for recipient_id in stream_recipient_ids:
+            for source in (self.public_conversations, private_conversations):
+                for key in source.stream_candidates.get(recipient_id, []):
+                    conversations[key] = source
+                    conversation_length[key] = source.conversation_length[key]
+                    conversation_diversity[key] = source.conversation_diversity[key]
+
+        hot_conversation_render_payloads = []
+        for key in choose_hot_conversations(conversation_length, conversation_diversity):
+            teaser_message_ids = conversations[key].teaser_message_ids[key]
+            teaser_data = {"participants": list(conversation_diversity[key]),
+                           "count": conversation_length[key] - len(teaser_message_ids),
+                           "first_few_messages": self.teaser(user_profile, teaser_message_ids)}
+            hot_conversation_render_payloads.append(teaser_data)
+        return hot_conversation_render_payloads
+
+    def teaser(self, user_profile, message_ids):
+        # type: (UserProfile, List[int]) -> List[Dict[str, Any]]
+        # The message list only depends on the messages, so we build
+        # it the first time any user needs it.
+        teaser_key = tuple(message_ids)
+        if teaser_key not in self.teasers:
+            messages = list(Message.objects.filter(
+                id__in=message_ids).select_related('sender', 'recipient'))
+            self.teasers[teaser_key] = build_message_list(user_profile, messages)
+        return self.teasers[teaser_key]
+
 def enough_traffic(unread_pms, hot_conversations, new_streams, new_users):
     # type: (Text, Text, int, int) -> bool
     if unread_pms or hot_conversations:
@@ -155,62 +252,109 @@ def send_digest_email(user_profile, subject, html_content, text_content):
                       delay=datetime.timedelta(0), sender=sender,
                       tags=["digest-emails"])
 
-def handle_digest_email(user_profile_id, cutoff):
-    # type: (int, float) -> None
-    user_profile = UserProfile.objects.get(id=user_profile_id)
+def gather_missed_pms(user_profiles, cutoff_date):
+    # type: (List[UserProfile], datetime.datetime) -> Dict[int, Tuple[List[Message], int]]
+    """Returns, for each user, up to PMS_LIMIT of their recent PMs, and
+    how many there were."""
+    # You can't have an unread message that you sent, but when testing
+    # this causes confusion so filter your messages out.
+    pms = UserMessage.objects.filter(
+        user_profile__in=user_profiles,
+        message__pub_date__gt=cutoff_date,
+    ).filter(
+        ~Q(message__recipient__type=Recipient.STREAM) &
+        ~Q(message__sender_id=F('user_profile_id'))
+    ).select_related('message', 'message__sender', 'message__recipient').order_by('message__pub_date')
+
+    missed_pms = defaultdict(lambda: ([], 0)) # type: Dict[int, Tuple[List[Message], int]]
+    for pm in pms:
+        (messages, count) = missed_pms[pm.user_profile_id]
+        if count < PMS_LIMIT:
+            messages.append(pm.message)
+        missed_pms[pm.user_profile_id] = (messages, count + 1)
+    return missed_pms
+
+def gather_home_view_streams(user_profiles):
+    # type: (List[UserProfile]) -> Dict[int, List[int]]
+    """The recipient IDs of the streams each user has in their home view."""
+    home_view_streams = defaultdict(list) # type: Dict[int, List[int]]
+    for (user_profile_id, recipient_id) in Subscription.objects.filter(
+            user_profile__in=user_profiles,
+            active=True,
+            in_home_view=True,
+            recipient__type=Recipient.STREAM).values_list('user_profile_id', 'recipient_id'):
+        home_view_streams[user_profile_id].append(recipient_id)
+    return home_view_streams
+
+def gather_private_stream_messages(user_profiles, cutoff_date):
+    # type: (List[UserProfile], datetime.datetime) -> Dict[int, List[ConversationMessage]]
+    """Returns, for each user, the messages they received in
+    invite-only streams since the cutoff."""
+    private_stream_recipient_ids = Recipient.objects.filter(
+        type=Recipient.STREAM,
+        type_id__in=Stream.objects.filter(invite_only=True).values('id')).values('id')
+    rows = UserMessage.objects.filter(
+        user_profile__in=user_profiles,
+        message__recipient_id__in=private_stream_recipient_ids,
+        message__pub_date__gt=cutoff_date,
+    ).order_by('message__pub_date').values_list(
+        'user_profile_id', 'message_id', 'message__recipient_id', 'message__subject',
+        'message__sender__full_name', 'message__sending_client__name')
+
+    private_stream_messages = defaultdict(list) # type: Dict[int, List[ConversationMessage]]
+    for row in rows:
+        private_stream_messages[row[0]].append(row[1:])
+    return private_stream_messages
+
+def handle_digest_emails(user_profile_ids, cutoff):
+    # type: (List[int], float) -> None
     # Convert from epoch seconds to a datetime object.
     cutoff_date = datetime.datetime.utcfromtimestamp(int(cutoff))
-
-    all_messages = UserMessage.objects.filter(
-        user_profile=user_profile,
-        message__pub_date__gt=cutoff_date).order_by("message__pub_date")
+    realm_digests = {} # type: Dict[int, RealmDigest]
+
+    for i in range(0, len(user_profile_ids), DIGEST_CHUNK_SIZE):
+        user_profiles = list(UserProfile.objects.filter(
+            id__in=user_profile_ids[i:i + DIGEST_CHUNK_SIZE]).select_related('realm'))
+        missed_pms = gather_missed_pms(user_profiles, cutoff_date)
+        home_view_streams = gather_home_view_streams(user_profiles)
+        private_stream_messages = gather_private_stream_messages(user_profiles, cutoff_date)
+
+        for user_profile in user_profiles:
+            if user_profile.realm_id not in realm_digests:
+                realm_digests[user_profile.realm_id] = RealmDigest(user_profile.realm, cutoff_date)
+            try:
+                send_digest_for_user(user_profile, realm_digests[user_profile.realm_id],
+                                     missed_pms[user_profile.id],
+                                     home_view_streams[user_profile.id],
+                                     private_stream_messages[user_profile.id])
+            except Exception:
+                # Don't stop the rest of the realm's digests.
+                logger.exception("Error sending digest email for %s" % (user_profile.email,))
+
+def send_digest_for_user(user_profile, realm_digest, missed_pms, home_view_streams,
+                         private_stream_messages):
+    # type: (UserProfile, RealmDigest, Tuple[List[Message], int], List[int], List[ConversationMessage]) -> None
+    (pms, pms_count) = missed_pms
+    private_conversations = StreamConversations(private_stream_messages)
 
     template_payload = common_context(user_profile)
-
-    # Start building email template data.
+    template_payload.update(realm_digest.template_payload)
     template_payload.update({
         'name': user_profile.full_name,
-        'unsubscribe_link': one_click_unsubscribe_link(user_profile, "digest")
+        'unread_pms': build_message_list(user_profile, pms),
+        'remaining_unread_pms_count': min(0, pms_count - PMS_LIMIT),
+        # Gather hot conversations.
+        'hot_conversations': realm_digest.hot_conversations(user_profile, home_view_streams,
+                                                            private_conversations),
     })
 
-    # Gather recent missed PMs, re-using the missed PM email logic.
-    # You can't have an unread message that you sent, but when testing
-    # this causes confusion so filter your messages out.
-    pms = all_messages.filter(
-        ~Q(message__recipient__type=Recipient.STREAM) &
-        ~Q(message__sender=user_profile))
-
-    # Show up to 4 missed PMs.
-    pms_limit = 4
-
-    template_payload['unread_pms'] = build_message_list(
-        user_profile, [pm.message for pm in pms[:pms_limit]])
-    template_payload['remaining_unread_pms_count'] = min(0, len(pms) - pms_limit)
-
-    home_view_recipients = [sub.recipient for sub in
-                            Subscription.objects.filter(
-                                user_profile=user_profile,
-                                active=True,
-                                in_home_view=True)]
-
-    stream_messages = all_messages.filter(
-        message__recipient__type=Recipient.STREAM,
-        message__recipient__in=home_view_recipients)
-
-    # Gather hot conversations.
-    template_payload["hot_conversations"] = gather_hot_conversations(
-        user_profile, stream_messages)
-
-    # Gather new streams.
-    new_streams_count, new_streams = gather_new_streams(
-        user_profile, cutoff_date)
-    template_payload["new_streams"] = new_streams
-    template_payload["new_streams_count"] = new_streams_count
+    # We don't want to send emails containing almost no information.
+    if not enough_traffic(template_payload["unread_pms"],
+                          template_payload["hot_conversations"],
+                          realm_digest.new_streams_count, realm_digest.new_users_count):
+        return
 
-    # Gather users who signed up recently.
-    new_users_count, new_users = gather_new_users(
-        user_profile, cutoff_date)
-    template_payload["new_users"] = new_users
+    template_payload['unsubscribe_link'] = one_click_unsubscribe_link(user_profile, "digest")
 
     subject = loader.render_to_string('zerver/emails/digest/digest_email.subject').strip()
     text_content = loader.render_to_string(
@@ -218,9 +362,9 @@ def handle_digest_email(user_profile_id, cutoff):
     html_content = loader.render_to_string(
         'zerver/emails/digest/digest_email.html', template_payload)
 
-    # We don't want to send emails containing almost no information.
-    if enough_traffic(template_payload["unread_pms"],
-                      template_payload["hot_conversations"],
-                      new_streams_count, new_users_count):
-        logger.info("Sending digest email for %s" % (user_profile.email,))
-        send_digest_email(user_profile, subject, html_content, text_content)
+    logger.info("Sending digest email for %s" % (user_profile.email,))
+    send_digest_email(user_profile, subject, html_content, text_content)
+
+def handle_digest_email(user_profile_id, cutoff):
+    # type: (int, float) -> None
+    handle_digest_emails([user_profile_id], cutoff)
@@ -0,0 +1,241 @@
+"""
+Delivery of the emails queued as ScheduledJobs (by send_future_email
+and friends) on deployments which send email over SMTP; see the
+deliver_email management command.
+
+Each sender claims a batch of due jobs in a transaction, locking them
+with SELECT ... FOR UPDATE SKIP LOCKED, so several senders (threads,
+processes or machines) can work through the queue at once without
+sending an email twice.  A sender keeps its SMTP connection open
+between batches, and deletes the batch's delivered jobs in one query.
+Jobs which fail are rescheduled, backing off, so they don't hold up
+the rest of the queue.
+"""
+from __future__ import absolute_import
+from __future__ import division
+
+from django.conf import settings
+from django.core.mail import get_connection, send_mail
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.html import format_html
+
+from zerver.models import ScheduledJob
+from zerver.lib.utils import statsd
+
+from typing import Dict, List, Optional, Tuple
+from ujson import loads
+
+import datetime
+import logging
+import smtplib
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# The number of jobs each sender claims at a time.
+DELIVERY_BATCH_SIZE = 100
+# The number of senders, each with its own SMTP connection.
+NUM_SENDERS = 4
+# How long a sender waits before looking again when no jobs are due.
+IDLE_POLL_SECONDS = 2
+# How often we log the delivery throughput.
+REPORT_INTERVAL_SECONDS = 60
+# A job we fail to deliver is retried after RETRY_DELAY_SECONDS, then
+# twice as long after each further failure, up to MAX_RETRY_DELAY_SECONDS,
+# and dropped after MAX_DELIVERY_ATTEMPTS failures.  Retrying it later
+# makes room for the jobs behind it in the queue.
+RETRY_DELAY_SECONDS = 60
+MAX_RETRY_DELAY_SECONDS = 6 * 60 * 60
+MAX_DELIVERY_ATTEMPTS = 10
+
+def get_recipient_as_string(dictionary):
+    # type: (Dict[str, str]) -> str
+    if not dictionary["recipient_name"]:
+        return dictionary["recipient_email"]
+    return format_html(u"\"{0}\" <{1}>", dictionary["recipient_name"], dictionary["recipient_email"])
+
+def get_sender_as_string(dictionary):
+    # type: (Dict[str, str]) -> str
+    if dictionary["sender_email"]:
+        return dictionary["sender_email"] if not dictionary["sender_name"] else format_html(u"\"{0}\" <{1}>",
+                                                                                            dictionary["sender_name"],
+                                                                                            dictionary["sender_email"])
+    return settings.DEFAULT_FROM_EMAIL
+
+def send_email_job(job, mail_connection=None):
+    # type: (ScheduledJob, Optional[BaseEmailBackend]) -> bool
+    data = loads(job.data)
+    subject = data["email_subject"]
+    message = data["email_text"]
+    from_email = get_sender_as_string(data)
+    to_email = get_recipient_as_string(data)
+
+    if data["email_html"]:
+        html_message = data["email_html"]
+        return send_mail(subject, message, from_email, [to_email], html_message=html_message,
+                         connection=mail_connection) > 0
+    return send_mail(subject, message, from_email, [to_email], connection=mail_connection) > 0
+
+def claim_due_email_jobs(batch_size):
+    # type: (int) -> List[ScheduledJob]
+    """Locks and returns up to `batch_size` email jobs which are due.
+    This must be called in a transaction, which holds the locks until
+    it ends; jobs which another sender has locked are skipped."""
+    # SKIP LOCKED is new in PostgreSQL 9.5; before that, concurrent
+    # senders wait for each other's batches rather than skipping them.
+    skip_locked = ""
+    if connection.vendor == 'postgresql' and connection.pg_version >= 90500:
+        skip_locked = " SKIP LOCKED"
+    query = ("SELECT * FROM %s WHERE type = %%s AND scheduled_timestamp <= %%s "
+             "ORDER BY scheduled_timestamp LIMIT %%s FOR UPDATE%s" % (
+                 ScheduledJob._meta.db_table, skip_locked))
+    return list(ScheduledJob.objects.raw(query, [ScheduledJob.EMAIL, timezone.now(), batch_size]))
+
+def send_email_job_with_connection(job, mail_connection):
+    # type: (ScheduledJob, BaseEmailBackend) -> bool
+    # Opening an open connection does nothing; we open it ourselves so
+    # that sending doesn't close it again afterwards.
+    mail_connection.open()
+    try:
+        return send_email_job(job, mail_connection)
+    except smtplib.SMTPServerDisconnected:
+        # The server dropped our idle connection; reconnect and retry once.
+        mail_connection.close()
+        mail_connection.open()
+        return send_email_job(job, mail_connection)
+
+def retry_email_job(job):
+    # type: (ScheduledJob) -> bool
+    """Reschedules a job we failed to deliver, backing off, and returns
+    True; or if it has failed too often, returns False, and the caller
+    should drop it."""
+    attempts = job.delivery_attempts + 1
+    if attempts >= MAX_DELIVERY_ATTEMPTS:
+        return False
+    delay = min(RETRY_DELAY_SECONDS * 2 ** (attempts - 1), MAX_RETRY_DELAY_SECONDS)
+    ScheduledJob.objects.filter(id=job.id).update(
+        delivery_attempts=attempts,
+        scheduled_timestamp=timezone.now() + datetime.timedelta(seconds=delay))
+    return True
+
+def deliver_email_batch(mail_connection, batch_size=DELIVERY_BATCH_SIZE):
+    # type: (BaseEmailBackend, int) -> Tuple[int, int]
+    """Sends a batch of due email jobs over `mail_connection`, and
+    returns how many were delivered and how many failed.  Failed jobs
+    are rescheduled to be retried later (see retry_email_job)."""
+    delivered = 0
+    failed = 0
+    with transaction.atomic():
+        done_job_ids = [] # type: List[int]
+        for job in claim_due_email_jobs(batch_size):
+            try:
+                if send_email_job_with_connection(job, mail_connection):
+                    delivered += 1
+                    done_job_ids.append(job.id)
+                    continue
+                logger.warning("No exception raised, but %r sent as 0 bytes" % (job,))
+            except smtplib.SMTPRecipientsRefused:
+                # Retrying won't help.
+                logger.warning("Dropping %r, as the recipient was refused" % (job,))
+                failed += 1
+                done_job_ids.append(job.id)
+                continue
+            except smtplib.SMTPException:
+                logger.exception("Error delivering %r" % (job,))
+            except socket.error:
+                # We can't reach the server, so leave the rest of the
+                # batch for later.
+                logger.exception("Error connecting to deliver %r; will retry" % (job,))
+                mail_connection.close()
+                failed += 1
+                break
+
+            failed += 1
+            if not retry_email_job(job):
+                logger.error("Dropping %r after %d failed attempts" % (job, MAX_DELIVERY_ATTEMPTS))
+                done_job_ids.append(job.id)
+        if done_job_ids:
+            ScheduledJob.objects.filter(id__in=done_job_ids).delete()
+    return (delivered, failed)
+
+class EmailDeliverer(object):
+    """Runs `num_senders` senders, each delivering batches of due email
+    jobs over its own persistent SMTP connection, and keeps track of
+    the delivery throughput."""
+
+    def __init__(self, num_senders=NUM_SENDERS, batch_size=DELIVERY_BATCH_SIZE):
+        # type: (int, int) -> None
+        self.num_senders = num_senders
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.delivered = 0
+        self.failed = 0
+        self.last_report = self.started
+        self.delivered_since_report = 0
+
+    def record(self, delivered, failed):
+        # type: (int, int) -> None
+        if delivered:
+            statsd.incr("email_deliverer.delivered", delivered)
+        if failed:
+            statsd.incr("email_deliverer.failed", failed)
+        with self.lock:
+            self.delivered += delivered
+            self.failed += failed
+            self.delivered_since_report += delivered
+            now = time.time()
+            if now - self.last_report >= REPORT_INTERVAL_SECONDS:
+                logger.info("Delivered %d emails in the last %.0fs (%.1f/s)" % (
+                    self.delivered_since_report, now - self.last_report,
+                    self.delivered_since_report / (now - self.last_report)))
+                self.last_report = now
+                self.delivered_since_report = 0
+
+    def throughput(self):
+        # type: () -> float
+        """Emails delivered per second, since we started."""
+        elapsed = time.time() - self.started
+        return self.delivered / elapsed if elapsed > 0 else 0
+
+    def run_sender(self, once=False):
+        # type: (bool) -> None
+        mail_connection = get_connection()
+        try:
+            while True:
+                (delivered, failed) = deliver_email_batch(mail_connection, self.batch_size)
+                self.record(delivered, failed)
+                if delivered == 0:
+                    if once:
+                        return
+                    time.sleep(IDLE_POLL_SECONDS)
+        finally:
+            mail_connection.close()
+
+    def run_sender_thread(self, once):
+        # type: (bool) -> None
+        try:
+            self.run_sender(once)
+        finally:
+            # Each thread has its own database connection.
+            connection.close()
+
+    def run(self, once=False):
+        # type: (bool) -> None
+        """Delivers emails until stopped, or with `once`, until there
+        are none left which are due."""
+        if self.num_senders == 1:
+            self.run_sender(once)
+            return
+
+        threads = [threading.Thread(target=self.run_sender_thread, args=(once,))
+                   for i in range(self.num_senders)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
@@ -301,18 +301,24 @@ def access_message(user_profile, message_id):
     # stream in your realm, so return the message, user_message pair
     return (message, user_message)
 
-def render_markdown(message, content, realm=None, realm_alert_words=None, message_users=None):
-    # type: (Message, Text, Optional[Realm], Optional[RealmAlertWords], Set[UserProfile]) -> Text
+def render_markdown(message, content, realm=None, realm_alert_words=None, message_users=None,
+                    message_user_ids=None):
+    # type: (Message, Text, Optional[Realm], Optional[RealmAlertWords], Set[UserProfile], Optional[Set[int]]) -> Text
     """Return HTML for given markdown. Bugdown may add properties to the
     message object such as `mentions_user_ids` and `mentions_wildcard`.
     These are only on this Django object and are not saved in the
     database.
+
+    Only the ids of the recipients are needed, so callers which don't
+    otherwise need their UserProfiles can pass `message_user_ids`
+    instead of `message_users`.
     """
 
-    if message_users is None:
-        message_user_ids = set() # type: Set[int]
-    else:
-        message_user_ids = {u.id for u in message_users}
+    if message_user_ids is None:
+        if message_users is None:
+            message_user_ids = set()
+        else:
+            message_user_ids = {u.id for u in message_users}
 
     if message is not None:
         message.mentions_wildcard = False
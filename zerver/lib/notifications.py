@@ -1,14 +1,16 @@
 from __future__ import print_function
 
-from typing import cast, Any, Iterable, Mapping, Optional, Sequence, Tuple, Text
+from typing import cast, Any, Dict, Iterable, List, Mapping, Optional, Sequence, Set, Tuple, Text
 
 import mandrill
 from confirmation.models import Confirmation
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.template import loader
 from django.utils import timezone
 from zerver.decorator import statsd_increment, uses_mandrill
+from zerver.lib.cache import delete_user_profile_caches
+from zerver.lib.utils import statsd
 from zerver.models import (
     Recipient,
     ScheduledJob,
@@ -17,19 +19,19 @@ from zerver.models import (
     get_display_recipient,
     UserProfile,
     get_user_profile_by_email,
-    get_user_profile_by_id,
     receives_offline_notifications,
-    get_context_for_message,
+    bulk_get_context_for_messages,
     Message,
     Realm,
 )
 
 import datetime
+import logging
 import re
 import subprocess
 import ujson
 from six.moves import urllib
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 def unsubscribe_token(user_profile):
     # type: (UserProfile) -> Text
@@ -72,14 +74,21 @@ def topic_narrow_url(realm, stream, topic):
     return u"%s%s/topic/%s" % (base_url, hashchange_encode(stream),
                                hashchange_encode(topic))
 
-def build_message_list(user_profile, messages):
-    # type: (UserProfile, List[Message]) -> List[Dict[str, Any]]
+def build_message_list(user_profile, messages, rendered_messages=None):
+    # type: (UserProfile, List[Message], Optional[Dict[Tuple[int, int], Dict[str, Text]]]) -> List[Dict[str, Any]]
     """
     Builds the message list object for the missed message email template.
     The messages are collapsed into per-recipient and per-sender blocks, like
     our web interface
+
+    A message's content in the email only depends on the message and the
+    realm, so callers building several users' emails can pass the same
+    `rendered_messages` dict to each call, to rewrite each message once.
     """
     messages_to_render = [] # type: List[Dict[str, Any]]
+    if rendered_messages is None:
+        rendered_messages = {}
+    headers = {} # type: Dict[Tuple[int, Text, int], Dict[str, Any]]
 
     def sender_string(message):
         # type: (Message) -> Text
@@ -127,15 +136,18 @@ def build_message_list(user_profile, messages):
 
     def build_message_payload(message):
         # type: (Message) -> Dict[str, Text]
-        plain = message.content
-        plain = fix_plaintext_image_urls(plain)
-        plain = relative_to_full_url(plain)
+        key = (user_profile.realm_id, message.id)
+        if key not in rendered_messages:
+            plain = message.content
+            plain = fix_plaintext_image_urls(plain)
+            plain = relative_to_full_url(plain)
 
-        html = message.rendered_content
-        html = relative_to_full_url(html)
-        html = fix_emoji_sizes(html)
+            html = message.rendered_content
+            html = relative_to_full_url(html)
+            html = fix_emoji_sizes(html)
 
-        return {'plain': plain, 'html': html}
+            rendered_messages[key] = {'plain': plain, 'html': html}
+        return rendered_messages[key]
 
     def build_sender_payload(message):
         # type: (Message) -> Dict[str, Any]
@@ -197,7 +209,12 @@ def build_message_list(user_profile, messages):
     messages.sort(key=lambda message: message.pub_date)
 
     for message in messages:
-        header = message_header(user_profile, message)
+        # The messages usually share a recipient, so we only work out
+        # the header (which needs the display recipient) once.
+        header_key = (message.recipient_id, message.subject, message.sender_id)
+        if header_key not in headers:
+            headers[header_key] = message_header(user_profile, message)
+        header = headers[header_key]
 
         # If we want to collapse into the previous recipient block
         if len(messages_to_render) > 0 and messages_to_render[-1]['header'] == header:
@@ -219,6 +236,74 @@ def build_message_list(user_profile, messages):
 
     return messages_to_render
 
+class MissedMessageEmailRenderer(object):
+    """Renders missed message emails, sharing work between them: each
+    message's content is rewritten once however many of the emails
+    include it, and the templates are loaded once."""
+
+    def __init__(self):
+        # type: () -> None
+        self.rendered_messages = {} # type: Dict[Tuple[int, int], Dict[str, Text]]
+        self.text_template = loader.get_template('zerver/missed_message_email.txt')
+        self.html_template = loader.get_template('zerver/missed_message_email.html')
+
+    def render(self, user_profile, missed_messages, message_count):
+        # type: (UserProfile, List[Message], int) -> EmailMultiAlternatives
+        """
+        `user_profile` is the user to send the reminder to
+        `missed_messages` is a list of Message objects to remind about they should
+                          all have the same recipient and subject
+        """
+        from zerver.context_processors import common_context
+        recipients = set((msg.recipient_id, msg.subject) for msg in missed_messages)
+        if len(recipients) != 1:
+            raise ValueError(
+                'All missed_messages must have the same recipient and subject %r' %
+                recipients
+            )
+
+        unsubscribe_link = one_click_unsubscribe_link(user_profile, "missed_messages")
+        template_payload = common_context(user_profile)
+        template_payload.update({
+            'name': user_profile.full_name,
+            'messages': build_message_list(user_profile, missed_messages,
+                                           self.rendered_messages),
+            'message_count': message_count,
+            'reply_warning': False,
+            'mention': missed_messages[0].recipient.type == Recipient.STREAM,
+            'reply_to_zulip': True,
+            'unsubscribe_link': unsubscribe_link,
+        })
+
+        headers = {}
+        from zerver.lib.email_mirror import create_missed_message_address
+        address = create_missed_message_address(user_profile, missed_messages[0])
+        headers['Reply-To'] = address
+
+        senders = set(m.sender.full_name for m in missed_messages)
+        sender_str = ", ".join(senders)
+        plural_messages = 's' if len(missed_messages) > 1 else ''
+
+        subject = "Missed Zulip%s from %s" % (plural_messages, sender_str)
+        from_email = 'Zulip <%s>' % (settings.NOREPLY_EMAIL_ADDRESS,)
+        if len(senders) == 1 and settings.SEND_MISSED_MESSAGE_EMAILS_AS_USER:
+            # If this setting is enabled, you can reply to the Zulip
+            # missed message emails directly back to the original sender.
+            # However, one must ensure the Zulip server is in the SPF
+            # record for the domain, or there will be spam/deliverability
+            # problems.
+            headers['Sender'] = from_email
+            sender = missed_messages[0].sender
+            from_email = '"%s" <%s>' % (sender_str, sender.email)
+
+        text_content = self.text_template.render(template_payload)
+        html_content = self.html_template.render(template_payload)
+
+        msg = EmailMultiAlternatives(subject, text_content, from_email, [user_profile.email],
+                                     headers = headers)
+        msg.attach_alternative(html_content, "text/html")
+        return msg
+
 @statsd_increment("missed_message_reminders")
 def do_send_missedmessage_events_reply_in_zulip(user_profile, missed_messages, message_count):
     # type: (UserProfile, List[Message], int) -> None
@@ -230,102 +315,105 @@ def do_send_missedmessage_events_reply_in_zulip(user_profile, missed_messages, m
     allows the user to respond to missed PMs, huddles, and @-mentions directly
     from the email.
 
-    `user_profile` is the user to send the reminder to
-    `missed_messages` is a list of Message objects to remind about they should
-                      all have the same recipient and subject
+    See MissedMessageEmailRenderer.render for the arguments.
     """
-    from zerver.context_processors import common_context
     # Disabled missedmessage emails internally
     if not user_profile.enable_offline_email_notifications:
         return
 
-    recipients = set((msg.recipient_id, msg.subject) for msg in missed_messages)
-    if len(recipients) != 1:
-        raise ValueError(
-            'All missed_messages must have the same recipient and subject %r' %
-            recipients
-        )
-
-    unsubscribe_link = one_click_unsubscribe_link(user_profile, "missed_messages")
-    template_payload = common_context(user_profile)
-    template_payload.update({
-        'name': user_profile.full_name,
-        'messages': build_message_list(user_profile, missed_messages),
-        'message_count': message_count,
-        'reply_warning': False,
-        'mention': missed_messages[0].recipient.type == Recipient.STREAM,
-        'reply_to_zulip': True,
-        'unsubscribe_link': unsubscribe_link,
-    })
-
-    headers = {}
-    from zerver.lib.email_mirror import create_missed_message_address
-    address = create_missed_message_address(user_profile, missed_messages[0])
-    headers['Reply-To'] = address
-
-    senders = set(m.sender.full_name for m in missed_messages)
-    sender_str = ", ".join(senders)
-    plural_messages = 's' if len(missed_messages) > 1 else ''
-
-    subject = "Missed Zulip%s from %s" % (plural_messages, sender_str)
-    from_email = 'Zulip <%s>' % (settings.NOREPLY_EMAIL_ADDRESS,)
-    if len(senders) == 1 and settings.SEND_MISSED_MESSAGE_EMAILS_AS_USER:
-        # If this setting is enabled, you can reply to the Zulip
-        # missed message emails directly back to the original sender.
-        # However, one must ensure the Zulip server is in the SPF
-        # record for the domain, or there will be spam/deliverability
-        # problems.
-        headers['Sender'] = from_email
-        sender = missed_messages[0].sender
-        from_email = '"%s" <%s>' % (sender_str, sender.email)
-
-    text_content = loader.render_to_string('zerver/missed_message_email.txt', template_payload)
-    html_content = loader.render_to_string('zerver/missed_message_email.html', template_payload)
-
-    msg = EmailMultiAlternatives(subject, text_content, from_email, [user_profile.email],
-                                 headers = headers)
-    msg.attach_alternative(html_content, "text/html")
-    msg.send()
+    MissedMessageEmailRenderer().render(user_profile, missed_messages, message_count).send()
 
     user_profile.last_reminder = timezone.now()
     user_profile.save(update_fields=['last_reminder'])
 
 def handle_missedmessage_emails(user_profile_id, missed_email_events):
     # type: (int, Iterable[Dict[str, Any]]) -> None
-    message_ids = [event.get('message_id') for event in missed_email_events]
-
-    user_profile = get_user_profile_by_id(user_profile_id)
-    if not receives_offline_notifications(user_profile):
-        return
+    handle_missedmessage_emails_for_users({user_profile_id: list(missed_email_events)})
+
+def handle_missedmessage_emails_for_users(missed_email_events_by_user):
+    # type: (Mapping[int, Iterable[Dict[str, Any]]]) -> List[int]
+    """Sends each user an email per conversation (recipient and
+    subject) in which they have unread missed messages.
+
+    The users, their unread messages (with senders and recipients) and
+    the context for the stream conversations are each fetched in one
+    query for all of the users, and the emails are sent over a single
+    connection.  Each user's emails are rendered and sent separately,
+    though, so that a failure only affects that user; returns the IDs
+    of the users whose emails couldn't be sent."""
+    user_profiles = [user_profile for user_profile in UserProfile.objects.filter(
+        id__in=missed_email_events_by_user.keys()).select_related('realm')
+        if receives_offline_notifications(user_profile)]
+    if not user_profiles:
+        return []
+
+    requested = set() # type: Set[Tuple[int, int]]
+    for user_profile in user_profiles:
+        for event in missed_email_events_by_user[user_profile.id]:
+            requested.add((user_profile.id, event.get('message_id')))
+
+    messages_by_user = defaultdict(list) # type: Dict[int, List[Message]]
+    for um in UserMessage.objects.filter(
+            user_profile__in=user_profiles,
+            message__id__in=set(message_id for (_, message_id) in requested),
+            flags=~UserMessage.flags.read).select_related(
+                'message', 'message__sender', 'message__recipient'):
+        if (um.user_profile_id, um.message_id) in requested:
+            messages_by_user[um.user_profile_id].append(um.message)
 
-    messages = [um.message for um in UserMessage.objects.filter(user_profile=user_profile,
-                                                                message__id__in=message_ids,
-                                                                flags=~UserMessage.flags.read)]
-    if not messages:
-        return
-
-    messages_by_recipient_subject = defaultdict(list) # type: Dict[Tuple[int, Text], List[Message]]
-    for msg in messages:
-        messages_by_recipient_subject[(msg.recipient_id, msg.topic_name())].append(msg)
-
-    message_count_by_recipient_subject = {
-        recipient_subject: len(msgs)
-        for recipient_subject, msgs in messages_by_recipient_subject.items()
-    }
-
-    for msg_list in messages_by_recipient_subject.values():
+    # Send an email per recipient subject pair
+    conversations = [] # type: List[Tuple[UserProfile, List[Message]]]
+    for user_profile in user_profiles:
+        messages_by_recipient_subject = defaultdict(list) # type: Dict[Tuple[int, Text], List[Message]]
+        for msg in messages_by_user[user_profile.id]:
+            messages_by_recipient_subject[(msg.recipient_id, msg.topic_name())].append(msg)
+        conversations.extend((user_profile, msg_list)
+                             for msg_list in messages_by_recipient_subject.values())
+
+    first_stream_messages = [] # type: List[Message]
+    for (user_profile, msg_list) in conversations:
         msg = min(msg_list, key=lambda msg: msg.pub_date)
         if msg.recipient.type == Recipient.STREAM:
-            msg_list.extend(get_context_for_message(msg))
+            first_stream_messages.append(msg)
+    context = bulk_get_context_for_messages(first_stream_messages)
 
-    # Send an email per recipient subject pair
-    for recipient_subject, msg_list in messages_by_recipient_subject.items():
-        unique_messages = {m.id: m for m in msg_list}
-        do_send_missedmessage_events_reply_in_zulip(
-            user_profile,
-            list(unique_messages.values()),
-            message_count_by_recipient_subject[recipient_subject],
-        )
+    conversations_by_user = OrderedDict() # type: Dict[int, List[List[Message]]]
+    for (user_profile, msg_list) in conversations:
+        # Disabled missedmessage emails internally
+        if not user_profile.enable_offline_email_notifications:
+            continue
+        conversations_by_user.setdefault(user_profile.id, []).append(msg_list)
+
+    renderer = MissedMessageEmailRenderer()
+    connection = get_connection()
+    users_by_id = {user_profile.id: user_profile for user_profile in user_profiles}
+    reminded_users = [] # type: List[UserProfile]
+    failed_user_ids = [] # type: List[int]
+    for user_profile_id, msg_lists in conversations_by_user.items():
+        user_profile = users_by_id[user_profile_id]
+        try:
+            emails = [] # type: List[EmailMultiAlternatives]
+            for msg_list in msg_lists:
+                msg = min(msg_list, key=lambda msg: msg.pub_date)
+                unique_messages = {m.id: m for m in msg_list + context.get(msg.id, [])}
+                emails.append(renderer.render(user_profile, list(unique_messages.values()),
+                                              len(msg_list)))
+            connection.send_messages(emails)
+        except Exception:
+            logging.exception("Error sending missed message emails to %s" % (user_profile.email,))
+            failed_user_ids.append(user_profile_id)
+            # The connection may be broken; the next send reopens it.
+            connection.close()
+            continue
+        statsd.incr("missed_message_reminders", len(emails))
+        reminded_users.append(user_profile)
+    connection.close()
+
+    if reminded_users:
+        UserProfile.objects.filter(id__in=[user_profile.id for user_profile in reminded_users]).update(
+            last_reminder=timezone.now())
+        delete_user_profile_caches(reminded_users)
+    return failed_user_ids
 
 @uses_mandrill
 def clear_followup_emails_queue(email, mail_client=None):
@@ -1,7 +1,7 @@
 from __future__ import absolute_import
 
 import random
-from typing import Any, Dict, Optional, SupportsInt, Text
+from typing import Any, Dict, Iterable, Optional, SupportsInt, Text
 
 from zerver.models import PushDeviceToken, UserProfile
 from zerver.models import get_user_profile_by_id
@@ -12,6 +12,7 @@ from zerver.lib.redis_utils import get_redis_client
 
 from apns import APNs, Frame, Payload, SENT_BUFFER_QTY
 from gcm import GCM
+import requests
 
 from django.conf import settings
 
@@ -146,15 +147,19 @@ def _do_push_to_apns_service(user, message, apns_connection):
 # Send a push notification to the desired clients
 # extra_data is a dict that will be passed to the
 # mobile app
+#
+# `devices` are the user's APNS PushDeviceTokens, if the caller has
+# already fetched them.
 @statsd_increment("apple_push_notification")
-def send_apple_push_notification(user, alert, **extra_data):
-    # type: (UserProfile, Text, **Any) -> None
+def send_apple_push_notification(user, alert, devices=None, **extra_data):
+    # type: (UserProfile, Text, Optional[Iterable[PushDeviceToken]], **Any) -> None
     if not connection and not dbx_connection:
         logging.error("Attempting to send push notification, but no connection was found. "
                       "This may be because we could not find the APNS Certificate file.")
         return
 
-    devices = PushDeviceToken.objects.filter(user=user, kind=PushDeviceToken.APNS)
+    if devices is None:
+        devices = PushDeviceToken.objects.filter(user=user, kind=PushDeviceToken.APNS)
     # Plain b64 token kept for debugging purposes
     tokens = [(b64_to_hex(device.token), device.ios_app_id, device.token)
               for device in devices]
@@ -196,17 +201,22 @@ if settings.ANDROID_GCM_API_KEY:
 else:
     gcm = None
 
+# Like the APNS connections, we keep our HTTPS connection to GCM open
+# between notifications.
+gcm_session = requests.Session()
+
 @statsd_increment("android_push_notification")
-def send_android_push_notification(user, data):
-    # type: (UserProfile, Dict[str, Any]) -> None
+def send_android_push_notification(user, data, devices=None):
+    # type: (UserProfile, Dict[str, Any], Optional[Iterable[PushDeviceToken]]) -> None
     if not gcm:
         logging.error("Attempting to send a GCM push notification, but no API key was configured")
         return
 
-    reg_ids = [device.token for device in
-               PushDeviceToken.objects.filter(user=user, kind=PushDeviceToken.GCM)]
+    if devices is None:
+        devices = PushDeviceToken.objects.filter(user=user, kind=PushDeviceToken.GCM)
+    reg_ids = [device.token for device in devices]
 
-    res = gcm.json_request(registration_ids=reg_ids, data=data)
+    res = gcm.json_request(registration_ids=reg_ids, data=data, session=gcm_session)
 
     if res and 'success' in res:
         for reg_id, msg_id in res['success'].items():
@@ -12,8 +12,9 @@ import threading
 import atexit
 from collections import defaultdict
 
+from zerver.lib.queue_stats import stamp_enqueue_time
 from zerver.lib.utils import statsd
-from typing import Any, Callable, Dict, Mapping, Optional, Set, Union
+from typing import Any, Callable, Dict, List, Mapping, Optional, Set, Tuple, Union
 
 Consumer = Callable[[BlockingChannel, Basic.Deliver, pika.BasicProperties, str], None]
 
@@ -28,6 +29,7 @@ class SimpleQueueClient(object):
         self.queues = set() # type: Set[str]
         self.channel = None # type: Optional[BlockingChannel]
         self.consumers = defaultdict(set) # type: Dict[str, Set[Consumer]]
+        self.batch_consuming = False
         # Disable RabbitMQ heartbeats since BlockingConnection can't process them
         self.rabbitmq_heartbeat = 0
         self._connect()
@@ -108,6 +110,15 @@ class SimpleQueueClient(object):
 
         self.ensure_queue(queue_name, do_publish)
 
+    def get_queue_depth(self, queue_name):
+        # type: (str) -> int
+        "Returns the number of messages waiting in the queue"
+        if not self.connection.is_open:
+            self._connect()
+        result = self.channel.queue_declare(queue=queue_name, durable=True)
+        self.queues.add(queue_name)
+        return result.method.message_count
+
     def json_publish(self, queue_name, body):
         # type: (str, Union[Mapping[str, Any], str]) -> None
         # Union because of zerver.middleware.write_log_line uses a str
@@ -163,13 +174,162 @@ class SimpleQueueClient(object):
         self.ensure_queue(queue_name, opened)
         return messages
 
+    def consume_json_batches(self, queue_name, callback, batch_size, max_wait):
+        # type: (str, Callable[[List[Dict[str, Any]]], None], int, float) -> None
+        """Consumes the queue in batches of up to `batch_size` messages,
+        waiting at most about `max_wait` seconds for a batch to fill.
+        RabbitMQ delivers at most `batch_size` unacknowledged messages
+        to us at a time, and each batch is acked in bulk once `callback`
+        returns.  Runs until stop_consuming is called."""
+        def do_consume():
+            # type: () -> None
+            self.channel.basic_qos(prefetch_count=batch_size)
+            batch = [] # type: List[Dict[str, Any]]
+            last_delivery_tag = None # type: Optional[int]
+            batch_start = 0.0
+
+            def process_batch():
+                # type: () -> None
+                try:
+                    callback(batch)
+                except Exception as e:
+                    self.channel.basic_nack(delivery_tag=last_delivery_tag, multiple=True)
+                    raise e
+                self.channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+
+            self.batch_consuming = True
+            for delivery in self.channel.consume(queue_name, inactivity_timeout=max_wait):
+                # The consume generator yields None (or a tuple of
+                # Nones) when no message arrived within max_wait.
+                if delivery is not None and delivery[0] is not None:
+                    (method, properties, body) = delivery
+                    if not batch:
+                        batch_start = time.time()
+                    batch.append(ujson.loads(body))
+                    last_delivery_tag = method.delivery_tag
+
+                if batch and (len(batch) >= batch_size or delivery is None or
+                              delivery[0] is None or time.time() - batch_start >= max_wait):
+                    process_batch()
+                    batch = []
+
+                if not self.batch_consuming:
+                    break
+            self.channel.cancel()
+
+        self.ensure_queue(queue_name, do_consume)
+
     def start_consuming(self):
         # type: () -> None
         self.channel.start_consuming()
 
     def stop_consuming(self):
         # type: () -> None
-        self.channel.stop_consuming()
+        if self.batch_consuming:
+            self.batch_consuming = False
+        else:
+            self.channel.stop_consuming()
+
+class TransactionalQueueClient(SimpleQueueClient):
+    """A SimpleQueueClient whose channel is in transaction mode, so that
+    a batch of messages can be published with a single round trip to
+    RabbitMQ: publish_many returns only once RabbitMQ has taken
+    responsibility for all of them, and if it fails, none of them were
+    published."""
+    def _connect(self):
+        # type: () -> None
+        super(TransactionalQueueClient, self)._connect()
+        self.channel.tx_select()
+
+    def publish_many(self, messages):
+        # type: (List[Tuple[str, str]]) -> None
+        # Unlike publish, we must not reconnect partway through the
+        # batch: the new channel's transaction wouldn't contain what we
+        # had already published, so those messages would be silently
+        # lost.  Instead, losing the connection raises, and the whole
+        # batch is retried (see QueuePublisher).
+        if not self.connection.is_open:
+            self._reconnect()
+        for (queue_name, body) in messages:
+            if not (self.connection.is_open and self.channel.is_open):
+                raise pika.exceptions.ConnectionClosed()
+            if queue_name not in self.queues:
+                self.channel.queue_declare(queue=queue_name, durable=True)
+                self.queues.add(queue_name)
+            self.channel.basic_publish(
+                exchange='',
+                routing_key=queue_name,
+                properties=pika.BasicProperties(delivery_mode=2),
+                body=body)
+        self.channel.tx_commit()
+
+        for (queue_name, body) in messages:
+            statsd.incr("rabbitmq.publish.%s" % (queue_name,))
+
+class InMemoryQueueClient(object):
+    """A stand-in for SimpleQueueClient which keeps its queues in this
+    process's memory, for exercising and benchmarking queue workers
+    and publishers without a RabbitMQ server.  Consuming stops when the
+    queue is empty.  `publish_latency` simulates the round trip to the
+    broker for each publish, or batch of them."""
+    def __init__(self, publish_latency=0.0):
+        # type: (float) -> None
+        self.publish_latency = publish_latency
+        self.queues = defaultdict(list) # type: Dict[str, List[str]]
+        self.consumers = {} # type: Dict[str, Callable[[Mapping[str, Any]], None]]
+
+    def publish(self, queue_name, body):
+        # type: (str, str) -> None
+        self.publish_many([(queue_name, body)])
+
+    def publish_many(self, messages):
+        # type: (List[Tuple[str, str]]) -> None
+        if self.publish_latency:
+            time.sleep(self.publish_latency)
+        for (queue_name, body) in messages:
+            self.queues[queue_name].append(body)
+
+    def json_publish(self, queue_name, body):
+        # type: (str, Union[Mapping[str, Any], str]) -> None
+        self.publish(queue_name, ujson.dumps(body))
+
+    def register_json_consumer(self, queue_name, callback):
+        # type: (str, Callable[[Mapping[str, Any]], None]) -> None
+        self.consumers[queue_name] = callback
+
+    def start_consuming(self):
+        # type: () -> None
+        for queue_name, callback in self.consumers.items():
+            queue = self.queues[queue_name]
+            while queue:
+                callback(ujson.loads(queue.pop(0)))
+
+    def consume_json_batches(self, queue_name, callback, batch_size, max_wait):
+        # type: (str, Callable[[List[Dict[str, Any]]], None], int, float) -> None
+        queue = self.queues[queue_name]
+        while queue:
+            batch = [ujson.loads(body) for body in queue[:batch_size]]
+            del queue[:batch_size]
+            callback(batch)
+
+    def get_queue_depth(self, queue_name):
+        # type: (str) -> int
+        return len(self.queues[queue_name])
+
+    def drain_queue(self, queue_name, json=False):
+        # type: (str, bool) -> List[Any]
+        messages = self.queues.pop(queue_name, [])
+        if json:
+            return [ujson.loads(message) for message in messages]
+        return messages
+
+    def stop_consuming(self):
+        # type: () -> None
+        pass
+
+    def close(self):
+        # type: () -> None
+        pass
 
 # Patch pika.adapters.TornadoConnection so that a socket error doesn't
 # throw an exception and disconnect the tornado process from the rabbitmq
@@ -297,6 +457,71 @@ def setup_tornado_rabbitmq():
     if settings.USING_RABBITMQ:
         atexit.register(lambda: queue_client.close())
 
+# Publishing from Django requests is batched: queue_json_publish calls
+# made while handling a request are buffered (see
+# zerver.middleware.QueuePublishBatching), and when the response is
+# ready, published to RabbitMQ together, in one transaction.  So a
+# request makes at most one round trip to RabbitMQ however many events
+# it publishes, and events are published only after the request's
+# database writes are done.  Nothing is left pending once the request
+# is over, so a recycled or killed worker loses no events.
+PUBLISH_ATTEMPTS = 3
+
+class QueuePublisher(object):
+    """Publishes batches of messages over a single channel (from
+    `client_factory`, normally in transaction mode), in order.  If a
+    batch can't be published, we reconnect and retry it, up to
+    PUBLISH_ATTEMPTS times before we give up and log an error."""
+
+    def __init__(self, client_factory):
+        # type: (Callable[[], Any]) -> None
+        self.client_factory = client_factory
+        self.client = None # type: Any
+        self.lock = threading.Lock()
+        self.log = logging.getLogger('zulip.queue')
+
+    def publish_many(self, messages):
+        # type: (List[Tuple[str, str]]) -> None
+        "Publishes (queue_name, body) pairs; returns once they're published."
+        with self.lock:
+            for attempt in range(PUBLISH_ATTEMPTS):
+                try:
+                    if self.client is None:
+                        self.client = self.client_factory()
+                    self.client.publish_many(messages)
+                    return
+                except (AttributeError, pika.exceptions.AMQPError):
+                    self.log.warning("Failed to publish %d messages, reconnecting" % (len(messages),))
+                    self.client = None
+            self.log.error("Dropping %d messages after %d attempts: %s" % (
+                len(messages), PUBLISH_ATTEMPTS, messages))
+            for (queue_name, body) in messages:
+                statsd.incr("rabbitmq.publish_failed.%s" % (queue_name,))
+
+queue_publisher = None # type: Optional[QueuePublisher]
+def get_queue_publisher():
+    # type: () -> QueuePublisher
+    global queue_publisher
+    if queue_publisher is None:
+        queue_publisher = QueuePublisher(TransactionalQueueClient)
+    return queue_publisher
+
+publish_batch_state = threading.local()
+
+def start_publish_batch():
+    # type: () -> None
+    # Anything left over from a request which didn't finish cleanly
+    # still gets published.
+    flush_publish_batch()
+    publish_batch_state.messages = []
+
+def flush_publish_batch():
+    # type: () -> None
+    messages = getattr(publish_batch_state, 'messages', None)
+    publish_batch_state.messages = None
+    if messages:
+        get_queue_publisher().publish_many(messages)
+
 # We using a simple lock to prevent multiple RabbitMQ messages being
 # sent to the SimpleQueueClient at the same time; this is a workaround
 # for an issue with the pika BlockingConnection where using
@@ -307,6 +532,14 @@ queue_lock = threading.RLock()
 def queue_json_publish(queue_name, event, processor):
     # type: (str, Union[Mapping[str, Any], str], Callable[[Any], None]) -> None
     # most events are dicts, but zerver.middleware.write_log_line uses a str
+    if settings.USING_RABBITMQ:
+        event = stamp_enqueue_time(event)
+        messages = getattr(publish_batch_state, 'messages', None)
+        if messages is not None:
+            # Serialize now, in case the caller modifies the event.
+            messages.append((queue_name, ujson.dumps(event)))
+            return
+
     with queue_lock:
         if settings.USING_RABBITMQ:
             get_queue_client().json_publish(queue_name, event)
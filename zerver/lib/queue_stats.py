@@ -0,0 +1,154 @@
+from __future__ import absolute_import
+from __future__ import division
+
+from typing import Any, Dict, List, Mapping, Optional, Union
+
+from zerver.lib.redis_utils import get_redis_client
+from zerver.lib.utils import statsd
+
+import time
+
+# queue_json_publish stamps each (dict) event with the time it was
+# enqueued, under this key; the worker framework removes the stamp
+# before handing the event to the worker.
+ENQUEUED_AT_KEY = 'enqueued_at'
+
+# Upper bounds, in milliseconds, of the histogram buckets for the time
+# events spend in the queue and the time `consume` takes.
+HISTOGRAM_BUCKETS_MS = [1, 10, 100, 1000, 10000, 60000, 600000]
+
+# Workers accumulate their statistics locally and write them to redis
+# at most this often, so recording them doesn't add a round trip to
+# every event.
+FLUSH_INTERVAL_SECONDS = 10.0
+
+def queue_stats_redis_key(queue_name):
+    # type: (str) -> str
+    return "queue_stats:%s" % (queue_name,)
+
+def stamp_enqueue_time(event):
+    # type: (Union[Mapping[str, Any], str]) -> Union[Mapping[str, Any], str]
+    if not isinstance(event, dict):
+        # zerver.middleware.write_log_line publishes strings; we don't
+        # have anywhere to put a stamp on those.
+        return event
+    event = dict(event)
+    event[ENQUEUED_AT_KEY] = time.time()
+    return event
+
+def pop_enqueue_time(event):
+    # type: (Any) -> Optional[float]
+    if not isinstance(event, dict):
+        return None
+    return event.pop(ENQUEUED_AT_KEY, None)
+
+def histogram_bucket(prefix, value_ms):
+    # type: (str, float) -> str
+    for bound in HISTOGRAM_BUCKETS_MS:
+        if value_ms <= bound:
+            return "%s_le_%d" % (prefix, bound)
+    return "%s_le_inf" % (prefix,)
+
+def histogram_fields(prefix):
+    # type: (str) -> List[str]
+    return ["%s_le_%d" % (prefix, bound) for bound in HISTOGRAM_BUCKETS_MS] + \
+        ["%s_le_inf" % (prefix,)]
+
+class QueueStats(object):
+    """Throughput and latency statistics for one queue worker.
+
+    `latency` is the time from queue_json_publish to the worker
+    starting on the event; `consume` is how long each call to the
+    worker's consume (or consume_batch) took.  Both are sent to statsd
+    as they happen, and accumulated in a redis hash per queue (shared
+    by all of the queue's workers) for `./manage.py queue_stats`."""
+
+    def __init__(self, queue_name):
+        # type: (str) -> None
+        self.queue_name = queue_name
+        self.statsd_prefix = "queue_worker.%s" % (queue_name,)
+        self.pending = {} # type: Dict[str, float]
+        self.started = time.time()
+        self.last_flush = self.started
+
+    def add(self, field, value=1):
+        # type: (str, float) -> None
+        self.pending[field] = self.pending.get(field, 0) + value
+
+    def record_latency(self, events, start):
+        # type: (List[Any], float) -> None
+        """Removes the enqueue stamps from `events`, which the worker
+        started on at time `start`, and records their latency."""
+        max_latency_ms = None # type: Optional[float]
+        for event in events:
+            enqueued_at = pop_enqueue_time(event)
+            if enqueued_at is None:
+                continue
+            latency_ms = max(0, start - enqueued_at) * 1000
+            self.add(histogram_bucket('latency', latency_ms))
+            self.add('latency_count')
+            self.add('latency_sum_ms', latency_ms)
+            if max_latency_ms is None or latency_ms > max_latency_ms:
+                max_latency_ms = latency_ms
+        if max_latency_ms is not None:
+            # For a batch, we report its oldest event.
+            statsd.timing("%s.latency" % (self.statsd_prefix,), max_latency_ms)
+
+    def record_consume(self, num_events, start, end, failed=False):
+        # type: (int, float, float, bool) -> None
+        """Records one call to consume (for num_events=1) or
+        consume_batch, which started and ended at the given times."""
+        self.add('events', num_events)
+        statsd.incr("%s.events" % (self.statsd_prefix,), num_events)
+        if failed:
+            self.add('errors', num_events)
+            statsd.incr("%s.errors" % (self.statsd_prefix,), num_events)
+
+        consume_ms = (end - start) * 1000
+        self.add(histogram_bucket('consume', consume_ms))
+        self.add('consume_count')
+        self.add('consume_sum_ms', consume_ms)
+        statsd.timing("%s.consume_time" % (self.statsd_prefix,), consume_ms)
+
+        if end - self.last_flush >= FLUSH_INTERVAL_SECONDS:
+            self.flush()
+
+    def flush(self):
+        # type: () -> None
+        self.last_flush = time.time()
+        if not self.pending:
+            return
+        key = queue_stats_redis_key(self.queue_name)
+        pipeline = get_redis_client().pipeline()
+        for field, value in self.pending.items():
+            if field.endswith('_ms'):
+                pipeline.hincrbyfloat(key, field, value)
+            else:
+                pipeline.hincrby(key, field, int(value))
+        pipeline.hsetnx(key, 'since', self.started)
+        pipeline.execute()
+        self.pending = {}
+
+def get_queue_stats(queue_name):
+    # type: (str) -> Dict[str, float]
+    stats = get_redis_client().hgetall(queue_stats_redis_key(queue_name))
+    return dict((field.decode('utf-8'), float(value)) for field, value in stats.items())
+
+def clear_queue_stats(queue_name):
+    # type: (str) -> None
+    get_redis_client().delete(queue_stats_redis_key(queue_name))
+
+def histogram_percentile(stats, prefix, percentile):
+    # type: (Mapping[str, float], str, float) -> Optional[float]
+    """An upper bound (a bucket boundary, in milliseconds) on the given
+    percentile; None if there's no data, and infinity if it's past the
+    largest bucket."""
+    total = stats.get('%s_count' % (prefix,), 0)
+    if total == 0:
+        return None
+    seen = 0.0
+    for bound, field in zip(HISTOGRAM_BUCKETS_MS + [float('inf')], histogram_fields(prefix)):
+        seen += stats.get(field, 0)
+        if seen >= total * percentile / 100:
+            return bound
+    return float('inf')
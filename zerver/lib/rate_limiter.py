@@ -1,22 +1,120 @@
 from __future__ import absolute_import
 
-from typing import Any, Iterator, Tuple, Text
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Text
 
 from django.conf import settings
 from zerver.lib.redis_utils import get_redis_client
-from six.moves import zip
 
 from zerver.models import UserProfile
 
-import redis
 import time
-import logging
 
 # Implement a rate-limiting scheme inspired by the one described here, but heavily modified
 # http://blog.domaintools.com/2013/04/rate-limiting-with-redis/
 
 client = get_redis_client()
 rules = settings.RATE_LIMITING_RULES # type: List[Tuple[int, int]]
+
+# Checks a request against all of the user's rules and, unless it's
+# over one of them, records it, atomically and in a single round trip.
+#
+# KEYS are the user's list and blocking keys.  ARGV is the time now, the
+# number of earlier requests to record (served from a local bucket;
+# see below) followed by their timestamps, oldest first, and then the
+# rules, as (range_seconds, num_requests) pairs.
+#
+# The list holds the timestamps of the user's last max_api_calls
+# requests, newest first.  Returns {1, seconds until free} if the user
+# is over a limit, and otherwise {0, seconds until the longest rule's
+# window resets, calls left under the longest rule, the fewest calls
+# left under any rule}.  Floats are returned as strings, since redis
+# would truncate them to integers.
+RATE_LIMIT_SCRIPT = """
+local list_key, blocking_key = KEYS[1], KEYS[2]
+local now = tonumber(ARGV[1])
+local num_earlier = tonumber(ARGV[2])
+
+local rules = {}
+local max_calls, max_window = 0, 0
+for i = 3 + num_earlier, #ARGV, 2 do
+    local range_seconds, num_requests = tonumber(ARGV[i]), tonumber(ARGV[i + 1])
+    rules[#rules + 1] = {range_seconds, num_requests}
+    max_calls = math.max(max_calls, num_requests)
+    max_window = math.max(max_window, range_seconds)
+end
+
+local timestamps = {}
+for i = 3, 2 + num_earlier do
+    timestamps[#timestamps + 1] = ARGV[i]
+end
+if #timestamps > 0 then
+    redis.call('lpush', list_key, unpack(timestamps))
+    redis.call('ltrim', list_key, 0, max_calls - 1)
+    redis.call('expire', list_key, max_window)
+end
+
+local calls = redis.call('lrange', list_key, 0, max_calls - 1)
+local blocking_ttl = redis.call('ttl', blocking_key)
+if blocking_ttl ~= -2 then
+    -- We are manually blocked; -1 means the block has no expiry.
+    if blocking_ttl < 0 then
+        blocking_ttl = 0.5
+    end
+    return {1, tostring(blocking_ttl)}
+end
+for _, rule in ipairs(rules) do
+    -- If the nth newest call is within the rule's range, this
+    -- call would exceed it.
+    local nth_call = calls[rule[2]]
+    if nth_call and tonumber(nth_call) + rule[1] > now then
+        return {1, tostring(tonumber(nth_call) + rule[1] - now)}
+    end
+end
+
+redis.call('lpush', list_key, ARGV[1])
+redis.call('ltrim', list_key, 0, max_calls - 1)
+redis.call('expire', list_key, max_window)
+table.insert(calls, 1, ARGV[1])
+
+local calls_left, min_calls_left = 0, max_calls
+for _, rule in ipairs(rules) do
+    local count = 0
+    for i = 1, math.min(#calls, rule[2]) do
+        if tonumber(calls[i]) > now - rule[1] then
+            count = count + 1
+        end
+    end
+    calls_left = rule[2] - count
+    min_calls_left = math.min(min_calls_left, calls_left)
+end
+return {0, tostring(rules[#rules][1]), calls_left, min_calls_left}
+"""
+rate_limit_script = client.register_script(RATE_LIMIT_SCRIPT)
+
+# With settings.RATE_LIMITING_LOCAL_BUCKET, a user who is far under
+# their limits can be served from a token bucket in this process, rather
+# than with a round trip to redis.  When the script reports that the
+# user has at least LOCAL_BUCKET_SHARE times as many calls left (under
+# every rule) as we'd take, we take up to LOCAL_BUCKET_MAX_TOKENS of them,
+# for LOCAL_BUCKET_SECONDS.  The requests served from the bucket are
+# recorded in redis with the user's next request which isn't.
+LOCAL_BUCKET_SHARE = 10
+LOCAL_BUCKET_MAX_TOKENS = 10
+LOCAL_BUCKET_SECONDS = 1.0
+# We drop expired buckets when there are more than this many.
+MAX_LOCAL_BUCKETS = 10000
+
+class LocalBucket(object):
+    def __init__(self, tokens, expires, calls_left, reset_time):
+        # type: (int, float, int, float) -> None
+        self.tokens = tokens
+        self.expires = expires
+        self.calls_left = calls_left
+        self.reset_time = reset_time
+        self.served = [] # type: List[float]
+
+local_buckets = {} # type: Dict[Text, LocalBucket]
+
 def _rules_for_user(user):
     # type: (UserProfile) -> List[Tuple[int, int]]
     if user.rate_limits != "":
@@ -58,7 +156,8 @@ def remove_ratelimit_rule(range_seconds, num_requests):
 def block_user(user, seconds, domain='all'):
     # type: (UserProfile, int, Text) -> None
     "Manually blocks a user id for the desired number of seconds"
-    _, _, blocking_key = redis_key(user, domain)
+    list_key, _, blocking_key = redis_key(user, domain)
+    local_buckets.pop(list_key, None)
     with client.pipeline() as pipe:
         pipe.set(blocking_key, 1)
         pipe.expire(blocking_key, seconds)
@@ -77,150 +176,52 @@ def clear_user_history(user, domain='all'):
     '''
     for key in redis_key(user, domain):
         client.delete(key)
+    local_buckets.clear()
+
+def run_rate_limit_script(user, domain, now, earlier_calls=None):
+    # type: (UserProfile, Text, float, Optional[List[float]]) -> List[Any]
+    if earlier_calls is None:
+        earlier_calls = []
+    list_key, _, blocking_key = redis_key(user, domain)
+    args = ['%.6f' % (now,), len(earlier_calls)] # type: List[Any]
+    args.extend('%.6f' % (timestamp,) for timestamp in earlier_calls)
+    for range_seconds, num_requests in _rules_for_user(user):
+        args.extend([range_seconds, num_requests])
+    return rate_limit_script(keys=[list_key, blocking_key], args=args)
+
+def rate_limit_request(user, domain='all'):
+    # type: (UserProfile, Text) -> Tuple[bool, float, int]
+    """Checks whether this request puts the user over any of their
+    limits, and if not, records it.  Returns a tuple of (rate_limited,
+    seconds until free if rate limited or else until the longest limit
+    resets, API calls left under the longest limit)."""
+    if len(_rules_for_user(user)) == 0:
+        return False, 0.0, 0
 
-def _get_api_calls_left(user, domain, range_seconds, max_calls):
-    # type: (UserProfile, Text, int, int) -> Tuple[int, float]
-    list_key, set_key, _ = redis_key(user, domain)
-    # Count the number of values in our sorted set
-    # that are between now and the cutoff
     now = time.time()
-    boundary = now - range_seconds
-
-    with client.pipeline() as pipe:
-        # Count how many API calls in our range have already been made
-        pipe.zcount(set_key, boundary, now)
-        # Get the newest call so we can calculate when the ratelimit
-        # will reset to 0
-        pipe.lindex(list_key, 0)
-
-        results = pipe.execute()
-
-    count = results[0]
-    newest_call = results[1]
-
-    calls_left = max_calls - count
-    if newest_call is not None:
-        time_reset = now + (range_seconds - (now - float(newest_call)))
-    else:
-        time_reset = now
-
-    return calls_left, time_reset
-
-def api_calls_left(user, domain='all'):
-    # type: (UserProfile, Text) -> Tuple[int, float]
-    """Returns how many API calls in this range this client has, as well as when
-       the rate-limit will be reset to 0"""
-    max_window = _rules_for_user(user)[-1][0]
-    max_calls = _rules_for_user(user)[-1][1]
-    return _get_api_calls_left(user, domain, max_window, max_calls)
-
-def is_ratelimited(user, domain='all'):
-    # type: (UserProfile, Text) -> Tuple[bool, float]
-    "Returns a tuple of (rate_limited, time_till_free)"
-    list_key, set_key, blocking_key = redis_key(user, domain)
-
-    rules = _rules_for_user(user)
-
-    if len(rules) == 0:
-        return False, 0.0
-
-    # Go through the rules from shortest to longest,
-    # seeing if this user has violated any of them. First
-    # get the timestamps for each nth items
-    with client.pipeline() as pipe:
-        for _, request_count in rules:
-            pipe.lindex(list_key, request_count - 1) # 0-indexed list
-
-        # Get blocking info
-        pipe.get(blocking_key)
-        pipe.ttl(blocking_key)
-
-        rule_timestamps = pipe.execute()
-
-    # Check if there is a manual block on this API key
-    blocking_ttl = rule_timestamps.pop()
-    key_blocked = rule_timestamps.pop()
-
-    if key_blocked is not None:
-        # We are manually blocked. Report for how much longer we will be
-        if blocking_ttl is None:
-            blocking_ttl = 0.5
-        else:
-            blocking_ttl = int(blocking_ttl)
-        return True, blocking_ttl
-
-    now = time.time()
-    for timestamp, (range_seconds, num_requests) in zip(rule_timestamps, rules):
-        # Check if the nth timestamp is newer than the associated rule. If so,
-        # it means we've hit our limit for this rule
-        if timestamp is None:
-            continue
-
-        timestamp = float(timestamp)
-        boundary = timestamp + range_seconds
-        if boundary > now:
-            free = boundary - now
-            return True, free
-
-    # No api calls recorded yet
-    return False, 0.0
-
-def incr_ratelimit(user, domain='all'):
-    # type: (UserProfile, Text) -> None
-    """Increases the rate-limit for the specified user"""
-    list_key, set_key, _ = redis_key(user, domain)
-    now = time.time()
-
-    # If we have no rules, we don't store anything
-    if len(rules) == 0:
-        return
-
-    # Start redis transaction
-    with client.pipeline() as pipe:
-        count = 0
-        while True:
-            try:
-                # To avoid a race condition between getting the element we might trim from our list
-                # and removing it from our associated set, we abort this whole transaction if
-                # another agent manages to change our list out from under us
-                # When watching a value, the pipeline is set to Immediate mode
-                pipe.watch(list_key)
-
-                # Get the last elem that we'll trim (so we can remove it from our sorted set)
-                last_val = pipe.lindex(list_key, max_api_calls(user) - 1)
-
-                # Restart buffered execution
-                pipe.multi()
-
-                # Add this timestamp to our list
-                pipe.lpush(list_key, now)
-
-                # Trim our list to the oldest rule we have
-                pipe.ltrim(list_key, 0, max_api_calls(user) - 1)
-
-                # Add our new value to the sorted set that we keep
-                # We need to put the score and val both as timestamp,
-                # as we sort by score but remove by value
-                pipe.zadd(set_key, now, now)
-
-                # Remove the trimmed value from our sorted set, if there was one
-                if last_val is not None:
-                    pipe.zrem(set_key, last_val)
-
-                # Set the TTL for our keys as well
-                api_window = max_api_window(user)
-                pipe.expire(list_key, api_window)
-                pipe.expire(set_key, api_window)
-
-                pipe.execute()
-
-                # If no exception was raised in the execution, there were no transaction conflicts
-                break
-            except redis.WatchError:
-                if count > 10:
-                    logging.error("Failed to complete incr_ratelimit transaction without interference 10 times "
-                                  "in a row! Aborting rate-limit increment")
-                    break
-                count += 1
-
-                continue
+    list_key = redis_key(user, domain)[0]
+    earlier_calls = [] # type: List[float]
+    bucket = local_buckets.pop(list_key, None)
+    if bucket is not None:
+        if bucket.tokens > 0 and now < bucket.expires:
+            bucket.tokens -= 1
+            bucket.served.append(now)
+            local_buckets[list_key] = bucket
+            return False, bucket.reset_time - now, bucket.calls_left - len(bucket.served)
+        earlier_calls = bucket.served
+
+    result = run_rate_limit_script(user, domain, now, earlier_calls)
+    if result[0]:
+        return True, float(result[1]), 0
+
+    secs_to_reset, calls_left, min_calls_left = float(result[1]), int(result[2]), int(result[3])
+    if settings.RATE_LIMITING_LOCAL_BUCKET:
+        tokens = min(min_calls_left // LOCAL_BUCKET_SHARE, LOCAL_BUCKET_MAX_TOKENS)
+        if tokens > 0:
+            if len(local_buckets) >= MAX_LOCAL_BUCKETS:
+                for key, expired in list(local_buckets.items()):
+                    if expired.expires <= now:
+                        del local_buckets[key]
+            local_buckets[list_key] = LocalBucket(tokens, now + LOCAL_BUCKET_SECONDS,
+                                                  calls_left, now + secs_to_reset)
+    return False, secs_to_reset, calls_left
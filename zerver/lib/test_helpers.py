@@ -89,12 +89,15 @@ def simulated_queue_client(client):
 def tornado_redirected_to_list(lst):
     # type: (List[Mapping[str, Any]]) -> Iterator[None]
     real_event_queue_process_notification = event_queue.process_notification
-    event_queue.process_notification = lambda notice: lst.append(notice)
-    # process_notification takes a single parameter called 'notice'.
-    # lst.append takes a single argument called 'object'.
-    # Some code might call process_notification using keyword arguments,
-    # so mypy doesn't allow assigning lst.append to process_notification
-    # So explicitly change parameter name to 'notice' to work around this problem
+    def append_notice(notice):
+        # type: (Mapping[str, Any]) -> None
+        # Batches sent via send_events are recorded as their
+        # individual notices.
+        if 'notices' in notice:
+            lst.extend(notice['notices'])
+        else:
+            lst.append(notice)
+    event_queue.process_notification = append_notice
     yield
     event_queue.process_notification = real_event_queue_process_notification
 
@@ -256,17 +259,6 @@ class HostRequestMock(object):
         # type: () -> Text
         return self.host
 
-class MockPythonResponse(object):
-    def __init__(self, text, status_code):
-        # type: (Text, int) -> None
-        self.text = text
-        self.status_code = status_code
-
-    @property
-    def ok(self):
-        # type: () -> bool
-        return self.status_code == 200
-
 INSTRUMENTING = os.environ.get('TEST_INSTRUMENT_URL_COVERAGE', '') == 'TRUE'
 INSTRUMENTED_CALLS = [] # type: List[Dict[str, Any]]
 
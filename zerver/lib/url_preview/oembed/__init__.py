@@ -1,13 +1,39 @@
 from __future__ import absolute_import
 from typing import Optional, Any, Text
-from pyoembed import oEmbed, PyOembedException
+from bs4 import BeautifulSoup
+from six.moves.urllib.parse import parse_qsl, urlencode, urljoin, urlparse, urlunparse
+import ujson
 
 
-def get_oembed_data(url, maxwidth=640, maxheight=480):
-    # type: (Text, Optional[int], Optional[int]) -> Any
+def get_oembed_endpoint(soup, url, maxwidth=640, maxheight=480):
+    # type: (BeautifulSoup, Text, Optional[int], Optional[int]) -> Optional[Text]
+    """Returns the JSON oEmbed endpoint which the page at `url`
+    advertises (oEmbed discovery), with our size limits added, or None
+    if it doesn't advertise one."""
+    link = soup.find('link', rel='alternate', type='application/json+oembed', href=True)
+    if link is None:
+        return None
+
+    parts = urlparse(urljoin(url, link['href']))
+    if parts.scheme not in ('http', 'https'):
+        return None
+    params = parse_qsl(parts.query)
+    names = set(name for (name, value) in params)
+    for (name, value) in [('maxwidth', maxwidth), ('maxheight', maxheight)]:
+        if value is not None and name not in names:
+            params.append((name, str(value)))
+    return urlunparse(parts._replace(query=urlencode(params)))
+
+
+def get_oembed_data(response_text):
+    # type: (Text) -> Any
+    """Parses an oEmbed endpoint's JSON response; returns None if it
+    isn't a valid one."""
     try:
-        data = oEmbed(url, maxwidth=maxwidth, maxheight=maxheight)
-    except PyOembedException:
+        data = ujson.loads(response_text)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or 'type' not in data:
         return None
 
     data['image'] = data.get('thumbnail_url')
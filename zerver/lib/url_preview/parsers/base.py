@@ -1,12 +1,16 @@
 from __future__ import absolute_import
-from typing import Any, Text
+from typing import Any, Text, Union
 from bs4 import BeautifulSoup
 
 
 class BaseParser(object):
     def __init__(self, html_source):
-        # type: (Text) -> None
-        self._soup = BeautifulSoup(html_source, "lxml")
+        # type: (Union[Text, BeautifulSoup]) -> None
+        # Several parsers can share one parse of a page.
+        if isinstance(html_source, BeautifulSoup):
+            self._soup = html_source
+        else:
+            self._soup = BeautifulSoup(html_source, "lxml")
 
     def extract_data(self):
         # type: () -> Any
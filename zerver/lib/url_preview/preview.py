@@ -1,12 +1,17 @@
 from __future__ import absolute_import
 import re
 import logging
+import time
 import traceback
-from typing import Any, Optional, Text
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from typing import Any, Dict, List, Optional, Text, Tuple
 from typing.re import Match
 import requests
-from zerver.lib.cache import cache_with_key, get_cache_with_key
-from zerver.lib.url_preview.oembed import get_oembed_data
+from bs4 import BeautifulSoup
+from zerver.lib.cache import cache_get_many, cache_set, get_cache_with_key
+from zerver.lib.utils import statsd
+from zerver.lib.url_preview.oembed import get_oembed_data, get_oembed_endpoint
 from zerver.lib.url_preview.parsers import OpenGraphParser, GenericParser
 
 
@@ -19,6 +24,20 @@ link_regex = re.compile(
     r'(?::\d+)?'  # optional port
     r'(?:/?|[/?]\S+)$', re.IGNORECASE)
 
+# Previews are fetched concurrently by this many threads, sharing a
+# pool of keep-alive connections to each host.
+FETCH_THREADS = 8
+# The timeout for connecting and for each read from the site.
+FETCH_TIMEOUT_SECONDS = 5
+# We give up on previewing a URL after this long...
+FETCH_DEADLINE_SECONDS = 15
+# ...and read at most this much of a page; the metadata we need is
+# at the start of it.
+MAX_PAGE_BYTES = 1024 * 1024
+# When we can't fetch a URL, we remember that for this long, rather
+# than retrying it for every message which links to it.
+FAILURE_CACHE_TIMEOUT = 60 * 60
+
 
 def is_link(url):
     # type: (Text) -> Match[Text]
@@ -30,33 +49,162 @@ def cache_key_func(url):
     return url
 
 
-@cache_with_key(cache_key_func, cache_name=CACHE_NAME, with_statsd_key="urlpreview_data")
-def get_link_embed_data(url, maxwidth=640, maxheight=480):
-    # type: (Text, Optional[int], Optional[int]) -> Any
-    if not is_link(url):
+class PreviewFetchFailed(Exception):
+    pass
+
+fetch_pool = None # type: Optional[ThreadPool]
+def get_fetch_pool():
+    # type: () -> ThreadPool
+    global fetch_pool
+    if fetch_pool is None:
+        fetch_pool = ThreadPool(FETCH_THREADS)
+    return fetch_pool
+
+session = None # type: Optional[requests.Session]
+def get_session():
+    # type: () -> requests.Session
+    global session
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=100, pool_maxsize=FETCH_THREADS)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    return session
+
+
+def read_response(response, url, deadline):
+    # type: (requests.Response, Text, float) -> bytes
+    """Reads at most MAX_PAGE_BYTES of a streamed response, giving up
+    if we pass the deadline."""
+    chunks = [] # type: List[bytes]
+    size = 0
+    for chunk in response.iter_content(chunk_size=16 * 1024):
+        if time.time() > deadline:
+            raise PreviewFetchFailed("Timed out reading %s" % (url,))
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= MAX_PAGE_BYTES:
+            break
+    return b''.join(chunks)[:MAX_PAGE_BYTES]
+
+
+def fetch_page(url, deadline):
+    # type: (Text, float) -> Optional[BeautifulSoup]
+    """Returns the parsed page, or None if it isn't an HTML page we
+    can preview."""
+    response = get_session().get(url, stream=True, timeout=FETCH_TIMEOUT_SECONDS)
+    try:
+        if not response.ok:
+            return None
+        content_type = response.headers.get('content-type', 'text/html')
+        if 'html' not in content_type:
+            return None
+        content = read_response(response, url, deadline)
+    finally:
+        response.close()
+    return BeautifulSoup(content, "lxml")
+
+
+def fetch_oembed_data(endpoint, deadline):
+    # type: (Text, float) -> Any
+    """Returns the data from a page's oEmbed endpoint, or None.  Since
+    the page itself has been fetched, a broken endpoint just means the
+    preview doesn't use oEmbed."""
+    try:
+        response = get_session().get(endpoint, stream=True, timeout=FETCH_TIMEOUT_SECONDS)
+        try:
+            if not response.ok:
+                return None
+            content = read_response(response, endpoint, deadline)
+        finally:
+            response.close()
+    except requests.exceptions.RequestException:
+        logging.warning("Unable to fetch oEmbed data from %s" % (endpoint,))
         return None
+    return get_oembed_data(content.decode('utf-8', 'replace'))
+
+
+def fetch_link_embed_data(url, maxwidth, maxheight, deadline):
+    # type: (Text, Optional[int], Optional[int], float) -> Tuple[bool, Any]
+    """Runs in the fetch pool; returns (whether we could fetch the URL,
+    the preview data).  This mustn't touch the database (including the
+    database cache), since it's not in a request or worker thread."""
     # Fetch information from URL.
     # We are using three sources in next order:
     # 1. OEmbed
     # 2. Open Graph
     # 3. Meta tags
+    # Every request goes through our session, with its timeouts and
+    # size limit; the page itself is fetched once, and also used to
+    # discover its oEmbed endpoint.
+    data = {} # type: Dict[str, Any]
     try:
-        data = get_oembed_data(url, maxwidth=maxwidth, maxheight=maxheight)
+        soup = fetch_page(url, deadline)
+        if soup is not None:
+            endpoint = get_oembed_endpoint(soup, url, maxwidth=maxwidth, maxheight=maxheight)
+            if endpoint is not None:
+                data = fetch_oembed_data(endpoint, deadline) or {}
+    except PreviewFetchFailed:
+        # We ran past the deadline, so the caller has already given up
+        # on this URL (and logged that).
+        return (False, None)
     except requests.exceptions.RequestException:
         msg = 'Unable to fetch information from url {0}, traceback: {1}'
         logging.error(msg.format(url, traceback.format_exc()))
-        return None
-    data = data or {}
-    response = requests.get(url)
-    if response.ok:
-        og_data = OpenGraphParser(response.text).extract_data()
+        return (False, None)
+
+    if soup is not None:
+        # The page is fetched and parsed only once, for all the parsers.
+        og_data = OpenGraphParser(soup).extract_data()
         if og_data:
             data.update(og_data)
-        generic_data = GenericParser(response.text).extract_data() or {}
+        generic_data = GenericParser(soup).extract_data() or {}
         for key in ['title', 'description', 'image']:
             if not data.get(key) and generic_data.get(key):
                 data[key] = generic_data[key]
-    return data
+    return (True, data)
+
+
+def get_link_embed_data_for_urls(urls, maxwidth=640, maxheight=480):
+    # type: (List[Text], Optional[int], Optional[int]) -> Dict[Text, Any]
+    """Returns the preview data for each of the URLs, fetching those
+    which aren't cached concurrently, and caching the results."""
+    cached = cache_get_many([cache_key_func(url) for url in urls], cache_name=CACHE_NAME)
+    results = {} # type: Dict[Text, Any]
+    deadline = time.time() + FETCH_DEADLINE_SECONDS
+    pending = [] # type: List[Tuple[Text, Any]]
+    for url in set(urls):
+        key = cache_key_func(url)
+        if key in cached:
+            statsd.incr("cache.dbcache.urlpreview_data.hit")
+            results[url] = cached[key][0]
+            continue
+        statsd.incr("cache.dbcache.urlpreview_data.miss")
+        if not is_link(url):
+            results[url] = None
+            cache_set(key, None, cache_name=CACHE_NAME)
+            continue
+        pending.append((url, get_fetch_pool().apply_async(
+            fetch_link_embed_data, (url, maxwidth, maxheight, deadline))))
+
+    for (url, fetch) in pending:
+        try:
+            (fetched, data) = fetch.get(timeout=max(0, deadline - time.time()))
+        except TimeoutError:
+            logging.warning("Timed out fetching information from url %s" % (url,))
+            (fetched, data) = (False, None)
+        results[url] = data
+        if fetched:
+            cache_set(cache_key_func(url), data, cache_name=CACHE_NAME)
+        else:
+            cache_set(cache_key_func(url), None, cache_name=CACHE_NAME,
+                      timeout=FAILURE_CACHE_TIMEOUT)
+    return results
+
+
+def get_link_embed_data(url, maxwidth=640, maxheight=480):
+    # type: (Text, Optional[int], Optional[int]) -> Any
+    return get_link_embed_data_for_urls([url], maxwidth=maxwidth, maxheight=maxheight)[url]
 
 
 @get_cache_with_key(cache_key_func, cache_name=CACHE_NAME)
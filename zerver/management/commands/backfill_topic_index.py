@@ -0,0 +1,43 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.actions import rebuild_topic_index
+from zerver.models import Recipient, Stream, get_realm
+
+class Command(BaseCommand):
+    help = """Rebuild the topic index (used for stream topic history) from the message table.
+
+By default, rebuilds the index for every stream on the server."""
+
+    def add_arguments(self, parser):
+        # type: (CommandParser) -> None
+        parser.add_argument('-r', '--realm',
+                            dest='string_id',
+                            type=str,
+                            help='Only rebuild the index for streams in this realm.')
+
+        parser.add_argument('-s', '--stream',
+                            dest='stream',
+                            type=str,
+                            help='Only rebuild the index for this stream (requires --realm).')
+
+    def handle(self, **options):
+        # type: (**str) -> None
+        if options["stream"] is not None and options["string_id"] is None:
+            self.print_help("./manage.py", "backfill_topic_index")
+            exit(1)
+
+        streams = Stream.objects.all()
+        if options["string_id"] is not None:
+            streams = streams.filter(realm=get_realm(options["string_id"]))
+        if options["stream"] is not None:
+            streams = streams.filter(name__iexact=options["stream"])
+
+        for stream in streams.order_by('id'):
+            recipient = Recipient.objects.get(type=Recipient.STREAM, type_id=stream.id)
+            num_topics = rebuild_topic_index(recipient)
+            print("%s / %s: %d topics" % (stream.realm.string_id, stream.name, num_topics))
@@ -0,0 +1,70 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from zerver.lib.cache_stats import clear_cache_stats, estimated_bytes, get_cache_stats
+
+import time
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('--sort', dest='sort', type=str, default='time',
+                            choices=['time', 'misses', 'read'],
+                            help="sort the key families by time spent, misses or bytes read "
+                                 "(default: time)")
+        parser.add_argument('--reset', dest='reset', action='store_true', default=False,
+                            help="clear the accumulated statistics after printing them")
+
+    help = """Shows the remote cache requests made by every process, by key family.
+
+For each family (the part of the key before the first ':'), shows the
+gets and the fraction of them which hit, the hits from the in-process
+cache (which don't reach memcached), the sets, the total and mean time
+spent in gets and sets in milliseconds, and an estimate (from a sample
+of the values) of the bytes read and written and the mean value size.
+The statistics are accumulated since they were last reset; processes
+send theirs every 10 seconds."""
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        (stats, since) = get_cache_stats()
+        if since is not None:
+            print("Since %s (%.0fs ago)" % (time.ctime(since), time.time() - since))
+
+        def time_ms(family_stats):
+            # type: (Any) -> float
+            return family_stats.get('get_ms', 0) + family_stats.get('set_ms', 0)
+
+        sort_keys = {
+            'time': time_ms,
+            'misses': lambda family_stats: family_stats.get('misses', 0),
+            'read': lambda family_stats: estimated_bytes(family_stats, 'read'),
+        }
+        families = sorted(stats.items(), key=lambda item: -sort_keys[options['sort']](item[1]))
+
+        print("%-32s %10s %6s %10s %10s %10s %8s %10s %10s %10s" % (
+            'family', 'gets', 'hit %', 'local', 'sets', 'time (ms)', 'ms/req',
+            'read (KB)', 'write (KB)', 'value (B)'))
+        for family, family_stats in families:
+            hits = family_stats.get('hits', 0)
+            gets = hits + family_stats.get('misses', 0)
+            sets = family_stats.get('sets', 0)
+            read_bytes = estimated_bytes(family_stats, 'read')
+            write_bytes = estimated_bytes(family_stats, 'write')
+            sampled = family_stats.get('read_sampled', 0) + family_stats.get('write_sampled', 0)
+            sampled_bytes = family_stats.get('read_bytes_sampled', 0) + \
+                family_stats.get('write_bytes_sampled', 0)
+            print("%-32s %10d %6s %10d %10d %10.0f %8.2f %10.0f %10.0f %10s" % (
+                family, gets, '%.1f' % (100 * hits / gets,) if gets else '-',
+                family_stats.get('local_hits', 0), sets, time_ms(family_stats),
+                time_ms(family_stats) / (gets + sets) if gets + sets else 0,
+                read_bytes / 1024, write_bytes / 1024,
+                '%.0f' % (sampled_bytes / sampled,) if sampled else '-'))
+
+        if options['reset']:
+            clear_cache_stats()
@@ -3,11 +3,13 @@ import datetime
 import pytz
 import logging
 
-from typing import Any
+from typing import Any, List
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db.models import Max
 
+from zerver.lib.digest import DIGEST_CHUNK_SIZE
 from zerver.lib.queue import queue_json_publish
 from zerver.models import UserActivity, UserProfile, Realm
 
@@ -26,19 +28,16 @@ logger.addHandler(file_handler)
 
 
 VALID_DIGEST_DAYS = (1, 2, 3, 4)
-def inactive_since(user_profile, cutoff):
-    # type: (UserProfile, datetime.datetime) -> bool
-    # Hasn't used the app in the last 24 business-day hours.
-    most_recent_visit = [row.last_visit for row in
-                         UserActivity.objects.filter(
-                             user_profile=user_profile)]
+def inactive_users(user_profiles, cutoff):
+    # type: (List[UserProfile], datetime.datetime) -> List[UserProfile]
+    # Those who haven't used the app in the last 24 business-day hours.
+    last_visits = dict(UserActivity.objects.filter(
+        user_profile__in=user_profiles).values_list('user_profile_id').annotate(
+            Max('last_visit')))
 
-    if not most_recent_visit:
-        # This person has never used the app.
-        return True
-
-    last_visit = max(most_recent_visit)
-    return last_visit < cutoff
+    # Users who have never used the app have no UserActivity rows.
+    return [user_profile for user_profile in user_profiles
+            if user_profile.id not in last_visits or last_visits[user_profile.id] < cutoff]
 
 def last_business_day():
     # type: () -> datetime.datetime
@@ -50,12 +49,19 @@ def last_business_day():
 
 # Changes to this should also be reflected in
 # zerver/worker/queue_processors.py:DigestWorker.consume()
-def queue_digest_recipient(user_profile, cutoff):
-    # type: (UserProfile, datetime.datetime) -> None
-    # Convert cutoff to epoch seconds for transit.
-    event = {"user_profile_id": user_profile.id,
-             "cutoff": cutoff.strftime('%s')}
-    queue_json_publish("digest_emails", event, lambda event: None)
+def queue_digest_recipients(user_profiles, cutoff):
+    # type: (List[UserProfile], datetime.datetime) -> None
+    # We queue a realm's users in chunks, rather than one at a time, so
+    # the worker only gathers the realm's traffic once per chunk; but
+    # not all together, so that a failure only affects its own chunk
+    # (and replaying it doesn't re-send the rest of the realm's
+    # digests), and several workers can share a large realm.
+    user_profile_ids = [user_profile.id for user_profile in user_profiles]
+    for i in range(0, len(user_profile_ids), DIGEST_CHUNK_SIZE):
+        # Convert cutoff to epoch seconds for transit.
+        event = {"user_profile_ids": user_profile_ids[i:i + DIGEST_CHUNK_SIZE],
+                 "cutoff": cutoff.strftime('%s')}
+        queue_json_publish("digest_emails", event, lambda event: None)
 
 def realms_for_this_deployment():
     # type: () -> List[str]
@@ -102,12 +108,13 @@ in a while.
             if not should_process_digest(realm.string_id, deployment_realms):
                 continue
 
-            user_profiles = UserProfile.objects.filter(
-                realm=realm, is_active=True, is_bot=False, enable_digest_emails=True)
+            user_profiles = list(UserProfile.objects.filter(
+                realm=realm, is_active=True, is_bot=False, enable_digest_emails=True))
 
-            for user_profile in user_profiles:
-                cutoff = last_business_day()
-                if inactive_since(user_profile, cutoff):
-                    queue_digest_recipient(user_profile, cutoff)
-                    logger.info("%s is inactive, queuing for potential digest" % (
-                        user_profile.email,))
+            cutoff = last_business_day()
+            recipients = inactive_users(user_profiles, cutoff)
+            for user_profile in recipients:
+                logger.info("%s is inactive, queuing for potential digest" % (
+                    user_profile.email,))
+            if recipients:
+                queue_digest_recipients(recipients, cutoff)
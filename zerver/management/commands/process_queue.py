@@ -9,6 +9,7 @@ from django.core.management import CommandError
 from django.conf import settings
 from django.utils import autoreload
 from zerver.worker.queue_processors import get_worker, get_active_worker_queues
+from zerver.worker.supervisor import QueueWorkerSupervisor
 import sys
 import signal
 import logging
@@ -23,6 +24,12 @@ class Command(BaseCommand):
                             help="worker label")
         parser.add_argument('--all', dest="all", action="store_true", default=False,
                             help="run all queues")
+        parser.add_argument('--supervise', dest="supervise", action="store_true", default=False,
+                            help="run a pool of worker processes for the queue given with "
+                                 "--queue_name (or for all queues), scaled to the queue depth")
+        parser.add_argument('--workers', metavar='<number of workers>', type=int, default=None,
+                            help="with --supervise, run this many workers per queue "
+                                 "(at most the queue's max_workers) instead of autoscaling")
 
     help = "Runs a queue processing worker"
 
@@ -50,7 +57,13 @@ class Command(BaseCommand):
                 td.start()
             logger.info('%d queue worker threads were launched' % (cnt,))
 
-        if options['all']:
+        if options['supervise']:
+            if options['queue_name'] is not None:
+                queue_names = [options['queue_name']]
+            else:
+                queue_names = get_active_worker_queues()
+            QueueWorkerSupervisor(queue_names, num_workers=options['workers']).run()
+        elif options['all']:
             autoreload.main(run_threaded_workers, (logger,))
         else:
             queue_name = options['queue_name']
@@ -63,8 +76,11 @@ class Command(BaseCommand):
             def signal_handler(signal, frame):
                 # type: (int, FrameType) -> None
                 logger.info("Worker %d disconnecting from queue %s" % (worker_num, queue_name))
-                worker.stop()
-                sys.exit(0)
+                worker.stop_gracefully()
+                # If we're in the middle of processing an event, we
+                # exit once it's done, when worker.start() returns.
+                if not worker.busy:
+                    sys.exit(0)
             signal.signal(signal.SIGTERM, signal_handler)
             signal.signal(signal.SIGINT, signal_handler)
 
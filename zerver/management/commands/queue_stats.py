@@ -0,0 +1,65 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any, Mapping, Optional
+
+from argparse import ArgumentParser
+from django.core.management.base import BaseCommand
+from zerver.lib.queue import SimpleQueueClient
+from zerver.lib.queue_stats import clear_queue_stats, get_queue_stats, histogram_percentile
+from zerver.worker.queue_processors import get_active_worker_queues
+
+import time
+
+def format_ms(value):
+    # type: (Optional[float]) -> str
+    if value is None:
+        return '-'
+    if value == float('inf'):
+        return 'inf'
+    return '%d' % (value,)
+
+def format_timing(stats, prefix):
+    # type: (Mapping[str, float], str) -> str
+    count = stats.get('%s_count' % (prefix,), 0)
+    mean = stats['%s_sum_ms' % (prefix,)] / count if count else None
+    return '%s/%s/%s' % (format_ms(mean),
+                         format_ms(histogram_percentile(stats, prefix, 50)),
+                         format_ms(histogram_percentile(stats, prefix, 99)))
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        # type: (ArgumentParser) -> None
+        parser.add_argument('queue_names', metavar='<queue name>', type=str, nargs='*',
+                            help="queues to report on (default: all of them)")
+        parser.add_argument('--reset', dest='reset', action='store_true', default=False,
+                            help="clear the accumulated statistics after printing them")
+
+    help = """Shows the depth and the worker throughput and latency of the queues.
+
+Latency is the time from an event being queued to a worker starting on
+it, and consume is how long the worker's consume (or consume_batch)
+takes; both are shown as mean/median/99th percentile in milliseconds,
+with the percentiles rounded up to a histogram bucket boundary.  The
+statistics are accumulated since they were last reset."""
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        queue_names = options['queue_names'] or sorted(get_active_worker_queues())
+        queue = SimpleQueueClient()
+        now = time.time()
+
+        print("%-36s %8s %10s %8s %9s %18s %18s" % (
+            'queue', 'depth', 'events', 'errors', 'events/s', 'latency (ms)', 'consume (ms)'))
+        for queue_name in queue_names:
+            stats = get_queue_stats(queue_name)
+            events = stats.get('events', 0)
+            since = stats.get('since')
+            rate = events / (now - since) if since is not None and now > since else 0
+            print("%-36s %8d %10d %8d %9.2f %18s %18s" % (
+                queue_name, queue.get_queue_depth(queue_name), events,
+                stats.get('errors', 0), rate,
+                format_timing(stats, 'latency'), format_timing(stats, 'consume')))
+            if options['reset']:
+                clear_queue_stats(queue_name)
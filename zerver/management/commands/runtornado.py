@@ -21,6 +21,7 @@ from zerver.lib.queue import setup_tornado_rabbitmq
 from zerver.tornado.application import create_tornado_application
 from zerver.tornado.event_queue import add_client_gc_hook, \
     missedmessage_hook, process_notification, setup_event_queue
+from zerver.tornado.rate_limiter import setup_tornado_rate_limiters
 from zerver.tornado.socket import respond_send_message
 
 import logging
@@ -107,6 +108,7 @@ class Command(BaseCommand):
                 http_server.listen(int(port), address=addr)
 
                 setup_event_queue()
+                setup_tornado_rate_limiters()
                 add_client_gc_hook(missedmessage_hook)
                 setup_tornado_rabbitmq()
 
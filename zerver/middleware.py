@@ -12,8 +12,10 @@ from zerver.lib.request import JsonableError
 from django.db import connection
 from django.http import HttpRequest, HttpResponse
 from zerver.lib.utils import statsd, get_subdomain
-from zerver.lib.queue import queue_json_publish
-from zerver.lib.cache import get_remote_cache_time, get_remote_cache_requests
+from zerver.lib.queue import queue_json_publish, start_publish_batch, flush_publish_batch
+from zerver.lib.cache import get_remote_cache_time, get_remote_cache_requests, \
+    start_per_request_generations
+from zerver.lib.cache_stats import format_request_cache_stats, start_request_cache_stats
 from zerver.lib.bugdown import get_bugdown_time, get_bugdown_requests
 from zerver.models import flush_per_request_caches, get_realm
 from zerver.exceptions import RateLimited
@@ -72,6 +74,7 @@ def record_request_start_data(log_data):
     log_data['time_started'] = time.time()
     log_data['remote_cache_time_start'] = get_remote_cache_time()
     log_data['remote_cache_requests_start'] = get_remote_cache_requests()
+    start_request_cache_stats()
     log_data['bugdown_time_start'] = get_bugdown_time()
     log_data['bugdown_requests_start'] = get_bugdown_requests()
 
@@ -194,6 +197,12 @@ def write_log_line(log_data, path, method, remote_ip, email, client_name,
         extra_request_data = " %s" % (log_data['extra'],)
     else:
         extra_request_data = ""
+    is_slow = is_slow_query(time_delta, path)
+    if is_slow:
+        # For slow requests, also show the key families they spent the
+        # most time on in the remote cache.
+        remote_cache_output += format_request_cache_stats()
+
     logger_client = "(%s via %s)" % (email, client_name)
     logger_timing = ('%5s%s%s%s%s%s %s' %
                      (format_timedelta(time_delta), optional_orig_delta,
@@ -207,7 +216,7 @@ def write_log_line(log_data, path, method, remote_ip, email, client_name,
     else:
         logger.info(logger_line)
 
-    if (is_slow_query(time_delta, path)):
+    if is_slow:
         queue_json_publish("slow_queries", "%s (%s)" % (logger_line, email), lambda e: None)
 
     if settings.PROFILE_ALL_REQUESTS:
@@ -339,7 +348,27 @@ class RateLimitMiddleware(object):
             resp['Retry-After'] = request._ratelimit_secs_to_freedom
             return resp
 
+class QueuePublishBatching(object):
+    # Buffer the queue events published while handling a request, and
+    # publish them together once the response is ready, before it's
+    # returned (see zerver/lib/queue.py).  Tornado publishes
+    # asynchronously already, so we leave it alone.
+    def process_request(self, request):
+        # type: (HttpRequest) -> None
+        if settings.USING_RABBITMQ and not settings.RUNNING_INSIDE_TORNADO:
+            start_publish_batch()
+
+    def process_response(self, request, response):
+        # type: (HttpRequest, HttpResponse) -> HttpResponse
+        flush_publish_batch()
+        return response
+
 class FlushDisplayRecipientCache(object):
+    def process_request(self, request):
+        # type: (HttpRequest) -> None
+        # Cache generations are looked up at most once per request.
+        start_per_request_generations()
+
     def process_response(self, request, response):
         # type: (HttpRequest, HttpResponse) -> HttpResponse
         # We flush the per-request caches after every request, so they
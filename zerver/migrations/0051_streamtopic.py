@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import zerver.lib.str_utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zerver', '0050_userprofile_avatar_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StreamTopic',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('recipient', models.ForeignKey(to='zerver.Recipient')),
+                ('topic_key', models.CharField(max_length=60)),
+                ('topic_name', models.CharField(max_length=60)),
+                ('max_message_id', models.IntegerField()),
+                ('message_count', models.IntegerField(default=0)),
+            ],
+            bases=(zerver.lib.str_utils.ModelReprMixin, models.Model),
+        ),
+        migrations.AlterUniqueTogether(
+            name='streamtopic',
+            unique_together=set([('recipient', 'topic_key')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='streamtopic',
+            index_together=set([('recipient', 'max_message_id')]),
+        ),
+    ]
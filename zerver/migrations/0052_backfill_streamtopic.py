@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Builds the StreamTopic index for the existing stream messages (see
+# rebuild_topic_index in zerver/lib/actions.py), so that stream topic
+# history works as soon as the server is upgraded.  Any rows added by
+# messages sent since 0051 are recomputed along with the rest.
+BACKFILL_STREAMTOPIC = """
+DELETE FROM zerver_streamtopic;
+INSERT INTO zerver_streamtopic
+    (recipient_id, topic_key, topic_name, max_message_id, message_count)
+SELECT
+    zerver_message.recipient_id,
+    lower(zerver_message.subject),
+    (array_agg(zerver_message.subject ORDER BY zerver_message.id DESC))[1],
+    max(zerver_message.id),
+    count(*)
+FROM zerver_message
+JOIN zerver_recipient ON zerver_recipient.id = zerver_message.recipient_id
+WHERE zerver_recipient.type = 2
+GROUP BY zerver_message.recipient_id, lower(zerver_message.subject);
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zerver', '0051_streamtopic'),
+    ]
+
+    operations = [
+        migrations.RunSQL(BACKFILL_STREAMTOPIC,
+                          reverse_sql="DELETE FROM zerver_streamtopic;"),
+    ]
@@ -6,7 +6,7 @@ from zerver.lib.str_utils import NonBinaryStr
 
 from django.db import models
 from django.db.models.query import QuerySet
-from django.db.models import Manager
+from django.db.models import Manager, Q
 from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser, UserManager, \
     PermissionsMixin
@@ -20,7 +20,8 @@ from zerver.lib.cache import cache_with_key, flush_user_profile, flush_realm, \
     display_recipient_cache_key, cache_delete, \
     get_stream_cache_key, active_user_dicts_in_realm_cache_key, \
     active_bot_dicts_in_realm_cache_key, active_user_dict_fields, \
-    active_bot_dict_fields, flush_message
+    active_bot_dict_fields, flush_message, bump_realm_state_version, \
+    flush_per_request_generations, get_realm_generation, with_stream_generation
 from zerver.lib.utils import make_safe_digest, generate_random_token
 from zerver.lib.str_utils import ModelReprMixin
 from django.db import transaction
@@ -74,9 +75,17 @@ def flush_per_request_caches():
     per_request_display_recipient_cache = {}
     global per_request_realm_filters_cache
     per_request_realm_filters_cache = {}
+    flush_per_request_generations()
 
-@cache_with_key(lambda *args: display_recipient_cache_key(args[0]),
-                timeout=3600*24*7)
+def display_recipient_remote_cache_key(recipient_id, recipient_type, recipient_type_id):
+    # type: (int, int, int) -> Text
+    key = display_recipient_cache_key(recipient_id)
+    if recipient_type == Recipient.STREAM:
+        # Renaming the stream bumps its generation.
+        return with_stream_generation(key, recipient_type_id)
+    return key
+
+@cache_with_key(display_recipient_remote_cache_key, timeout=3600*24*7)
 def get_display_recipient_remote_cache(recipient_id, recipient_type, recipient_type_id):
     # type: (int, int, int) -> Union[Text, List[Dict[str, Any]]]
     """
@@ -376,6 +385,7 @@ def flush_realm_emoji(sender, **kwargs):
     cache_set(get_realm_emoji_cache_key(realm),
               get_realm_emoji_uncached(realm),
               timeout=3600*24*7)
+    bump_realm_state_version(realm.id)
 
 post_save.connect(flush_realm_emoji, sender=RealmEmoji)
 post_delete.connect(flush_realm_emoji, sender=RealmEmoji)
@@ -451,6 +461,7 @@ def flush_realm_filter(sender, **kwargs):
     # type: (Any, **Any) -> None
     realm_id = kwargs['instance'].realm_id
     cache_delete(get_realm_filters_cache_key(realm_id))
+    bump_realm_state_version(realm_id)
     try:
         per_request_realm_filters_cache.pop(realm_id)
     except KeyError:
@@ -830,7 +841,8 @@ def bulk_get_streams(realm, stream_names):
             where=[where_clause],
             params=stream_names)
 
-    return generic_bulk_cached_fetch(lambda stream_name: get_stream_cache_key(stream_name, realm),
+    generation = get_realm_generation(realm.id)
+    return generic_bulk_cached_fetch(lambda stream_name: get_stream_cache_key(stream_name, realm, generation),
                                      fetch_streams_by_name,
                                      [stream_name.lower() for stream_name in stream_names],
                                      id_fetcher=lambda stream: stream.name.lower())
@@ -973,7 +985,12 @@ class Message(ModelReprMixin, models.Model):
 
     def sent_by_human(self):
         # type: () -> bool
-        sending_client = self.sending_client.name.lower()
+        return Message.is_human_client(self.sending_client.name)
+
+    @staticmethod
+    def is_human_client(client_name):
+        # type: (Text) -> bool
+        sending_client = client_name.lower()
 
         return (sending_client in ('zulipandroid', 'zulipios', 'zulipdesktop',
                                    'website', 'ios', 'android')) or (
@@ -1033,6 +1050,31 @@ def get_context_for_message(message):
         pub_date__gt=message.pub_date - timedelta(minutes=15),
     ).order_by('-id')[:10]
 
+def bulk_get_context_for_messages(messages):
+    # type: (Sequence[Message]) -> Dict[int, List[Message]]
+    """get_context_for_message for each of the messages, keyed by
+    message ID, fetched (with senders and recipients) in one query."""
+    if not messages:
+        return {}
+    query = Q()
+    for message in messages:
+        query |= Q(recipient_id=message.recipient_id,
+                   subject=message.subject,
+                   id__lt=message.id,
+                   pub_date__gt=message.pub_date - timedelta(minutes=15))
+    candidates = list(Message.objects.filter(query).select_related(
+        'sender', 'recipient').order_by('-id'))
+
+    context = {} # type: Dict[int, List[Message]]
+    for message in messages:
+        context[message.id] = [
+            candidate for candidate in candidates
+            if candidate.recipient_id == message.recipient_id and
+            candidate.subject == message.subject and
+            candidate.id < message.id and
+            candidate.pub_date > message.pub_date - timedelta(minutes=15)][:10]
+    return context
+
 post_save.connect(flush_message, sender=Message)
 
 class Reaction(ModelReprMixin, models.Model):
@@ -1050,6 +1092,31 @@ class Reaction(ModelReprMixin, models.Model):
                   'user_profile__id', 'user_profile__full_name']
         return Reaction.objects.filter(message_id__in=needed_ids).values(*fields)
 
+# StreamTopic is an index of the topics used on each stream, so that
+# listing a stream's topics doesn't require scanning its messages.
+# There is one row per (stream recipient, case-insensitive topic).  It
+# is maintained incrementally by do_send_messages, and recomputed for
+# the affected topics after topic edits and message deletions (see
+# update_topic_index in zerver/lib/actions.py).  Migration 0052 builds
+# it for existing messages, and the backfill_topic_index management
+# command rebuilds it from the Message table.
+class StreamTopic(ModelReprMixin, models.Model):
+    recipient = models.ForeignKey(Recipient) # type: Recipient
+    # The lowercased topic name, since topics are case-insensitive.
+    topic_key = models.CharField(max_length=MAX_SUBJECT_LENGTH) # type: Text
+    # The capitalization used by the most recent message in the topic.
+    topic_name = models.CharField(max_length=MAX_SUBJECT_LENGTH) # type: Text
+    max_message_id = models.IntegerField() # type: int
+    message_count = models.IntegerField(default=0) # type: int
+
+    class Meta(object):
+        unique_together = ("recipient", "topic_key")
+        index_together = [("recipient", "max_message_id")]
+
+    def __unicode__(self):
+        # type: () -> Text
+        return u"<StreamTopic: %s / %s>" % (self.recipient_id, self.topic_name)
+
 # Whenever a message is sent, for each user current subscribed to the
 # corresponding Recipient object, we add a row to the UserMessage
 # table, which has has columns (id, user profile id, message id,
@@ -1157,13 +1224,13 @@ def get_user_profile_by_email(email):
     # type: (Text) -> UserProfile
     return UserProfile.objects.select_related().get(email__iexact=email.strip())
 
-@cache_with_key(active_user_dicts_in_realm_cache_key, timeout=3600*24*7)
+@cache_with_key(active_user_dicts_in_realm_cache_key, timeout=3600*24*7, lease_timeout=10)
 def get_active_user_dicts_in_realm(realm):
     # type: (Realm) -> List[Dict[str, Any]]
     return UserProfile.objects.filter(realm=realm, is_active=True) \
                               .values(*active_user_dict_fields)
 
-@cache_with_key(active_bot_dicts_in_realm_cache_key, timeout=3600*24*7)
+@cache_with_key(active_bot_dicts_in_realm_cache_key, timeout=3600*24*7, lease_timeout=10)
 def get_active_bot_dicts_in_realm(realm):
     # type: (Realm) -> List[Dict[str, Any]]
     return UserProfile.objects.filter(realm=realm, is_active=True, is_bot=True) \
@@ -1368,6 +1435,17 @@ class DefaultStream(models.Model):
     class Meta(object):
         unique_together = ("realm", "stream")
 
+def flush_realm_state(sender, **kwargs):
+    # type: (Any, **Any) -> None
+    realm_id = kwargs['instance'].realm_id
+    if realm_id is not None:
+        bump_realm_state_version(realm_id)
+
+post_save.connect(flush_realm_state, sender=DefaultStream)
+post_delete.connect(flush_realm_state, sender=DefaultStream)
+post_save.connect(flush_realm_state, sender=RealmAlias)
+post_delete.connect(flush_realm_state, sender=RealmAlias)
+
 class Referral(models.Model):
     user_profile = models.ForeignKey(UserProfile) # type: UserProfile
     email = models.EmailField(blank=False, null=False) # type: Text
@@ -1388,3 +1466,6 @@ class ScheduledJob(models.Model):
     # Kind if like a ForeignKey, but table is determined by type.
     filter_id = models.IntegerField(null=True) # type: Optional[int]
     filter_string = models.CharField(max_length=100) # type: Text
+    # How many times we've failed to deliver it; see
+    # zerver.lib.email_delivery.retry_email_job.
+    delivery_attempts = models.PositiveSmallIntegerField(default=0) # type: int
@@ -0,0 +1,277 @@
+from __future__ import absolute_import
+
+import mock
+import time
+import ujson
+from typing import Any, Callable, Text
+
+from zerver.lib import cache, cache_stats
+from zerver.lib.actions import do_rename_stream
+from zerver.lib.cache import LocalCache, active_bot_dicts_in_realm_cache_key, \
+    active_user_dicts_in_realm_cache_key, bump_realm_generation, cache_delete, cache_get, \
+    cache_get_many, cache_set, cache_set_many, cache_with_key, get_remote_cache_requests, local_cache_channel, \
+    start_per_request_generations, user_profile_by_id_cache_key
+from zerver.lib.cache_stats import clear_cache_stats, get_cache_stats
+from zerver.lib.test_classes import ZulipTestCase
+from zerver.lib.test_helpers import queries_captured
+from zerver.middleware import write_log_line
+from zerver.models import Recipient, bulk_get_streams, flush_per_request_caches, \
+    get_active_user_dicts_in_realm, get_display_recipient, get_realm, get_recipient, \
+    get_stream, get_user_profile_by_email, get_user_profile_by_id
+
+class LocalCacheTest(ZulipTestCase):
+    def setUp(self):
+        # type: () -> None
+        cache.local_cache = None
+
+    def tearDown(self):
+        # type: () -> None
+        cache.local_cache = None
+
+    def test_lru_eviction(self):
+        # type: () -> None
+        local = LocalCache(u'test', max_entries=2)
+        local.set(u'a', (1,))
+        local.set(u'b', (2,))
+        self.assertEqual(local.get(u'a'), (1,))
+        local.set(u'c', (3,))
+        # 'b' was the least recently used.
+        self.assertEqual(local.get(u'b'), None)
+        self.assertEqual(local.get(u'a'), (1,))
+        self.assertEqual(local.get(u'c'), (3,))
+
+        local = LocalCache(u'test', max_bytes=1000)
+        local.set(u'a', (u'x' * 600,))
+        local.set(u'b', (u'y' * 600,))
+        self.assertEqual(local.get(u'a'), None)
+        self.assertEqual(local.get(u'b'), (u'y' * 600,))
+        self.assertTrue(local.bytes <= 1000)
+
+    def test_expiry_and_copies(self):
+        # type: () -> None
+        local = LocalCache(u'test', timeout=60)
+        local.set(u'a', ([1, 2],))
+        val = local.get(u'a')
+        val[0].append(3)
+        # Callers get their own copy.
+        self.assertEqual(local.get(u'a'), ([1, 2],))
+
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertEqual(local.get(u'a'), None)
+        self.assertEqual(local.bytes, 0)
+
+    def test_local_tier(self):
+        # type: () -> None
+        user_profile = get_user_profile_by_email('hamlet@zulip.com')
+        with self.settings(LOCAL_CACHE_ENABLED=True):
+            get_user_profile_by_id(user_profile.id)
+            get_user_profile_by_id(user_profile.id)
+
+            # Served from this process, without asking memcached.
+            requests = get_remote_cache_requests()
+            self.assertEqual(get_user_profile_by_id(user_profile.id).email, 'hamlet@zulip.com')
+            self.assertEqual(get_remote_cache_requests(), requests)
+
+            # Another process changes the user, and broadcasts that.
+            cache.get_local_cache_redis_client().publish(
+                local_cache_channel(), ujson.dumps([user_profile_by_id_cache_key(user_profile.id)]))
+            get_user_profile_by_id(user_profile.id)
+            self.assertEqual(get_remote_cache_requests(), requests + 1)
+            get_user_profile_by_id(user_profile.id)
+            self.assertEqual(get_remote_cache_requests(), requests + 1)
+
+            # Saving the user here invalidates it too.
+            user_profile.full_name = 'Prince Hamlet'
+            user_profile.save(update_fields=['full_name'])
+            self.assertEqual(get_user_profile_by_id(user_profile.id).full_name, 'Prince Hamlet')
+
+class CacheStampedeTest(ZulipTestCase):
+    def setUp(self):
+        # type: () -> None
+        self.calls = 0
+
+    def cached_function(self, **options):
+        # type: (**Any) -> Callable[[int], int]
+        @cache_with_key(lambda x: u'stampede_test:%d' % (x,), **options)
+        def compute(x):
+            # type: (int) -> int
+            self.calls += 1
+            return x * self.calls
+        return compute
+
+    def hold_lease(self, key):
+        # type: (Text) -> None
+        self.assertTrue(cache.acquire_cache_lease(key, None, 10))
+
+    def test_waits_for_lease_holder(self):
+        # type: () -> None
+        compute = self.cached_function(lease_timeout=10)
+        self.hold_lease(u'stampede_test:3')
+
+        # The caller holding the lease stores the value while we wait.
+        def store_value(seconds):
+            # type: (float) -> None
+            cache_set(u'stampede_test:3', 42)
+
+        with mock.patch('time.sleep', side_effect=store_value), \
+                mock.patch('zerver.lib.cache.statsd') as statsd:
+            self.assertEqual(compute(3), 42)
+        self.assertEqual(self.calls, 0)
+        self.assertEqual(statsd.timing.call_args[0][0], 'cache.stampede_test.lease_wait')
+
+    def test_lease_timeout(self):
+        # type: () -> None
+        compute = self.cached_function(lease_timeout=10)
+        self.hold_lease(u'stampede_test:3')
+        with mock.patch('zerver.lib.cache.LEASE_WAIT_SECONDS', 0), \
+                mock.patch('zerver.lib.cache.statsd') as statsd:
+            self.assertEqual(compute(3), 3)
+        self.assertEqual(self.calls, 1)
+        statsd.incr.assert_any_call('cache.stampede_test.lease_timeout')
+
+    def test_lease_released(self):
+        # type: () -> None
+        compute = self.cached_function(lease_timeout=10)
+        self.assertEqual(compute(3), 3)
+        self.assertEqual(compute(3), 3)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(cache_get(cache.cache_lease_key(u'stampede_test:3')), None)
+
+    def test_serve_stale(self):
+        # type: () -> None
+        compute = self.cached_function(lease_timeout=10, serve_stale=True)
+        self.assertEqual(compute(3), 3)
+        cache_delete(u'stampede_test:3')
+
+        # While someone else recomputes it, we get the old value.
+        self.hold_lease(u'stampede_test:3')
+        with mock.patch('time.sleep') as sleep:
+            self.assertEqual(compute(3), 3)
+        self.assertFalse(sleep.called)
+        self.assertEqual(self.calls, 1)
+
+    def test_early_refresh(self):
+        # type: () -> None
+        compute = self.cached_function(timeout=100, early_refresh=1.0)
+        self.assertEqual(compute(3), 3)
+
+        # Far from expiring, and quick to compute.
+        cache_set(cache.cache_refresh_key(u'stampede_test:3'), (time.time() + 1000, 0.001))
+        with mock.patch('random.random', return_value=0.5):
+            self.assertEqual(compute(3), 3)
+        self.assertEqual(self.calls, 1)
+
+        # About to expire, and slow to compute.
+        cache_set(cache.cache_refresh_key(u'stampede_test:3'), (time.time() + 1, 10.0))
+        with mock.patch('random.random', return_value=0.5):
+            self.assertEqual(compute(3), 6)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(compute(3), 6)
+
+class CacheGenerationTest(ZulipTestCase):
+    def tearDown(self):
+        # type: () -> None
+        flush_per_request_caches()
+
+    def test_bump_realm_generation(self):
+        # type: () -> None
+        realm = get_realm('zulip')
+        key = active_user_dicts_in_realm_cache_key(realm)
+        self.assertEqual(active_user_dicts_in_realm_cache_key(realm), key)
+        get_active_user_dicts_in_realm(realm)
+        self.assertNotEqual(cache_get(key), None)
+
+        bump_realm_generation(realm.id)
+        self.assertNotEqual(active_user_dicts_in_realm_cache_key(realm), key)
+        with queries_captured() as queries:
+            get_active_user_dicts_in_realm(realm)
+        self.assert_length(queries, 1)
+
+    def test_generation_fetched_once_per_request(self):
+        # type: () -> None
+        realm = get_realm('zulip')
+        start_per_request_generations()
+        with mock.patch('zerver.lib.cache.cache_get', wraps=cache.cache_get) as mock_cache_get:
+            key = active_user_dicts_in_realm_cache_key(realm)
+            self.assertEqual(active_bot_dicts_in_realm_cache_key(realm).split(u':')[-1],
+                             key.split(u':')[-1])
+            self.assertEqual(mock_cache_get.call_count, 1)
+
+            # Our own bumps are seen at once, without another lookup.
+            bump_realm_generation(realm.id)
+            self.assertNotEqual(active_user_dicts_in_realm_cache_key(realm), key)
+            self.assertEqual(mock_cache_get.call_count, 1)
+
+        # Outside of a request, the generation is looked up every time.
+        flush_per_request_caches()
+        with mock.patch('zerver.lib.cache.cache_get', wraps=cache.cache_get) as mock_cache_get:
+            active_user_dicts_in_realm_cache_key(realm)
+            active_user_dicts_in_realm_cache_key(realm)
+        self.assertEqual(mock_cache_get.call_count, 2)
+
+    def test_realm_save_invalidates_streams(self):
+        # type: () -> None
+        realm = get_realm('zulip')
+        self.assertEqual(get_stream('Denmark', realm).realm.name, realm.name)
+        with queries_captured() as queries:
+            realm.name = 'New name'
+            realm.save(update_fields=['name'])
+        # Invalidating the realm's streams doesn't look them up.
+        self.assertFalse([query for query in queries if 'zerver_stream' in query['sql']])
+        self.assertEqual(get_stream('Denmark', realm).realm.name, 'New name')
+        self.assertEqual(bulk_get_streams(realm, ['Denmark'])['denmark'].realm.name, 'New name')
+
+    def test_stream_rename_invalidates_display_recipient(self):
+        # type: () -> None
+        realm = get_realm('zulip')
+        stream = get_stream('Denmark', realm)
+        recipient = get_recipient(Recipient.STREAM, stream.id)
+        self.assertEqual(get_display_recipient(recipient), 'Denmark')
+        do_rename_stream(stream, 'Danmark')
+        flush_per_request_caches()
+        self.assertEqual(get_display_recipient(recipient), 'Danmark')
+
+class CacheStatsTest(ZulipTestCase):
+    def setUp(self):
+        # type: () -> None
+        cache_stats.flush()
+        clear_cache_stats()
+        cache_stats.start_request_cache_stats()
+
+    def tearDown(self):
+        # type: () -> None
+        clear_cache_stats()
+
+    def test_record_by_family(self):
+        # type: () -> None
+        with mock.patch('zerver.lib.cache_stats.BYTES_SAMPLE_RATE', 1):
+            cache_set_many({u'stats_test:1': (u'x' * 100,), u'stats_test:2': (1,),
+                            u'other_stats_test:1': (2,)})
+            cache_get_many([u'stats_test:1', u'stats_test:3', u'other_stats_test:1'])
+            cache_get(u'stats_test:2')
+
+        stats = cache_stats.request_stats[u'stats_test']
+        self.assertEqual(stats['sets'], 2)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['read_sampled'], 2)
+        self.assertTrue(stats['read_bytes_sampled'] > 100)
+        self.assertIn('get_ms', stats)
+        self.assertEqual(cache_stats.request_stats[u'other_stats_test']['hits'], 1)
+        self.assertIn(u'stats_test 2/3', cache_stats.format_request_cache_stats())
+
+        cache_stats.flush()
+        (totals, since) = get_cache_stats()
+        self.assertEqual(totals[u'stats_test']['hits'], 2)
+        self.assertEqual(totals[u'stats_test']['misses'], 1)
+        self.assertEqual(totals[u'other_stats_test']['sets'], 1)
+        self.assertNotEqual(since, None)
+
+    def test_slow_request_log_line(self):
+        # type: () -> None
+        cache_get(u'stats_test:1')
+        log_data = {'time_started': time.time() - 10}
+        with mock.patch('zerver.middleware.logger.info') as info, \
+                mock.patch('zerver.middleware.queue_json_publish'):
+            write_log_line(log_data, '/json/messages', 'GET', '127.0.0.1', 'hamlet@zulip.com', 'website')
+        self.assertIn('(mem keys: stats_test 0/1', info.call_args[0][0])
@@ -0,0 +1,215 @@
+from __future__ import absolute_import
+
+import datetime
+import mock
+import threading
+import ujson
+from six.moves.socketserver import StreamRequestHandler, TCPServer, ThreadingMixIn
+from typing import List, Set
+
+from django.test import override_settings
+from django.utils import timezone
+
+from zerver.lib.email_delivery import EmailDeliverer, MAX_DELIVERY_ATTEMPTS, \
+    RETRY_DELAY_SECONDS
+from zerver.lib.test_classes import ZulipTestCase
+from zerver.lib.test_helpers import queries_captured
+from zerver.models import ScheduledJob
+
+class SMTPRequestHandler(StreamRequestHandler):
+    def reply(self, line):
+        # type: (str) -> None
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+
+    def handle(self):
+        # type: () -> None
+        self.server.connections += 1 # type: ignore # attributes set in StandInSMTPServer
+        self.reply('220 localhost ESMTP')
+        recipients = [] # type: List[str]
+        while True:
+            line = self.rfile.readline().decode('utf-8').rstrip('\r\n')
+            if not line:
+                return
+            command = line.split(' ', 1)[0].upper()
+            if command in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif command == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                address = line.split(':', 1)[1].strip().strip('<>')
+                if address in self.server.refused: # type: ignore
+                    self.reply('550 No such user')
+                else:
+                    recipients.append(address)
+                    self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline().rstrip(b'\r\n') != b'.':
+                    pass
+                if set(recipients) & self.server.failing: # type: ignore
+                    self.reply('451 Try again later')
+                    continue
+                self.server.delivered.extend(recipients) # type: ignore
+                self.reply('250 OK')
+            elif command in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+class ThreadingTCPServer(ThreadingMixIn, TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class StandInSMTPServer(object):
+    """A local stand-in for an SMTP server, which accepts mail for
+    everyone except the `refused` addresses, fails to deliver mail for
+    the `failing` addresses, and records the recipients of the mail it
+    accepted."""
+    def __init__(self, refused=None, failing=None):
+        # type: (Set[str], Set[str]) -> None
+        self.server = ThreadingTCPServer(('127.0.0.1', 0), SMTPRequestHandler)
+        self.server.connections = 0 # type: ignore
+        self.server.delivered = [] # type: ignore # List[str]
+        self.server.refused = refused or set() # type: ignore
+        self.server.failing = failing or set() # type: ignore
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def port(self):
+        # type: () -> int
+        return self.server.server_address[1]
+
+    @property
+    def connections(self):
+        # type: () -> int
+        return self.server.connections # type: ignore
+
+    @property
+    def delivered(self):
+        # type: () -> List[str]
+        return self.server.delivered # type: ignore
+
+    def stop(self):
+        # type: () -> None
+        self.server.shutdown()
+        self.server.server_close()
+
+def smtp_settings(port):
+    # type: (int) -> override_settings
+    return override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                             EMAIL_HOST='127.0.0.1', EMAIL_PORT=port, EMAIL_USE_TLS=False,
+                             EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='')
+
+class EmailDeliveryTest(ZulipTestCase):
+    def setUp(self):
+        # type: () -> None
+        self.smtp_server = StandInSMTPServer(refused={'nobody@example.com'},
+                                             failing={'failing@example.com'})
+
+    def tearDown(self):
+        # type: () -> None
+        self.smtp_server.stop()
+
+    def schedule_email(self, recipient_email, delay=datetime.timedelta(0)):
+        # type: (str, datetime.timedelta) -> ScheduledJob
+        data = {
+            'email_subject': 'Hello',
+            'email_text': 'Hello there',
+            'email_html': '<p>Hello there</p>',
+            'sender_email': 'noreply@zulip.com',
+            'sender_name': 'Zulip',
+            'recipient_email': recipient_email,
+            'recipient_name': '',
+        }
+        return ScheduledJob.objects.create(type=ScheduledJob.EMAIL, filter_string=recipient_email,
+                                           data=ujson.dumps(data),
+                                           scheduled_timestamp=timezone.now() + delay)
+
+    def deliver(self, port, batch_size=100):
+        # type: (int, int) -> EmailDeliverer
+        deliverer = EmailDeliverer(num_senders=1, batch_size=batch_size)
+        with smtp_settings(port):
+            deliverer.run(once=True)
+        return deliverer
+
+    def test_deliver_due_emails(self):
+        # type: () -> None
+        recipients = ['user%d@example.com' % (i,) for i in range(7)]
+        for email in recipients:
+            self.schedule_email(email)
+        future_job = self.schedule_email('later@example.com', delay=datetime.timedelta(days=1))
+
+        with queries_captured() as queries:
+            deliverer = self.deliver(self.smtp_server.port, batch_size=3)
+
+        self.assertEqual(deliverer.delivered, 7)
+        self.assertEqual(deliverer.failed, 0)
+        self.assertEqual(sorted(self.smtp_server.delivered), sorted(recipients))
+        # All of the emails went over a single SMTP connection...
+        self.assertEqual(self.smtp_server.connections, 1)
+        # ...and each batch of jobs was deleted in one query.
+        deletes = [query for query in queries if query['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(list(ScheduledJob.objects.values_list('id', flat=True)), [future_job.id])
+
+    def test_refused_recipient_is_dropped(self):
+        # type: () -> None
+        self.schedule_email('user@example.com')
+        self.schedule_email('nobody@example.com')
+
+        with mock.patch('zerver.lib.email_delivery.logger.warning') as warn:
+            deliverer = self.deliver(self.smtp_server.port)
+
+        self.assertEqual(deliverer.delivered, 1)
+        self.assertEqual(deliverer.failed, 1)
+        self.assertEqual(self.smtp_server.delivered, ['user@example.com'])
+        self.assertIn('recipient was refused', warn.call_args[0][0])
+        self.assertFalse(ScheduledJob.objects.exists())
+
+    def test_failed_job_retried_later(self):
+        # type: () -> None
+        failing_job = self.schedule_email('failing@example.com')
+        self.schedule_email('user@example.com')
+
+        with mock.patch('zerver.lib.email_delivery.logger.exception'):
+            deliverer = self.deliver(self.smtp_server.port)
+
+        # The failed job makes way for the rest of the queue, and is
+        # retried later.
+        self.assertEqual(deliverer.delivered, 1)
+        self.assertEqual(deliverer.failed, 1)
+        self.assertEqual(self.smtp_server.delivered, ['user@example.com'])
+        failing_job = ScheduledJob.objects.get(id=failing_job.id)
+        self.assertEqual(failing_job.delivery_attempts, 1)
+        self.assertGreater(failing_job.scheduled_timestamp,
+                           timezone.now() + datetime.timedelta(seconds=RETRY_DELAY_SECONDS - 10))
+
+        # Once it has failed too often, it's dropped.
+        ScheduledJob.objects.filter(id=failing_job.id).update(
+            delivery_attempts=MAX_DELIVERY_ATTEMPTS - 1, scheduled_timestamp=timezone.now())
+        with mock.patch('zerver.lib.email_delivery.logger.exception'), \
+                mock.patch('zerver.lib.email_delivery.logger.error') as error:
+            deliverer = self.deliver(self.smtp_server.port)
+        self.assertEqual(deliverer.failed, 1)
+        self.assertEqual(error.call_count, 1)
+        self.assertFalse(ScheduledJob.objects.exists())
+
+    def test_unreachable_server_keeps_jobs(self):
+        # type: () -> None
+        self.schedule_email('user1@example.com')
+        self.schedule_email('user2@example.com')
+        port = self.smtp_server.port
+        self.smtp_server.stop()
+
+        with mock.patch('zerver.lib.email_delivery.logger.exception'):
+            deliverer = self.deliver(port)
+
+        self.assertEqual(deliverer.delivered, 0)
+        self.assertEqual(deliverer.failed, 1)
+        self.assertEqual(ScheduledJob.objects.count(), 2)
@@ -6,6 +6,7 @@ from django.test import TestCase
 from zerver.lib.test_helpers import (
     most_recent_message,
     most_recent_usermessage,
+    queries_captured,
 )
 
 from zerver.lib.test_classes import (
@@ -14,10 +15,11 @@ from zerver.lib.test_classes import (
 
 from zerver.models import (
     get_display_recipient, get_stream, get_user_profile_by_email,
-    Recipient, get_realm,
+    Recipient, UserProfile, get_client, get_realm,
 )
 
 from zerver.lib.actions import (
+    check_send_message,
     encode_email_address,
 )
 from zerver.lib.email_mirror import (
@@ -26,7 +28,7 @@ from zerver.lib.email_mirror import (
     get_missed_message_token_from_address,
 )
 
-from zerver.lib.digest import handle_digest_email
+from zerver.lib.digest import handle_digest_email, handle_digest_emails
 
 from zerver.lib.notifications import (
     handle_missedmessage_emails,
@@ -272,6 +274,100 @@ class TestDigestEmailMessages(ZulipTestCase):
         self.assertEqual(mock_send_future_email.call_args[0][0][0]['email'],
                          u'othello@zulip.com')
 
+    def send_stream_message_from_website(self, sender_email, stream_name, subject):
+        # type: (str, str, str) -> int
+        # Digests only count messages sent by people, not bots.
+        sender = get_user_profile_by_email(sender_email)
+        return check_send_message(sender, get_client("website"), "stream", [stream_name],
+                                  subject, "digest test content", realm=sender.realm)
+
+    def digest_text_for(self, mock_send_future_email, email):
+        # type: (mock.MagicMock, str) -> str
+        for call_args in mock_send_future_email.call_args_list:
+            if call_args[0][0][0]['email'] == email:
+                return call_args[0][2]
+        raise AssertionError("No digest sent to %s" % (email,))
+
+    @mock.patch('zerver.lib.digest.one_click_unsubscribe_link', return_value='unsubscribe')
+    @mock.patch('zerver.lib.digest.send_future_email')
+    def test_hot_conversations_follow_subscriptions(self, mock_send_future_email, mock_unsubscribe):
+        # type: (mock.MagicMock, mock.MagicMock) -> None
+        cutoff = time.time() - 10
+        self.subscribe_to_stream("iago@zulip.com", "Digest secrets")
+        for sender in ["othello@zulip.com", "iago@zulip.com", "othello@zulip.com"]:
+            self.send_stream_message_from_website(sender, "Verona", "busy topic")
+        self.send_stream_message_from_website("iago@zulip.com", "Digest secrets", "secret topic")
+
+        hamlet = get_user_profile_by_email("hamlet@zulip.com")
+        iago = get_user_profile_by_email("iago@zulip.com")
+        handle_digest_emails([hamlet.id, iago.id], cutoff)
+
+        hamlet_digest = self.digest_text_for(mock_send_future_email, hamlet.email)
+        self.assertIn("Verona > busy topic", hamlet_digest)
+        self.assertIn("+ 1 more message by", hamlet_digest)
+        self.assertNotIn("secret topic", hamlet_digest)
+        self.assertIn("Digest secrets > secret topic",
+                      self.digest_text_for(mock_send_future_email, iago.email))
+
+    @mock.patch('zerver.lib.digest.one_click_unsubscribe_link', return_value='unsubscribe')
+    @mock.patch('zerver.lib.digest.send_future_email')
+    def test_private_stream_history_not_shared(self, mock_send_future_email, mock_unsubscribe):
+        # type: (mock.MagicMock, mock.MagicMock) -> None
+        cutoff = time.time() - 10
+        self.make_stream("Digest private", invite_only=True)
+        self.subscribe_to_stream("iago@zulip.com", "Digest private")
+        self.send_stream_message_from_website("iago@zulip.com", "Digest private", "early topic")
+        # Hamlet only gets the messages sent after they joined.
+        self.subscribe_to_stream("hamlet@zulip.com", "Digest private")
+        self.send_stream_message_from_website("iago@zulip.com", "Digest private", "late topic")
+
+        hamlet = get_user_profile_by_email("hamlet@zulip.com")
+        iago = get_user_profile_by_email("iago@zulip.com")
+        handle_digest_emails([hamlet.id, iago.id], cutoff)
+
+        hamlet_digest = self.digest_text_for(mock_send_future_email, hamlet.email)
+        self.assertIn("Digest private > late topic", hamlet_digest)
+        self.assertNotIn("early topic", hamlet_digest)
+        iago_digest = self.digest_text_for(mock_send_future_email, iago.email)
+        self.assertIn("Digest private > early topic", iago_digest)
+        self.assertIn("Digest private > late topic", iago_digest)
+
+    @mock.patch('zerver.lib.digest.one_click_unsubscribe_link', return_value='unsubscribe')
+    @mock.patch('zerver.lib.digest.send_future_email')
+    def test_realm_traffic_gathered_once(self, mock_send_future_email, mock_unsubscribe):
+        # type: (mock.MagicMock, mock.MagicMock) -> None
+        cutoff = time.time() - 10
+        for sender in ["othello@zulip.com", "iago@zulip.com", "hamlet@zulip.com"]:
+            self.send_stream_message_from_website(sender, "Verona", "busy topic")
+
+        hamlet = get_user_profile_by_email("hamlet@zulip.com")
+        user_ids = list(UserProfile.objects.filter(
+            realm=get_realm("zulip"), is_bot=False).values_list('id', flat=True))
+        # Warm the caches first.
+        handle_digest_emails(user_ids, cutoff)
+
+        query_counts = []
+        for batch in [[hamlet.id], user_ids]:
+            with queries_captured() as queries:
+                handle_digest_emails(batch, cutoff)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    @mock.patch('zerver.management.commands.enqueue_digest_emails.queue_json_publish')
+    def test_digest_recipients_queued_in_chunks(self, mock_queue_json_publish):
+        # type: (mock.MagicMock) -> None
+        from zerver.management.commands.enqueue_digest_emails import queue_digest_recipients
+        user_profiles = list(UserProfile.objects.filter(realm=get_realm("zulip"), is_bot=False))
+        cutoff = datetime.datetime.utcnow()
+        with mock.patch('zerver.management.commands.enqueue_digest_emails.DIGEST_CHUNK_SIZE', 2):
+            queue_digest_recipients(user_profiles, cutoff)
+
+        events = [call_args[0][1] for call_args in mock_queue_json_publish.call_args_list]
+        self.assertEqual(len(events), (len(user_profiles) + 1) // 2)
+        self.assertEqual([user_id for event in events for user_id in event["user_profile_ids"]],
+                         [user_profile.id for user_profile in user_profiles])
+        self.assertTrue(all(len(event["user_profile_ids"]) <= 2 for event in events))
+
 class TestReplyExtraction(ZulipTestCase):
     def test_reply_is_extracted_from_plain(self):
         # type: () -> None
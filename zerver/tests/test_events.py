@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Dict, List, Optional, Text, Tuple
 
 from django.conf import settings
 from django.http import HttpRequest, HttpResponse
@@ -59,6 +59,7 @@ from zerver.lib.actions import (
     do_change_enable_digest_emails,
     do_add_realm_alias,
     do_remove_realm_alias,
+    do_events_register,
     fetch_initial_state_data,
 )
 
@@ -74,7 +75,12 @@ from zerver.lib.validator import (
 
 from zerver.views.events_register import _default_all_public_streams, _default_narrow
 
-from zerver.tornado.event_queue import allocate_client_descriptor, EventQueue
+from zerver.decorator import RespondAsynchronously
+from zerver.exceptions import RateLimited
+from zerver.lib.rate_limiter import block_user, client as redis_client, unblock_user
+from zerver.tornado.event_queue import allocate_client_descriptor, EventQueue, send_events
+from zerver.tornado.rate_limiter import TornadoRateLimiter, get_throttled_counts, \
+    throttled_counts_redis_key
 from zerver.tornado.views import get_events_backend
 
 from collections import OrderedDict
@@ -248,6 +254,91 @@ class GetEventsTest(ZulipTestCase):
         self.assertEqual(events[0]["type"], "message")
         self.assertEqual(events[0]["message"]["display_recipient"], "Denmark")
 
+    def test_get_events_rate_limited(self):
+        # type: () -> None
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+
+        def get_events(post_data):
+            # type: (Dict[str, Any]) -> Tuple[POSTRequestMock, Any]
+            request = POSTRequestMock(post_data, user_profile)
+            request.client = get_client("website")
+            request.META['REMOTE_ADDR'] = '127.0.0.1'
+            return request, get_events_backend(request, user_profile)
+
+        with self.settings(RATE_LIMITING=True, TORNADO_RATE_LIMITS={'events': (1, 0.5)},
+                           TORNADO_RATE_LIMIT_MAX_DELAY=5), \
+                mock.patch('zerver.tornado.views.events_rate_limiter', TornadoRateLimiter('events')), \
+                mock.patch('tornado.ioloop.IOLoop.instance') as ioloop:
+            request, result = get_events({"apply_markdown": ujson.dumps(True),
+                                          "user_client": "website",
+                                          "dont_block": ujson.dumps(True)})
+            self.assert_json_success(result)
+            queue_id = ujson.loads(result.content)["queue_id"]
+
+            # The next poll is held back for (about) 2 seconds, on the IOLoop.
+            poll = {"queue_id": queue_id,
+                    "user_client": "website",
+                    "last_event_id": -1,
+                    "dont_block": ujson.dumps(True)}
+            request, result = get_events(poll)
+            self.assertIs(result, RespondAsynchronously)
+            (deadline, callback) = ioloop.return_value.add_timeout.call_args[0]
+            self.assertAlmostEqual(deadline - time.time(), 2, delta=0.5)
+
+            request._tornado_handler.zulip_finish = mock.Mock()
+            callback()
+            (response, finished_request) = request._tornado_handler.zulip_finish.call_args[0]
+            self.assertEqual(response['result'], 'success')
+            self.assertEqual(response['events'], [])
+            self.assertIs(finished_request, request)
+
+            # The one after that would need to wait longer than we allow.
+            with self.settings(TORNADO_RATE_LIMIT_MAX_DELAY=3):
+                with self.assertRaises(RateLimited):
+                    get_events(poll)
+
+class TornadoRateLimiterTest(ZulipTestCase):
+    def test_token_bucket(self):
+        # type: () -> None
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        limiter = TornadoRateLimiter('events')
+        now = 1000.0
+        with self.settings(TORNADO_RATE_LIMITS={'events': (3, 1.0)}, TORNADO_RATE_LIMIT_MAX_DELAY=2):
+            results = [limiter.reserve(user_profile, now) for i in range(6)]
+            # The bucket refills while the user is away.
+            later_result = limiter.reserve(user_profile, now + 10)
+
+        # A burst of 3 goes through at once; the next two requests are
+        # delayed until the bucket has refilled enough for them, and the
+        # last is rejected, as it would have to wait too long.
+        self.assertEqual(results, [(True, 0.0)] * 3 + [(True, 1.0), (True, 2.0), (False, 3.0)])
+        self.assertEqual(later_result, (True, 0.0))
+        self.assertEqual(limiter.throttled, {user_profile.id: 3})
+
+    def test_sync(self):
+        # type: () -> None
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        limiter = TornadoRateLimiter('events')
+        redis_client.delete(throttled_counts_redis_key('events'))
+
+        with self.settings(TORNADO_RATE_LIMITS={'events': (3, 0.01)}):
+            self.assertEqual(limiter.reserve(user_profile), (True, 0.0))
+
+            # Manual blocks are picked up when we sync with redis.
+            block_user(user_profile, 30, domain='events')
+            limiter.sync()
+            (allowed, delay) = limiter.reserve(user_profile)
+            self.assertFalse(allowed)
+            self.assertAlmostEqual(delay, 30, delta=2)
+
+            unblock_user(user_profile, domain='events')
+            with mock.patch('logging.info') as info:
+                limiter.sync()
+            self.assertIn('Throttled 1 events requests from 1 users', info.call_args[0][0])
+            self.assertEqual(limiter.reserve(user_profile), (True, 0.0))
+
+        self.assertEqual(get_throttled_counts('events'), {user_profile.id: 1})
+
 class EventsRegisterTest(ZulipTestCase):
     user_profile = get_user_profile_by_email("hamlet@zulip.com")
     bot = get_user_profile_by_email("welcome-bot@zulip.com")
@@ -968,7 +1059,7 @@ class EventsRegisterTest(ZulipTestCase):
         schema_checker = check_dict([
             ('type', equals('subscription')),
             ('op', equals('peer_add')),
-            ('user_id', check_int),
+            ('user_ids', check_list(check_int)),
             ('subscriptions', check_list(check_string)),
         ])
         error = schema_checker('events[2]', events[2])
@@ -1008,7 +1099,7 @@ class EventsRegisterTest(ZulipTestCase):
         peer_add_schema_checker = check_dict([
             ('type', equals('subscription')),
             ('op', equals('peer_add')),
-            ('user_id', check_int),
+            ('user_ids', check_list(check_int)),
             ('subscriptions', check_list(check_string)),
         ])
         peer_remove_schema_checker = check_dict([
@@ -1085,6 +1176,42 @@ class FetchInitialStateDataTest(ZulipTestCase):
         result = fetch_initial_state_data(user_profile, None, "")
         self.assertTrue(len(result['realm_bots']) > 5)
 
+    def test_realm_state_block_shared(self):
+        # type: () -> None
+        hamlet = get_user_profile_by_email('hamlet@zulip.com')
+        cordelia = get_user_profile_by_email('cordelia@zulip.com')
+        fetch_initial_state_data(hamlet, None, "")
+
+        # A second user in the realm gets the realm-wide sections
+        # from the cached block.
+        with mock.patch('zerver.lib.actions.get_realm_user_dicts') as mock_get_realm_user_dicts:
+            result = fetch_initial_state_data(cordelia, ['realm_user'], "")
+        mock_get_realm_user_dicts.assert_not_called()
+        self.assertIn(hamlet.email, [user['email'] for user in result['realm_users']])
+
+        # Changing any of them bumps the realm's state version.
+        do_add_default_stream(hamlet.realm, "Scotland")
+        result = fetch_initial_state_data(cordelia, ['default_streams'], "")
+        self.assertIn("Scotland", [stream['name'] for stream in result['realm_default_streams']])
+
+        do_change_full_name(hamlet, "New Hamlet")
+        result = fetch_initial_state_data(cordelia, ['realm_user'], "")
+        self.assertIn("New Hamlet", [user['full_name'] for user in result['realm_users']])
+
+    def test_streams_include_private_subscriptions(self):
+        # type: () -> None
+        hamlet = get_user_profile_by_email('hamlet@zulip.com')
+        cordelia = get_user_profile_by_email('cordelia@zulip.com')
+        self.make_stream('private_stream', invite_only=True)
+        self.subscribe_to_stream(hamlet.email, 'private_stream')
+
+        hamlet_streams = fetch_initial_state_data(hamlet, ['stream'], "")['streams']
+        cordelia_streams = fetch_initial_state_data(cordelia, ['stream'], "")['streams']
+        self.assertIn('private_stream', [stream['name'] for stream in hamlet_streams])
+        self.assertNotIn('private_stream', [stream['name'] for stream in cordelia_streams])
+        self.assertEqual([stream['name'] for stream in hamlet_streams],
+                         sorted(stream['name'] for stream in hamlet_streams))
+
 class EventQueueTest(TestCase):
     def test_one_event(self):
         # type: () -> None
@@ -1178,6 +1305,80 @@ class EventQueueTest(TestCase):
                            "messages": [1, 2, 3, 4, 5, 6],
                            "timestamp": "1"}])
 
+    def test_flag_range_not_collapsed(self):
+        # type: () -> None
+        queue = EventQueue("1")
+        id_list_event = {"type": "update_message_flags",
+                         "flag": "read",
+                         "operation": "add",
+                         "all": False,
+                         "messages": [1, 2],
+                         "timestamp": "1"}
+        range_event = {"type": "update_message_flags",
+                       "flag": "read",
+                       "operation": "add",
+                       "all": False,
+                       "messages": [3, 5],
+                       "max_id": 5,
+                       "stream_id": 1,
+                       "topic": None,
+                       "timestamp": "1"}
+        queue.push(dict(id_list_event))
+        queue.push(dict(range_event))
+        queue.push(dict(id_list_event, messages=[6]))
+        self.assertEqual(queue.contents(),
+                         [dict(range_event, id=1),
+                          dict(id_list_event, id=2, messages=[1, 2, 6])])
+
+    def test_peer_add_expanded_for_api_clients(self):
+        # type: () -> None
+        event = dict(type="subscription", op="peer_add", subscriptions=["Denmark"],
+                     user_ids=[3, 4])
+        descriptor_args = dict(user_profile_id=1, user_profile_email="hamlet@zulip.com",
+                               realm_id=1, event_types=None, apply_markdown=True,
+                               all_public_streams=False, queue_timeout=600,
+                               last_connection_time=time.time(), narrow=[])
+        webapp = allocate_client_descriptor(dict(descriptor_args, client_type_name="website"))
+        self.assertEqual(webapp.expand_event(event), [event])
+        mobile = allocate_client_descriptor(dict(descriptor_args, client_type_name="ZulipAndroid"))
+        self.assertEqual(mobile.expand_event(event),
+                         [dict(type="subscription", op="peer_add", subscriptions=["Denmark"], user_id=3),
+                          dict(type="subscription", op="peer_add", subscriptions=["Denmark"], user_id=4)])
+
+    def test_flag_range_expanded_for_api_clients(self):
+        # type: () -> None
+        event = dict(type="update_message_flags", operation="add", flag="read",
+                     all=False, messages=[3, 5], max_id=5, stream_id=1, topic=None)
+        descriptor_args = dict(user_profile_id=1, user_profile_email="hamlet@zulip.com",
+                               realm_id=1, event_types=None, apply_markdown=True,
+                               all_public_streams=False, queue_timeout=600,
+                               last_connection_time=time.time(), narrow=[])
+        webapp = allocate_client_descriptor(dict(descriptor_args, client_type_name="website"))
+        self.assertEqual(webapp.expand_event(event), [dict(event, messages=[])])
+        mobile = allocate_client_descriptor(dict(descriptor_args, client_type_name="ZulipAndroid"))
+        self.assertEqual(mobile.expand_event(event), [event])
+
+        # Too many messages to list; the client has to reload.
+        event["messages"] = []
+        self.assertEqual(mobile.expand_event(event),
+                         [dict(type="restart", server_generation=settings.SERVER_GENERATION,
+                               immediate=True)])
+
+    def test_send_events_in_chunks(self):
+        # type: () -> None
+        notices = [dict(event=dict(type="unknown"), users=[1, 2]) for i in range(5)]
+        with mock.patch('zerver.tornado.event_queue.SEND_EVENTS_MAX_NOTICES', 2), \
+                mock.patch('zerver.tornado.event_queue.SEND_EVENTS_MAX_USERS', 3), \
+                mock.patch('zerver.tornado.event_queue.queue_json_publish') as publish:
+            send_events(notices)
+        # Each chunk is limited to 3 users, so holds one notice.
+        self.assertEqual(publish.call_count, 5)
+
+        with mock.patch('zerver.tornado.event_queue.SEND_EVENTS_MAX_NOTICES', 2), \
+                mock.patch('zerver.tornado.event_queue.queue_json_publish') as publish:
+            send_events(notices)
+        self.assertEqual([len(call[0][1]['notices']) for call in publish.call_args_list], [2, 2, 1])
+
     def test_flag_remove_collapsing(self):
         # type: () -> None
         queue = EventQueue("1")
@@ -1219,6 +1420,70 @@ class EventQueueTest(TestCase):
                            'type': 'unknown',
                            "timestamp": "1"}])
 
+class DeltaRegisterTest(ZulipTestCase):
+    def register(self, user_profile, state_version=None, queue_events=[]):
+        # type: (UserProfile, Optional[Text], List[Dict[str, Any]]) -> Dict[str, Any]
+        with mock.patch('zerver.lib.actions.request_event_queue', return_value='queue'), \
+                mock.patch('zerver.lib.actions.get_user_events', return_value=queue_events):
+            return do_events_register(user_profile, get_client("website"),
+                                      state_version=state_version)
+
+    def test_delta_register(self):
+        # type: () -> None
+        hamlet = get_user_profile_by_email('hamlet@zulip.com')
+        cordelia = get_user_profile_by_email('cordelia@zulip.com')
+        result = self.register(hamlet)
+        self.assertIn('realm_users', result)
+        self.assertNotIn('state_events', result)
+        state_version = result['state_version']
+
+        do_change_full_name(cordelia, 'New Cordelia')
+        do_add_realm_alias(hamlet.realm, 'zulip.org')
+
+        result = self.register(hamlet, state_version)
+        for key in ['realm_users', 'realm_domains', 'realm_emoji', 'realm_filters',
+                    'realm_default_streams']:
+            self.assertNotIn(key, result)
+        # Per-user state is still sent in full.
+        self.assertIn('subscriptions', result)
+        self.assertEqual([(event['type'], event['op']) for event in result['state_events']],
+                         [('realm_user', 'update'), ('realm_domains', 'add')])
+        self.assertEqual(result['state_events'][0]['person']['full_name'], 'New Cordelia')
+        self.assertNotEqual(result['state_version'], state_version)
+
+        # Nothing has changed since the last register.
+        result = self.register(hamlet, result['state_version'])
+        self.assertEqual(result['state_events'], [])
+
+    def test_delta_register_queue_events(self):
+        # type: () -> None
+        hamlet = get_user_profile_by_email('hamlet@zulip.com')
+        state_version = self.register(hamlet)['state_version']
+
+        queue_event = dict(id=0, type='realm_domains', op='remove', domain='zulip.org')
+        result = self.register(hamlet, state_version, queue_events=[queue_event])
+        self.assertEqual(result['state_events'], [queue_event])
+        self.assertEqual(result['last_event_id'], 0)
+
+    def test_full_register_fallback(self):
+        # type: () -> None
+        hamlet = get_user_profile_by_email('hamlet@zulip.com')
+        state_version = self.register(hamlet)['state_version']
+
+        # Unknown versions get a full register.
+        for bad_version in ['', 'nonsense', 'abc:1']:
+            result = self.register(hamlet, bad_version)
+            self.assertIn('realm_users', result)
+            self.assertNotIn('state_events', result)
+
+        # So does a client which has missed more than the log holds.
+        with mock.patch('zerver.lib.actions.REALM_STATE_LOG_SIZE', 1):
+            do_change_full_name(hamlet, 'Hamlet 1')
+            do_change_full_name(hamlet, 'Hamlet 2')
+            result = self.register(hamlet, state_version)
+        self.assertIn('realm_users', result)
+        self.assertNotIn('state_events', result)
+
 class TestEventsRegisterAllPublicStreamsDefaults(TestCase):
     def setUp(self):
         # type: () -> None
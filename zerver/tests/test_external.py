@@ -7,9 +7,13 @@ from django.test import TestCase
 
 from zerver.forms import email_is_not_mit_mailing_list
 
+from zerver.lib import rate_limiter
 from zerver.lib.rate_limiter import (
     add_ratelimit_rule,
+    block_user,
     clear_user_history,
+    rate_limit_request,
+    redis_key,
     remove_ratelimit_rule,
 )
 
@@ -122,3 +126,60 @@ class RateLimitTests(ZulipTestCase):
             result = self.send_api_message(email, "Good message")
 
             self.assert_json_success(result)
+
+    def test_rate_limit_request(self):
+        # type: () -> None
+        user = get_user_profile_by_email("hamlet@zulip.com")
+        clear_user_history(user)
+
+        with mock.patch.object(rate_limiter, 'rate_limit_script',
+                               wraps=rate_limiter.rate_limit_script) as script:
+            results = [rate_limit_request(user) for i in range(6)]
+        # Each request is checked and recorded in one round trip.
+        self.assertEqual(script.call_count, 6)
+
+        self.assertEqual([ratelimited for (ratelimited, secs, calls_left) in results],
+                         [False] * 5 + [True])
+        # The last rule is the (60, 100) default one.
+        self.assertEqual([calls_left for (ratelimited, secs, calls_left) in results[:5]],
+                         [99, 98, 97, 96, 95])
+        (ratelimited, secs, calls_left) = results[5]
+        self.assertTrue(0 < secs <= 1)
+
+        # The rejected request wasn't recorded.
+        list_key = redis_key(user, 'all')[0]
+        self.assertEqual(rate_limiter.client.llen(list_key), 5)
+
+        block_user(user, 30)
+        (ratelimited, secs, calls_left) = rate_limit_request(user)
+        self.assertTrue(ratelimited)
+        self.assertTrue(25 < secs <= 30)
+
+    def test_local_bucket(self):
+        # type: () -> None
+        user = get_user_profile_by_email("hamlet@zulip.com")
+        clear_user_history(user)
+        list_key = redis_key(user, 'all')[0]
+        # The (1, 5) rule is too tight to take any calls locally.
+        remove_ratelimit_rule(1, 5)
+
+        with self.settings(RATE_LIMITING_LOCAL_BUCKET=True), \
+                mock.patch.object(rate_limiter, 'rate_limit_script',
+                                  wraps=rate_limiter.rate_limit_script) as script:
+            results = [rate_limit_request(user) for i in range(12)]
+            # The first request takes 99 // 10 = 9 tokens, which serve
+            # the next 9 requests without redis; the 11th records them,
+            # and takes 89 // 10 = 8 tokens, one of which serves the 12th.
+            self.assertEqual(script.call_count, 2)
+            self.assertEqual(rate_limiter.client.llen(list_key), 11)
+
+            # The bucket expires, and isn't used after that.
+            with mock.patch('time.time', return_value=time.time() + 2):
+                rate_limit_request(user)
+            self.assertEqual(script.call_count, 3)
+            self.assertEqual(rate_limiter.client.llen(list_key), 13)
+
+        self.assertFalse(any(ratelimited for (ratelimited, secs, calls_left) in results))
+        self.assertEqual([calls_left for (ratelimited, secs, calls_left) in results],
+                         list(range(99, 87, -1)))
+        add_ratelimit_rule(1, 5)
@@ -3,17 +3,25 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import mock
+import socket
+import threading
+import time
 import ujson
-from typing import Any
-from requests.exceptions import ConnectionError
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from bs4 import BeautifulSoup
+from typing import Any, Dict, List
 from django.test import override_settings
 
-from zerver.models import Recipient, Message
+from zerver.models import Recipient, Message, get_realm
+from zerver.lib.bugdown import version as bugdown_version
 from zerver.lib.test_classes import ZulipTestCase
-from zerver.lib.test_helpers import MockPythonResponse
+from zerver.lib.test_helpers import tornado_redirected_to_list
+from zerver.tornado.event_queue import send_events
 from zerver.worker.queue_processors import FetchLinksEmbedData
-from zerver.lib.url_preview.preview import get_link_embed_data
-from zerver.lib.url_preview.oembed import get_oembed_data
+from zerver.lib.url_preview import preview
+from zerver.lib.url_preview.preview import get_link_embed_data, get_link_embed_data_for_urls
+from zerver.lib.url_preview.oembed import get_oembed_data, get_oembed_endpoint
 from zerver.lib.url_preview.parsers import (
     OpenGraphParser, GenericParser)
 
@@ -29,39 +37,148 @@ TEST_CACHES = {
     }
 }
 
+TEST_PAGE = b"""
+  <html>
+    <head>
+        <title>Test title</title>
+        <meta property="og:title" content="The Rock" />
+        <meta property="og:type" content="video.movie" />
+        <meta property="og:url" content="http://www.imdb.com/title/tt0117500/" />
+        <meta property="og:image" content="http://ia.media-imdb.com/images/rock.jpg" />
+    </head>
+    <body>
+        <h1>Main header</h1>
+        <p>Description text</p>
+    </body>
+  </html>
+"""
+
+OEMBED_PAGE = b"""
+  <html>
+    <head>
+        <title>Test title</title>
+        <link rel="alternate" type="application/json+oembed" href="/oembed?format=json" />
+    </head>
+    <body><p>Description text</p></body>
+  </html>
+"""
+
+OEMBED_RESPONSE = {
+    'type': 'rich',
+    'version': '1.0',
+    'title': 'Embedded title',
+    'thumbnail_url': 'http://example.com/thumbnail.jpg',
+    'html': '<p>test</p>',
+}
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class PreviewRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        # type: () -> None
+        self.server.requests.append(self.path)
+        if self.path.startswith('/slow'):
+            time.sleep(0.5)
+        if self.path.startswith('/missing'):
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if self.path.startswith('/oembed'):
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(ujson.dumps(OEMBED_RESPONSE).encode('utf-8'))
+            return
+        if self.path.startswith('/image'):
+            self.send_header('Content-Type', 'image/png')
+            self.end_headers()
+            self.wfile.write(b'\x89PNG' + b'\x00' * 1000)
+            return
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.end_headers()
+        if self.path.startswith('/embeddable'):
+            self.wfile.write(OEMBED_PAGE)
+            return
+        self.wfile.write(TEST_PAGE)
+        if self.path.startswith('/large'):
+            try:
+                for i in range(1000):
+                    self.wfile.write(b'<p>' + b'x' * 10000 + b'</p>\n')
+                self.wfile.write(b'<p>The end</p>')
+            except socket.error:
+                # The client stopped reading, as it should.
+                pass
+
+    def log_message(self, format, *args):
+        # type: (str, *Any) -> None
+        # keep the tests quiet
+        pass
+
+class PreviewServer(object):
+    """A local stand-in for the websites whose links we preview."""
+    def __init__(self):
+        # type: () -> None
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), PreviewRequestHandler)
+        self.server.requests = [] # type: ignore # List[str]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def requests(self):
+        # type: () -> List[str]
+        return self.server.requests # type: ignore
+
+    def url(self, path):
+        # type: (str) -> str
+        return 'http://127.0.0.1:%d%s' % (self.server.server_address[1], path)
+
+    def stop(self):
+        # type: () -> None
+        self.server.shutdown()
+        self.server.server_close()
+
+def unused_port_url():
+    # type: () -> str
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return 'http://127.0.0.1:%d/' % (port,)
+
+class PreviewServerTestCase(ZulipTestCase):
+    def setUp(self):
+        # type: () -> None
+        self.preview_server = PreviewServer()
+
+    def tearDown(self):
+        # type: () -> None
+        self.preview_server.stop()
+
 @override_settings(INLINE_URL_EMBED_PREVIEW=True)
 class OembedTestCase(ZulipTestCase):
-    @mock.patch('pyoembed.requests.get')
-    def test_present_provider(self, get):
-        # type: (Any) -> None
-        get.return_value = response = mock.Mock()
-        response.headers = {'content-type': 'application/json'}
-        response.ok = True
-        response_data = {
-            'type': 'rich',
-            'thumbnail_url': 'https://scontent.cdninstagram.com/t51.2885-15/n.jpg',
-            'thumbnail_width': 640,
-            'thumbnail_height': 426,
-            'title': 'NASA',
-            'html': '<p>test</p>',
-            'version': '1.0',
-            'width': 658,
-            'height': None}
-        response.text = ujson.dumps(response_data)
-        url = 'http://instagram.com/p/BLtI2WdAymy'
-        data = get_oembed_data(url)
+    def test_discovery(self):
+        # type: () -> None
+        soup = BeautifulSoup(OEMBED_PAGE, "lxml")
+        endpoint = get_oembed_endpoint(soup, 'http://example.com/page')
+        self.assertEqual(endpoint,
+                         'http://example.com/oembed?format=json&maxwidth=640&maxheight=480')
+
+        soup = BeautifulSoup(TEST_PAGE, "lxml")
+        self.assertIsNone(get_oembed_endpoint(soup, 'http://example.com/page'))
+
+    def test_present_provider(self):
+        # type: () -> None
+        data = get_oembed_data(ujson.dumps(OEMBED_RESPONSE))
         self.assertIsInstance(data, dict)
-        self.assertIn('title', data)
-        self.assertEqual(data['title'], response_data['title'])
+        self.assertEqual(data['title'], 'Embedded title')
+        self.assertEqual(data['image'], OEMBED_RESPONSE['thumbnail_url'])
 
-    @mock.patch('pyoembed.requests.get')
-    def test_error_request(self, get):
-        # type: (Any) -> None
-        get.return_value = response = mock.Mock()
-        response.ok = False
-        url = 'http://instagram.com/p/BLtI2WdAymy'
-        data = get_oembed_data(url)
-        self.assertIsNone(data)
+    def test_invalid_response(self):
+        # type: () -> None
+        self.assertIsNone(get_oembed_data('<html></html>'))
+        self.assertIsNone(get_oembed_data('[]'))
 
 
 class OpenGraphParserTestCase(ZulipTestCase):
@@ -153,31 +270,13 @@ class GenericParserTestCase(ZulipTestCase):
         self.assertIsNone(result.get('description'))
 
 
-class PreviewTestCase(ZulipTestCase):
+class PreviewTestCase(PreviewServerTestCase):
     def _send_message_with_test_org_url(self, sender_email):
         # type: (str) -> Message
-        html = """
-          <html>
-            <head>
-                <title>Test title</title>
-                <meta property="og:title" content="The Rock" />
-                <meta property="og:type" content="video.movie" />
-                <meta property="og:url" content="http://www.imdb.com/title/tt0117500/" />
-                <meta property="og:image" content="http://ia.media-imdb.com/images/rock.jpg" />
-            </head>
-            <body>
-                <h1>Main header</h1>
-                <p>Description text</p>
-            </body>
-          </html>
-        """
-        url = 'http://test.org/'
+        url = self.preview_server.url('/')
         msg_id = self.send_message(
             sender_email, "cordelia@zulip.com",
             Recipient.PERSONAL, subject="url", content=url)
-        response = MockPythonResponse(html, 200)
-        mocked_response = mock.Mock(
-            side_effect=lambda k: {url: response}.get(k, MockPythonResponse('', 404)))
         msg = Message.objects.select_related("sender").get(id=msg_id)
         self.assertNotIn(
             '<a href="{0}" target="_blank" title="The Rock">The Rock</a>'.format(url),
@@ -189,14 +288,13 @@ class PreviewTestCase(ZulipTestCase):
             'message_realm_id': msg.sender.realm_id,
             'message_content': url}
         with self.settings(INLINE_URL_EMBED_PREVIEW=True, TEST_SUITE=False, CACHES=TEST_CACHES):
-            with mock.patch('requests.get', mocked_response):
-                FetchLinksEmbedData().consume(event)
+            FetchLinksEmbedData().consume(event)
         msg = Message.objects.select_related("sender").get(id=msg_id)
         return msg
 
     def test_get_link_embed_data(self):
         # type: () -> None
-        url = 'http://test.org/'
+        url = self.preview_server.url('/')
         embedded_link = '<a href="{0}" target="_blank" title="The Rock">The Rock</a>'.format(url)
 
         # When humans send, we should get embedded content.
@@ -212,9 +310,38 @@ class PreviewTestCase(ZulipTestCase):
         msg = self._send_message_with_test_org_url(sender_email='prospero@zulip.com')
         self.assertIn(embedded_link, msg.rendered_content)
 
+    def test_batched_updates(self):
+        # type: () -> None
+        events = []
+        for (path, recipient) in [('/', 'cordelia@zulip.com'), ('/other', 'othello@zulip.com')]:
+            url = self.preview_server.url(path)
+            msg_id = self.send_message(
+                "hamlet@zulip.com", recipient,
+                Recipient.PERSONAL, subject="url", content=url)
+            events.append({
+                'message_id': msg_id,
+                'urls': [url],
+                'message_realm_id': get_realm('zulip').id,
+                'message_content': url})
+
+        tornado_events = [] # type: List[Dict[str, Any]]
+        with self.settings(INLINE_URL_EMBED_PREVIEW=True, TEST_SUITE=False, CACHES=TEST_CACHES), \
+                tornado_redirected_to_list(tornado_events), \
+                mock.patch('zerver.lib.actions.send_events', wraps=send_events) as send_events_mock:
+            FetchLinksEmbedData().consume_batch(events)
+
+        # Both messages are updated, with one notification to Tornado.
+        self.assertEqual(send_events_mock.call_count, 1)
+        self.assertEqual([event['event']['message_id'] for event in tornado_events],
+                         [event['message_id'] for event in events])
+        for event in events:
+            msg = Message.objects.get(id=event['message_id'])
+            self.assertIn('title="The Rock"', msg.rendered_content)
+            self.assertEqual(msg.rendered_content_version, bugdown_version)
+
     def test_http_error_get_data(self):
         # type: () -> None
-        url = 'http://test.org/'
+        url = unused_port_url()
         msg_id = self.send_message(
             "hamlet@zulip.com", "cordelia@zulip.com",
             Recipient.PERSONAL, subject="url", content=url)
@@ -225,16 +352,82 @@ class PreviewTestCase(ZulipTestCase):
             'message_realm_id': msg.sender.realm_id,
             'message_content': url}
         with self.settings(INLINE_URL_EMBED_PREVIEW=True, TEST_SUITE=False, CACHES=TEST_CACHES):
-            with mock.patch('requests.get', mock.Mock(side_effect=ConnectionError())):
-                with mock.patch('logging.error') as error_mock:
-                    FetchLinksEmbedData().consume(event)
+            with mock.patch('logging.error') as error_mock:
+                FetchLinksEmbedData().consume(event)
         self.assertEqual(error_mock.call_count, 1)
         msg = Message.objects.get(id=msg_id)
         self.assertEqual(
-            '<p><a href="http://test.org/" target="_blank" title="http://test.org/">http://test.org/</a></p>',
+            '<p><a href="{0}" target="_blank" title="{0}">{0}</a></p>'.format(url),
             msg.rendered_content)
 
     def test_invalid_link(self):
         # type: () -> None
         with self.settings(INLINE_URL_EMBED_PREVIEW=True, TEST_SUITE=False, CACHES=TEST_CACHES):
             self.assertIsNone(get_link_embed_data('com.notvalidlink'))
+
+    def test_concurrent_fetches(self):
+        # type: () -> None
+        urls = [self.preview_server.url('/slow?page=%d' % (i,)) for i in range(4)]
+        with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
+            start = time.time()
+            results = get_link_embed_data_for_urls(urls + urls[:1])
+            elapsed = time.time() - start
+        # Each page takes half a second to load.
+        self.assertLess(elapsed, 1.5)
+        self.assertEqual(sorted(self.preview_server.requests),
+                         ['/slow?page=%d' % (i,) for i in range(4)])
+        for url in urls:
+            self.assertEqual(results[url]['title'], 'The Rock')
+            self.assertEqual(results[url]['description'], 'Description text')
+
+    def test_results_cached(self):
+        # type: () -> None
+        url = self.preview_server.url('/')
+        with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
+            self.assertEqual(get_link_embed_data(url)['title'], 'The Rock')
+            self.assertEqual(get_link_embed_data(url)['title'], 'The Rock')
+        self.assertEqual(self.preview_server.requests, ['/'])
+
+    def test_failures_cached(self):
+        # type: () -> None
+        missing_url = self.preview_server.url('/missing')
+        slow_url = self.preview_server.url('/slow')
+        with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES), \
+                mock.patch.object(preview, 'FETCH_DEADLINE_SECONDS', 0.2), \
+                mock.patch('logging.warning') as warning_mock, \
+                mock.patch('zerver.lib.url_preview.preview.cache_set',
+                           wraps=preview.cache_set) as cache_set_mock:
+            results = get_link_embed_data_for_urls([missing_url, slow_url])
+            self.assertEqual(results, {missing_url: {}, slow_url: None})
+            self.assertEqual(warning_mock.call_count, 1)
+            cache_set_mock.assert_any_call(slow_url, None, cache_name='database',
+                                           timeout=preview.FAILURE_CACHE_TIMEOUT)
+
+            get_link_embed_data_for_urls([missing_url, slow_url])
+        self.assertEqual(sorted(self.preview_server.requests), ['/missing', '/slow'])
+
+    def test_size_and_type_limits(self):
+        # type: () -> None
+        with mock.patch.object(preview, 'MAX_PAGE_BYTES', 100 * 1024):
+            soup = preview.fetch_page(self.preview_server.url('/large'), time.time() + 10)
+        self.assertEqual(soup.title.text, 'Test title')
+        self.assertNotIn('The end', soup.text)
+
+        self.assertIsNone(preview.fetch_page(self.preview_server.url('/image'), time.time() + 10))
+
+    def test_oembed_discovery(self):
+        # type: () -> None
+        url = self.preview_server.url('/embeddable')
+        with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
+            data = get_link_embed_data(url)
+        self.assertEqual(data['title'], 'Embedded title')
+        self.assertEqual(data['image'], OEMBED_RESPONSE['thumbnail_url'])
+        self.assertEqual(data['description'], 'Description text')
+        # The page is fetched only once, and the endpoint through our
+        # session too.
+        self.assertEqual(self.preview_server.requests,
+                         ['/embeddable', '/oembed?format=json&maxwidth=640&maxheight=480'])
+
+        with mock.patch.object(preview, 'MAX_PAGE_BYTES', 10):
+            self.assertIsNone(preview.fetch_oembed_data(self.preview_server.url('/oembed'),
+                                                        time.time() + 10))
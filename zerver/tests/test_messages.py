@@ -32,7 +32,7 @@ from zerver.models import (
     MAX_MESSAGE_LENGTH, MAX_SUBJECT_LENGTH,
     Message, Realm, Recipient, Stream, UserMessage, UserProfile, Attachment, RealmAlias,
     get_realm, get_stream, get_user_profile_by_email,
-    Reaction, sew_messages_and_reactions
+    Reaction, StreamTopic, sew_messages_and_reactions
 )
 
 from zerver.lib.actions import (
@@ -40,6 +40,8 @@ from zerver.lib.actions import (
     do_create_user,
     get_client,
     get_recipient,
+    rebuild_topic_index,
+    update_topic_index,
 )
 
 from zerver.lib.upload import create_attachment
@@ -52,7 +54,7 @@ import mock
 import time
 import ujson
 from six.moves import range
-from typing import Any, Optional, Text
+from typing import Any, List, Optional, Text, Tuple
 
 class TopicHistoryTest(ZulipTestCase):
     def test_topics_history(self):
@@ -92,6 +94,7 @@ class TopicHistoryTest(ZulipTestCase):
                 message=message,
                 flags=flags,
             )
+            update_topic_index(recipient, [topic])
 
         create_test_message('topic2', read=False)
         create_test_message('toPIc1', read=False, starred=True)
@@ -114,6 +117,77 @@ class TopicHistoryTest(ZulipTestCase):
             [u'toPIc1', 1],
         ])
 
+    def test_topic_index(self):
+        # type: () -> None
+        email = 'hamlet@zulip.com'
+        self.login(email)
+        stream = self.subscribe_to_stream(email, 'topic index')
+        recipient = get_recipient(Recipient.STREAM, stream.id)
+
+        def get_index():
+            # type: () -> List[Tuple[Text, Text, int, int]]
+            return list(StreamTopic.objects.filter(recipient=recipient).order_by('-max_message_id').values_list(
+                'topic_key', 'topic_name', 'max_message_id', 'message_count'))
+
+        id1 = self.send_message(email, 'topic index', Recipient.STREAM, subject='topic1')
+        id2 = self.send_message(email, 'topic index', Recipient.STREAM, subject='Topic1')
+        id3 = self.send_message(email, 'topic index', Recipient.STREAM, subject='topic2')
+        self.assertEqual(get_index(), [
+            (u'topic2', u'topic2', id3, 1),
+            (u'topic1', u'Topic1', id2, 2),
+        ])
+
+        # Moving messages between topics updates both topics
+        result = self.client_patch("/json/messages/" + str(id1), {
+            'message_id': id1,
+            'subject': 'topic2',
+            'propagate_mode': 'change_one',
+        })
+        self.assert_json_success(result)
+        self.assertEqual(get_index(), [
+            (u'topic2', u'topic2', id3, 2),
+            (u'topic1', u'Topic1', id2, 1),
+        ])
+
+        result = self.client_patch("/json/messages/" + str(id2), {
+            'message_id': id2,
+            'subject': 'topic2',
+            'propagate_mode': 'change_one',
+        })
+        self.assert_json_success(result)
+        self.assertEqual(get_index(), [
+            (u'topic2', u'topic2', id3, 3),
+        ])
+
+        # The backfill produces the same index from scratch
+        StreamTopic.objects.filter(recipient=recipient).delete()
+        self.assertEqual(rebuild_topic_index(recipient), 1)
+        self.assertEqual(get_index(), [
+            (u'topic2', u'topic2', id3, 3),
+        ])
+
+        endpoint = '/json/users/me/%d/topics' % (stream.id,)
+        result = self.client_get(endpoint, dict())
+        self.assert_json_success(result)
+        history = ujson.loads(result.content)['topics']
+        self.assertEqual([topic_name for (topic_name, unread_count) in history], [u'topic2'])
+
+    def test_private_stream_topics_history(self):
+        # type: () -> None
+        email = 'hamlet@zulip.com'
+        self.login(email)
+        stream = self.make_stream('private topics', invite_only=True)
+        self.subscribe_to_stream('iago@zulip.com', 'private topics')
+        self.send_message('iago@zulip.com', 'private topics', Recipient.STREAM, subject='before')
+        self.subscribe_to_stream(email, 'private topics')
+        self.send_message('iago@zulip.com', 'private topics', Recipient.STREAM, subject='after')
+
+        # Topics from before we joined the private stream aren't visible
+        endpoint = '/json/users/me/%d/topics' % (stream.id,)
+        result = self.client_get(endpoint, dict())
+        self.assert_json_success(result)
+        self.assertEqual(ujson.loads(result.content)['topics'], [[u'after', 1]])
+
     def test_bad_stream_id(self):
         # type: () -> None
         email = 'iago@zulip.com'
@@ -438,7 +512,7 @@ class StreamMessagesTest(ZulipTestCase):
         with queries_captured() as queries:
             send_message()
 
-        self.assert_max_length(queries, 8)
+        self.assert_max_length(queries, 9)
 
     def test_stream_message_dict(self):
         # type: () -> None
@@ -961,6 +961,67 @@ class GetOldMessagesTest(ZulipTestCase):
                 return
         self.fail("get_old_messages query not found")
 
+    def test_get_old_messages_usermessage_query_count(self):
+        # type: () -> None
+        """
+        Flags are fetched in the same query as the message ids for every
+        narrow type, including the public stream narrows where we include
+        history via an outer join, so zerver_usermessage is only ever hit
+        by the tagged get_old_messages query.
+        """
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        self.subscribe_to_stream("hamlet@zulip.com", 'Scotland')
+        self.send_message("othello@zulip.com", "Scotland", Recipient.STREAM)
+        self.send_message("othello@zulip.com", "hamlet@zulip.com", Recipient.PERSONAL)
+
+        narrows = [
+            None,
+            '[["stream", "Scotland"]]',
+            '[["stream", "Scotland"], ["topic", "test"]]',
+            '[["stream", "Scotland"], ["sender", "othello@zulip.com"]]',
+            '[["stream", "Scotland"], ["search", "test"]]',
+            '[["stream", "Scotland"], ["is", "starred"]]',
+            '[["pm-with", "othello@zulip.com"]]',
+            '[["sender", "othello@zulip.com"]]',
+            '[["topic", "test"]]',
+            '[["is", "private"]]',
+            '[["is", "mentioned"]]',
+            '[["in", "home"]]',
+            '[["search", "test"]]',
+        ]
+        for narrow in narrows:
+            query_params = {'anchor': 0, 'num_before': 0, 'num_after': 10} # type: Dict[str, object]
+            if narrow is not None:
+                query_params['narrow'] = narrow
+            request = POSTRequestMock(query_params, user_profile)
+            with queries_captured() as queries:
+                get_old_messages_backend(request, user_profile)
+            usermessage_queries = [q for q in queries if 'zerver_usermessage' in q['sql']]
+            self.assertEqual(len(usermessage_queries), 1, narrow)
+            self.assertIn('/* get_old_messages */', usermessage_queries[0]['sql'])
+
+    def test_get_old_messages_include_history_flags(self):
+        # type: () -> None
+        """
+        Messages sent to a public stream before the user subscribed come
+        back as read and historical; messages the user received keep
+        their UserMessage flags.
+        """
+        self.make_stream('history test')
+        historical_id = self.send_message("othello@zulip.com", "history test", Recipient.STREAM)
+        self.subscribe_to_stream("hamlet@zulip.com", 'history test')
+        received_id = self.send_message("othello@zulip.com", "history test", Recipient.STREAM)
+
+        self.login("hamlet@zulip.com")
+        narrow = [dict(operator='stream', operand='history test')]
+        result = self.get_and_check_messages(dict(narrow=ujson.dumps(narrow),
+                                                  anchor=historical_id,
+                                                  num_before=0,
+                                                  num_after=10))
+        flags = dict((m['id'], m['flags']) for m in result['messages'])
+        self.assertEqual(flags[historical_id], ["read", "historical"])
+        self.assertNotIn("historical", flags[received_id])
+
     def test_use_first_unread_anchor_with_some_unread_messages(self):
         # type: () -> None
         user_profile = get_user_profile_by_email("hamlet@zulip.com")
@@ -1166,7 +1227,7 @@ class GetOldMessagesTest(ZulipTestCase):
                                                   'narrow': '[["sender", "othello@zulip.com"]]'},
                                                  sql)
 
-        sql_template = 'SELECT anon_1.message_id \nFROM (SELECT id AS message_id \nFROM zerver_message \nWHERE recipient_id = {scotland_recipient} AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC'
+        sql_template = 'SELECT anon_1.message_id, anon_1.flags \nFROM (SELECT zerver_message.id AS message_id, flags \nFROM zerver_message LEFT OUTER JOIN zerver_usermessage ON zerver_usermessage.message_id = zerver_message.id AND zerver_usermessage.user_profile_id = {hamlet_id} \nWHERE recipient_id = {scotland_recipient} AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC'
         sql = sql_template.format(**query_ids)
         self.common_check_get_old_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                                   'narrow': '[["stream", "Scotland"]]'},
@@ -1178,7 +1239,7 @@ class GetOldMessagesTest(ZulipTestCase):
                                                   'narrow': '[["topic", "blah"]]'},
                                                  sql)
 
-        sql_template = "SELECT anon_1.message_id \nFROM (SELECT id AS message_id \nFROM zerver_message \nWHERE recipient_id = {scotland_recipient} AND upper(subject) = upper('blah') AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
+        sql_template = "SELECT anon_1.message_id, anon_1.flags \nFROM (SELECT zerver_message.id AS message_id, flags \nFROM zerver_message LEFT OUTER JOIN zerver_usermessage ON zerver_usermessage.message_id = zerver_message.id AND zerver_usermessage.user_profile_id = {hamlet_id} \nWHERE recipient_id = {scotland_recipient} AND upper(subject) = upper('blah') AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
         sql = sql_template.format(**query_ids)
         self.common_check_get_old_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                                   'narrow': '[["stream", "Scotland"], ["topic", "blah"]]'},
@@ -1208,7 +1269,7 @@ class GetOldMessagesTest(ZulipTestCase):
                                                   'narrow': '[["search", "jumping"]]'},
                                                  sql)
 
-        sql_template = "SELECT anon_1.message_id, anon_1.subject, anon_1.rendered_content, anon_1.content_matches, anon_1.subject_matches \nFROM (SELECT id AS message_id, subject, rendered_content, ts_match_locs_array('zulip.english_us_search', rendered_content, plainto_tsquery('zulip.english_us_search', 'jumping')) AS content_matches, ts_match_locs_array('zulip.english_us_search', escape_html(subject), plainto_tsquery('zulip.english_us_search', 'jumping')) AS subject_matches \nFROM zerver_message \nWHERE recipient_id = {scotland_recipient} AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', 'jumping')) AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
+        sql_template = "SELECT anon_1.message_id, anon_1.flags, anon_1.subject, anon_1.rendered_content, anon_1.content_matches, anon_1.subject_matches \nFROM (SELECT zerver_message.id AS message_id, flags, subject, rendered_content, ts_match_locs_array('zulip.english_us_search', rendered_content, plainto_tsquery('zulip.english_us_search', 'jumping')) AS content_matches, ts_match_locs_array('zulip.english_us_search', escape_html(subject), plainto_tsquery('zulip.english_us_search', 'jumping')) AS subject_matches \nFROM zerver_message LEFT OUTER JOIN zerver_usermessage ON zerver_usermessage.message_id = zerver_message.id AND zerver_usermessage.user_profile_id = {hamlet_id} \nWHERE recipient_id = {scotland_recipient} AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', 'jumping')) AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
         sql = sql_template.format(**query_ids)
         self.common_check_get_old_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                                   'narrow': '[["stream", "Scotland"], ["search", "jumping"]]'},
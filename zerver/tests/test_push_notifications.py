@@ -1,20 +1,29 @@
 import mock
 from mock import call
+import requests
+import threading
 import time
-from typing import Any, Union, SupportsInt, Text
+import ujson
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from typing import Any, Dict, List, Tuple, Union, SupportsInt, Text
 
 import gcm
 
+from django.db.models import F
 from django.test import TestCase
 from django.conf import settings
 
-from zerver.models import PushDeviceToken, UserProfile, Message
+from zerver.models import PushDeviceToken, Recipient, UserMessage, UserProfile, Message
 from zerver.models import get_user_profile_by_email, receives_online_notifications, \
     receives_offline_notifications
 from zerver.lib import push_notifications as apn
+from zerver.lib.actions import handle_push_notifications
 from zerver.lib.test_classes import (
     ZulipTestCase,
 )
+from zerver.lib.test_helpers import queries_captured
+from zerver.worker.queue_processors import PushNotificationsWorker
 
 class MockRedis(object):
     data = {}  # type: Dict[str, Any]
@@ -447,3 +456,235 @@ class TestReceivesNotificationsFunctions(ZulipTestCase):
         self.user.enable_offline_email_notifications = False
         self.user.enable_offline_push_notifications = True
         self.assertTrue(receives_offline_notifications(self.user))
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class GCMRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real GCM server.
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        # type: () -> None
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        payload = ujson.loads(body)
+        self.server.requests.append((self.client_address, payload))
+        response = ujson.dumps({
+            'multicast_id': len(self.server.requests),
+            'success': len(payload['registration_ids']),
+            'failure': 0,
+            'canonical_ids': 0,
+            'results': [{'message_id': '0:%d' % (i,)}
+                        for i in range(len(payload['registration_ids']))],
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        # type: (str, *Any) -> None
+        # keep the tests quiet
+        pass
+
+class StandInGCMServer(object):
+    """A local stand-in for the GCM HTTP connection server."""
+    def __init__(self):
+        # type: () -> None
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), GCMRequestHandler)
+        self.server.requests = [] # type: ignore # List[Tuple[Tuple[str, int], Dict[str, Any]]]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def requests(self):
+        # type: () -> List[Tuple[Tuple[str, int], Dict[str, Any]]]
+        return self.server.requests # type: ignore
+
+    @property
+    def url(self):
+        # type: () -> str
+        return 'http://127.0.0.1:%d/gcm/send' % (self.server.server_address[1],)
+
+    def stop(self):
+        # type: () -> None
+        self.server.shutdown()
+        self.server.server_close()
+
+class StandInAPNsGateway(object):
+    def __init__(self):
+        # type: () -> None
+        self.frames = [] # type: List[Any]
+
+    def send_notification_multiple(self, frame):
+        # type: (Any) -> None
+        self.frames.append(frame)
+
+class StandInAPNs(object):
+    """Stands in for an apns.APNs connection."""
+    def __init__(self):
+        # type: () -> None
+        self.gateway_server = StandInAPNsGateway()
+
+class HandlePushNotificationsTest(ZulipTestCase):
+    def setUp(self):
+        # type: () -> None
+        self.user_profile = get_user_profile_by_email('hamlet@zulip.com')
+        for token in [u'aaaa', u'bbbb']:
+            PushDeviceToken.objects.create(
+                kind=PushDeviceToken.APNS,
+                token=apn.hex_to_b64(token),
+                user=self.user_profile,
+                ios_app_id=settings.ZULIP_IOS_APP_ID)
+        for token in [u'1111', u'2222']:
+            PushDeviceToken.objects.create(
+                kind=PushDeviceToken.GCM,
+                token=apn.hex_to_b64(token),
+                user=self.user_profile,
+                ios_app_id=None)
+        # Start with everything read, so we know what the badge should be.
+        UserMessage.objects.filter(user_profile=self.user_profile).update(
+            flags=F('flags').bitor(UserMessage.flags.read))
+
+        self.gcm_server = StandInGCMServer()
+        self.apns = StandInAPNs()
+        test_gcm = gcm.GCM('fake key')
+        test_gcm.url = self.gcm_server.url
+        self.patchers = [
+            mock.patch.object(apn, 'gcm', test_gcm),
+            mock.patch.object(apn, 'gcm_session', requests.Session()),
+            mock.patch.object(apn, 'connection', self.apns),
+            mock.patch.object(apn, 'dbx_connection', None),
+            mock.patch.object(apn, 'redis_client', MockRedis()),
+            mock.patch('logging.info'),
+            mock.patch('logging.warn'),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        # type: () -> None
+        for patcher in self.patchers:
+            patcher.stop()
+        self.gcm_server.stop()
+
+    def send_missed_messages(self):
+        # type: () -> List[int]
+        return [
+            self.send_message('othello@zulip.com', 'hamlet@zulip.com', Recipient.PERSONAL),
+            self.send_message('iago@zulip.com', 'hamlet@zulip.com', Recipient.PERSONAL),
+            self.send_message('othello@zulip.com', 'Verona', Recipient.STREAM,
+                              content='@**King Hamlet** look at this'),
+        ]
+
+    def events_for(self, user_profile, message_ids):
+        # type: (UserProfile, List[int]) -> List[Dict[str, Any]]
+        return [{'user_profile_id': user_profile.id, 'message_id': message_id}
+                for message_id in message_ids]
+
+    def test_one_notification_per_user(self):
+        # type: () -> None
+        message_ids = self.send_missed_messages()
+        # An unread message which isn't a mention doesn't count towards
+        # the badge.
+        self.send_message('othello@zulip.com', 'Verona', Recipient.STREAM)
+
+        cordelia = get_user_profile_by_email('cordelia@zulip.com')
+        cordelia_message_id = self.send_message('othello@zulip.com', 'cordelia@zulip.com',
+                                                Recipient.PERSONAL)
+
+        events = self.events_for(self.user_profile, message_ids)
+        events += self.events_for(cordelia, [cordelia_message_id])
+        with mock.patch('zerver.lib.push_notifications.APNsMessage',
+                        wraps=apn.APNsMessage) as apns_message:
+            PushNotificationsWorker().consume_batch(events)
+
+        # Cordelia has no devices, so Hamlet gets the only pushes: one
+        # to each gateway, covering all of the missed messages.
+        self.assertEqual(len(self.apns.gateway_server.frames), 1)
+        self.assertEqual(apns_message.call_count, 1)
+        (args, kwargs) = apns_message.call_args
+        self.assertEqual(set(args[1]), {u'aaaa', u'bbbb'})
+        self.assertEqual(kwargs['badge'], 3)
+        self.assertEqual(kwargs['zulip'], {'message_ids': message_ids})
+        self.assertEqual(kwargs['alert'],
+                         "3 new Zulip mentions and private messages from Othello, the Moor of Venice, Iago")
+
+        self.assertEqual(len(self.gcm_server.requests), 1)
+        payload = self.gcm_server.requests[0][1]
+        self.assertEqual(set(payload['registration_ids']),
+                         {apn.hex_to_b64(u'1111').decode('utf-8'),
+                          apn.hex_to_b64(u'2222').decode('utf-8')})
+        data = payload['data']
+        self.assertEqual(data['zulip_message_ids'], message_ids)
+        self.assertEqual(data['zulip_message_id'], message_ids[-1])
+        self.assertEqual(data['recipient_type'], 'stream')
+        self.assertEqual(data['alert'], kwargs['alert'])
+
+    def test_single_message(self):
+        # type: () -> None
+        message_id = self.send_message('othello@zulip.com', 'hamlet@zulip.com', Recipient.PERSONAL)
+        with mock.patch('zerver.lib.push_notifications.APNsMessage',
+                        wraps=apn.APNsMessage) as apns_message:
+            PushNotificationsWorker().consume_batch(self.events_for(self.user_profile, [message_id]))
+        kwargs = apns_message.call_args[1]
+        self.assertEqual(kwargs['alert'], "New private message from Othello, the Moor of Venice")
+        self.assertEqual(kwargs['badge'], 1)
+        self.assertEqual(self.gcm_server.requests[0][1]['data']['recipient_type'], 'private')
+
+    def test_read_messages_are_skipped(self):
+        # type: () -> None
+        message_ids = self.send_missed_messages()
+        UserMessage.objects.filter(user_profile=self.user_profile).update(
+            flags=F('flags').bitor(UserMessage.flags.read))
+        PushNotificationsWorker().consume_batch(self.events_for(self.user_profile, message_ids))
+        self.assertEqual(self.apns.gateway_server.frames, [])
+        self.assertEqual(self.gcm_server.requests, [])
+
+    def test_queries_independent_of_batch_size(self):
+        # type: () -> None
+        message_ids = self.send_missed_messages()
+        # Warm the caches first.
+        PushNotificationsWorker().consume_batch(self.events_for(self.user_profile, message_ids))
+        query_counts = []
+        for batch in [message_ids[:1], message_ids]:
+            with queries_captured() as queries:
+                PushNotificationsWorker().consume_batch(self.events_for(self.user_profile, batch))
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_gcm_connection_reused(self):
+        # type: () -> None
+        message_ids = self.send_missed_messages()
+        worker = PushNotificationsWorker()
+        for message_id in message_ids:
+            worker.consume_batch(self.events_for(self.user_profile, [message_id]))
+        self.assertEqual(len(self.gcm_server.requests), 3)
+        # Each batch's push went over the same keep-alive connection.
+        client_addresses = set(address for (address, payload) in self.gcm_server.requests)
+        self.assertEqual(len(client_addresses), 1)
+
+    @mock.patch('logging.exception')
+    def test_failure_does_not_block_other_users(self, mock_exception):
+        # type: (mock.MagicMock) -> None
+        message_ids = self.send_missed_messages()
+        othello = get_user_profile_by_email('othello@zulip.com')
+        events = self.events_for(othello, [message_ids[0]]) + \
+            self.events_for(self.user_profile, message_ids)
+
+        worker = PushNotificationsWorker()
+
+        def handle(user_profile_id, missed_messages):
+            # type: (int, List[Dict[str, Any]]) -> None
+            if user_profile_id == othello.id:
+                raise Exception("push failed")
+            handle_push_notifications(user_profile_id, missed_messages)
+
+        with mock.patch('zerver.worker.queue_processors.handle_push_notifications',
+                        side_effect=handle), \
+                mock.patch.object(worker, '_handle_consume_exception') as handle_exception:
+            worker.consume_batch(events)
+        handle_exception.assert_called_once_with(self.events_for(othello, [message_ids[0]]))
+        self.assertEqual(len(self.gcm_server.requests), 1)
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
-from typing import Any, Dict, List, Mapping, Optional, Sequence, Text
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Set, Text
 
 from django.http import HttpRequest, HttpResponse
 from django.utils.translation import ugettext as _
@@ -44,7 +44,8 @@ from zerver.lib.actions import (
     gather_subscriptions_helper, bulk_add_subscriptions, bulk_remove_subscriptions,
     gather_subscriptions, get_default_streams_for_realm, get_realm, get_stream,
     get_user_profile_by_email, set_default_streams, check_stream_name,
-    create_stream_if_needed, create_streams_if_needed, active_user_ids
+    create_stream_if_needed, create_streams_if_needed, active_user_ids,
+    do_deactivate_user, do_reactivate_user, get_subscriber_emails
 )
 
 from zerver.views.streams import (
@@ -1495,7 +1496,7 @@ class SubscriptionAPITest(ZulipTestCase):
                 )
         self.assert_max_length(queries, 43)
 
-        self.assert_length(events, 8)
+        self.assert_length(events, 7)
         for ev in [x for x in events if x['event']['type'] not in ('message', 'stream')]:
             if isinstance(ev['event']['subscriptions'][0], dict):
                 self.assertEqual(ev['event']['op'], 'add')
@@ -1508,6 +1509,11 @@ class SubscriptionAPITest(ZulipTestCase):
                 # never subscribed to, in order for the neversubscribed
                 # structure to stay up-to-date.
                 self.assertEqual(ev['event']['op'], 'peer_add')
+                self.assertEqual(
+                    set(ev['event']['user_ids']),
+                    set([get_user_profile_by_email(email1).id,
+                         get_user_profile_by_email(email2).id])
+                )
 
         stream = get_stream('multi_user_stream', realm)
         self.assertEqual(stream.num_subscribers(), 2)
@@ -1536,7 +1542,7 @@ class SubscriptionAPITest(ZulipTestCase):
         self.assertEqual(len(add_peer_event['users']), 16)
         self.assertEqual(add_peer_event['event']['type'], 'subscription')
         self.assertEqual(add_peer_event['event']['op'], 'peer_add')
-        self.assertEqual(add_peer_event['event']['user_id'], self.user_profile.id)
+        self.assertEqual(add_peer_event['event']['user_ids'], [self.user_profile.id])
 
         stream = get_stream('multi_user_stream', realm)
         self.assertEqual(stream.num_subscribers(), 3)
@@ -1565,7 +1571,7 @@ class SubscriptionAPITest(ZulipTestCase):
         self.assertEqual(len(add_peer_event['users']), 16)
         self.assertEqual(add_peer_event['event']['type'], 'subscription')
         self.assertEqual(add_peer_event['event']['op'], 'peer_add')
-        self.assertEqual(add_peer_event['event']['user_id'], user_profile.id)
+        self.assertEqual(add_peer_event['event']['user_ids'], [user_profile.id])
 
     def test_private_stream_subscription(self):
         # type: () -> None
@@ -1608,7 +1614,7 @@ class SubscriptionAPITest(ZulipTestCase):
         self.assertEqual(len(add_peer_event['users']), 1)
         self.assertEqual(add_peer_event['event']['type'], 'subscription')
         self.assertEqual(add_peer_event['event']['op'], 'peer_add')
-        self.assertEqual(add_peer_event['event']['user_id'], user_profile.id)
+        self.assertEqual(add_peer_event['event']['user_ids'], [user_profile.id])
 
     def test_users_getting_add_peer_event(self):
         # type: () -> None
@@ -1631,20 +1637,24 @@ class SubscriptionAPITest(ZulipTestCase):
                 dict(principals=ujson.dumps(new_users_to_subscribe)),
             )
 
-        add_peer_events = [events[2], events[3]]
-        for add_peer_event in add_peer_events:
-            self.assertEqual(add_peer_event['event']['type'], 'subscription')
-            self.assertEqual(add_peer_event['event']['op'], 'peer_add')
-            event_sent_to_ids = add_peer_event['users']
-            user_dict = [get_user_profile_by_id(user_id).email
-                         for user_id in event_sent_to_ids]
-            for user in new_users_to_subscribe:
-                # Make sure new users subscribed to stream is not in
-                # peer_add event recipient list
-                self.assertNotIn(user, user_dict)
-            for old_user in users_to_subscribe:
-                # Check non new users are in peer_add event recipient list.
-                self.assertIn(old_user, user_dict)
+        # Both new subscribers are announced in a single peer_add event.
+        add_peer_event = events[2]
+        self.assertEqual(add_peer_event['event']['type'], 'subscription')
+        self.assertEqual(add_peer_event['event']['op'], 'peer_add')
+        self.assertEqual(
+            set(add_peer_event['event']['user_ids']),
+            set(get_user_profile_by_email(email).id for email in new_users_to_subscribe)
+        )
+        event_sent_to_ids = add_peer_event['users']
+        user_dict = [get_user_profile_by_id(user_id).email
+                     for user_id in event_sent_to_ids]
+        for user in new_users_to_subscribe:
+            # Make sure new users subscribed to stream is not in
+            # peer_add event recipient list
+            self.assertNotIn(user, user_dict)
+        for old_user in users_to_subscribe:
+            # Check non new users are in peer_add event recipient list.
+            self.assertIn(old_user, user_dict)
 
     def test_users_getting_remove_peer_event(self):
         # type: () -> None
@@ -2287,6 +2297,41 @@ class GetSubscribersTest(ZulipTestCase):
             self.assertTrue(len(sub["subscribers"]) == len(users_to_subscribe))
         self.assert_length(queries, 4)
 
+    def test_subscriber_ids_cache(self):
+        # type: () -> None
+        """
+        Subscriber lists are served from the per-stream cache once
+        warm, and the cache follows subscription and user activity
+        changes.
+        """
+        stream = self.make_stream('subscriber_cache')
+        othello = get_user_profile_by_email("othello@zulip.com")
+        bulk_add_subscriptions([stream], [self.user_profile, othello])
+
+        gather_subscriptions(self.user_profile)
+        with queries_captured() as queries:
+            gather_subscriptions(self.user_profile)
+        # No query for the subscriptions of all the realm's streams.
+        self.assert_length(queries, 3)
+
+        def subscriber_emails():
+            # type: () -> Set[Text]
+            return set(get_subscriber_emails(stream, self.user_profile))
+
+        self.assertEqual(subscriber_emails(), {self.email, othello.email})
+
+        bulk_remove_subscriptions([othello], [stream])
+        self.assertEqual(subscriber_emails(), {self.email})
+
+        bulk_add_subscriptions([stream], [othello])
+        self.assertEqual(subscriber_emails(), {self.email, othello.email})
+
+        do_deactivate_user(othello)
+        self.assertEqual(subscriber_emails(), {self.email})
+
+        do_reactivate_user(othello)
+        self.assertEqual(subscriber_emails(), {self.email, othello.email})
+
     @slow("common_subscribe_to_streams is slow")
     def test_never_subscribed_streams(self):
         # type: () -> None
@@ -4,13 +4,15 @@ from __future__ import absolute_import
 from typing import Any, Dict, List
 
 from zerver.models import (
-    get_user_profile_by_email, Recipient, UserMessage
+    get_stream, get_user_profile_by_email, Recipient, UserMessage
 )
 
+from zerver.lib.actions import do_update_message_flags
 from zerver.lib.test_helpers import tornado_redirected_to_list
 from zerver.lib.test_classes import (
     ZulipTestCase,
 )
+import mock
 import ujson
 
 class PointerTest(ZulipTestCase):
@@ -152,6 +154,29 @@ class UnreadCountTests(ZulipTestCase):
         for msg in self.get_old_messages():
             self.assertEqual(msg['flags'], [])
 
+    def test_update_all_flags_in_batches(self):
+        # type: () -> None
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        unread = UserMessage.objects.filter(user_profile=user_profile,
+                                            flags=~UserMessage.flags.read)
+        expected_count = unread.count()
+        max_id = unread.latest('message_id').message_id
+        self.assertTrue(expected_count > 2)
+
+        events = [] # type: List[Dict[str, Any]]
+        with mock.patch('zerver.lib.actions.UPDATE_MESSAGE_FLAGS_BATCH_SIZE', 2), \
+                tornado_redirected_to_list(events):
+            count = do_update_message_flags(user_profile, "add", "read", None, True, None, None)
+
+        self.assertEqual(count, expected_count)
+        self.assertEqual(unread.count(), 0)
+
+        self.assertEqual(len(events), 1)
+        event = events[0]['event']
+        self.assertEqual(event['all'], True)
+        self.assertEqual(event['messages'], [])
+        self.assertEqual(event['max_id'], max_id)
+
     def test_mark_all_in_stream_read(self):
         # type: () -> None
         self.login("hamlet@zulip.com")
@@ -174,6 +199,9 @@ class UnreadCountTests(ZulipTestCase):
         event = events[0]['event']
         expected = dict(operation='add',
                         messages=[message_id],
+                        max_id=message_id,
+                        stream_id=get_stream("test_stream", user_profile.realm).id,
+                        topic=None,
                         flag='read',
                         type='update_message_flags',
                         all=False)
@@ -225,6 +253,9 @@ class UnreadCountTests(ZulipTestCase):
         event = events[0]['event']
         expected = dict(operation='add',
                         messages=[message_id],
+                        max_id=message_id,
+                        stream_id=get_stream("test_stream", user_profile.realm).id,
+                        topic='test_topic',
                         flag='read',
                         type='update_message_flags',
                         all=False)
@@ -242,6 +273,26 @@ class UnreadCountTests(ZulipTestCase):
             if msg.user_profile.email == "hamlet@zulip.com":
                 self.assertFalse(msg.flags.read)
 
+    def test_mark_large_stream_read_omits_ids(self):
+        # type: () -> None
+        self.login("hamlet@zulip.com")
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        self.subscribe_to_stream(user_profile.email, "test_stream", user_profile.realm)
+        message_ids = [self.send_message("hamlet@zulip.com", "test_stream", Recipient.STREAM, "hello")
+                       for i in range(3)]
+
+        events = [] # type: List[Dict[str, Any]]
+        with tornado_redirected_to_list(events), \
+                mock.patch('zerver.lib.actions.UPDATE_MESSAGE_FLAGS_EVENT_MAX_IDS', 2):
+            result = self.client_post("/json/messages/flags", {"messages": ujson.dumps([]),
+                                                               "op": "add",
+                                                               "flag": "read",
+                                                               "stream_name": "test_stream"})
+        self.assert_json_success(result)
+        event = events[0]['event']
+        self.assertEqual(event['messages'], [])
+        self.assertEqual(event['max_id'], max(message_ids))
+
     def test_mark_all_in_invalid_topic_read(self):
         # type: () -> None
         self.login("hamlet@zulip.com")
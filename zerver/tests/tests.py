@@ -21,7 +21,7 @@ from zerver.lib.test_runner import slow
 from zerver.forms import WRONG_SUBDOMAIN_ERROR
 
 from zerver.models import UserProfile, Recipient, \
-    Realm, RealmAlias, UserActivity, \
+    Realm, RealmAlias, UserActivity, UserActivityInterval, \
     get_user_profile_by_email, get_realm, get_client, get_stream, \
     Message, get_unique_open_realm, completely_open
 
@@ -33,17 +33,25 @@ from zerver.lib.actions import \
     do_change_is_admin, extract_recipients, \
     do_set_realm_name, do_deactivate_realm, \
     do_change_stream_invite_only
-from zerver.lib.notifications import handle_missedmessage_emails
+from zerver.lib.notifications import handle_missedmessage_emails, \
+    handle_missedmessage_emails_for_users, MissedMessageEmailRenderer
 from zerver.lib.session_user import get_session_dict_user
 from zerver.middleware import is_slow_query
 from zerver.lib.avatar import avatar_url
+from zerver.lib.timestamp import datetime_to_timestamp, timestamp_to_datetime
 from zerver.lib.utils import split_by
+from zerver.lib.queue import InMemoryQueueClient, QueuePublisher, PUBLISH_ATTEMPTS, \
+    TransactionalQueueClient, flush_publish_batch, queue_json_publish, start_publish_batch
+from zerver.lib.queue_stats import clear_queue_stats, get_queue_stats, \
+    histogram_percentile, stamp_enqueue_time
 
 from zerver.worker import queue_processors
+from zerver.worker.supervisor import QueueWorkerSupervisor, desired_worker_count
 
 from django.conf import settings
 from django.core import mail
 from six.moves import range, urllib
+import datetime
 import os
 import re
 import sys
@@ -51,6 +59,7 @@ import time
 import ujson
 import random
 import filecmp
+import pika
 import subprocess
 
 def bail(msg):
@@ -535,6 +544,18 @@ class WorkerTest(TestCase):
                 callback = self.consumers[queue_name]
                 callback(data)
 
+        def consume_json_batches(self, queue_name, callback, batch_size, max_wait):
+            # type: (str, Callable, int, float) -> None
+            events = [data for (name, data) in self.queue if name == queue_name]
+            for i in range(0, len(events), batch_size):
+                callback(events[i:i + batch_size])
+
+        def drain_queue(self, queue_name, json):
+            # type: (str, bool) -> List[Dict[str, Any]]
+            events = [data for (name, data) in self.queue if name == queue_name]
+            self.queue = [(name, data) for (name, data) in self.queue if name != queue_name]
+            return events
+
     def test_UserActivityWorker(self):
         # type: () -> None
         fake_client = self.FakeClient()
@@ -564,6 +585,133 @@ class WorkerTest(TestCase):
             self.assertTrue(len(activity_records), 1)
             self.assertTrue(activity_records[0].count, 1)
 
+    def test_UserActivityWorker_batch(self):
+        # type: () -> None
+        fake_client = self.FakeClient()
+
+        user = get_user_profile_by_email('hamlet@zulip.com')
+        UserActivity.objects.filter(
+            user_profile = user.id,
+            client = get_client('ios')
+        ).delete()
+
+        now = time.time()
+        for i in range(5):
+            fake_client.queue.append(('user_activity', dict(
+                user_profile_id = user.id,
+                client = 'ios',
+                time = now + i,
+                query = 'send_message' if i % 2 else 'get_events_backend'
+            )))
+
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.UserActivityWorker()
+            worker.batch_size = 3
+            worker.setup()
+            worker.start()
+
+        activity_records = UserActivity.objects.filter(
+            user_profile = user.id,
+            client = get_client('ios')
+        )
+        counts = {record.query: record.count for record in activity_records}
+        self.assertEqual(counts, {'send_message': 2, 'get_events_backend': 3})
+        last_visit = activity_records.get(query='get_events_backend').last_visit
+        self.assertEqual(last_visit, timestamp_to_datetime(now + 4))
+
+    def test_UserActivityWorker_existing_rows(self):
+        # type: () -> None
+        fake_client = self.FakeClient()
+        user = get_user_profile_by_email('hamlet@zulip.com')
+        client = get_client('ios')
+        UserActivity.objects.filter(user_profile=user.id, client=client).delete()
+        last_visit = timestamp_to_datetime(time.time())
+        UserActivity.objects.create(user_profile=user, client=client, query='send_message',
+                                    count=10, last_visit=last_visit)
+
+        # An older event only bumps the count.
+        fake_client.queue.append(('user_activity', dict(
+            user_profile_id = user.id,
+            client = 'ios',
+            time = time.time() - 3600,
+            query = 'send_message'
+        )))
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.UserActivityWorker()
+            worker.setup()
+            worker.start()
+
+        activity = UserActivity.objects.get(user_profile=user.id, client=client, query='send_message')
+        self.assertEqual(activity.count, 11)
+        self.assertEqual(activity.last_visit, last_visit)
+
+    def test_UserActivityIntervalWorker(self):
+        # type: () -> None
+        fake_client = self.FakeClient()
+        user = get_user_profile_by_email('hamlet@zulip.com')
+        UserActivityInterval.objects.filter(user_profile=user).delete()
+        start = timestamp_to_datetime(int(time.time()) - 3 * 3600)
+        UserActivityInterval.objects.create(user_profile=user, start=start,
+                                            end=start + datetime.timedelta(minutes=15))
+
+        # Two events extending the existing interval, then two more
+        # forming a new one an hour later.
+        for minutes in [5, 20, 80, 90]:
+            fake_client.queue.append(('user_activity_interval', dict(
+                user_profile_id = user.id,
+                time = datetime_to_timestamp(start + datetime.timedelta(minutes=minutes)),
+            )))
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.UserActivityIntervalWorker()
+            worker.setup()
+            worker.start()
+
+        intervals = UserActivityInterval.objects.filter(user_profile=user).order_by('start')
+        self.assertEqual([(interval.start, interval.end) for interval in intervals], [
+            (start, start + datetime.timedelta(minutes=35)),
+            (start + datetime.timedelta(minutes=80), start + datetime.timedelta(minutes=105)),
+        ])
+
+    def test_batch_error_handling(self):
+        # type: () -> None
+        processed = [] # type: List[List[str]]
+
+        @queue_processors.assign_queue('unreliable_batch_worker')
+        class UnreliableBatchWorker(queue_processors.QueueProcessingWorker):
+            batch_size = 2
+
+            def consume_batch(self, events):
+                # type: (List[Dict[str, Any]]) -> None
+                types = [event["type"] for event in events]
+                if 'unexpected behaviour' in types:
+                    raise Exception('Worker task not performing as expected!')
+                processed.append(types)
+
+            def _log_problem(self):
+                # type: () -> None
+
+                # keep the tests quiet
+                pass
+
+        fake_client = self.FakeClient()
+        for msg in ['good', 'fine', 'unexpected behaviour', 'bad batch', 'back to normal']:
+            fake_client.queue.append(('unreliable_batch_worker', {'type': msg}))
+
+        fn = os.path.join(settings.QUEUE_ERROR_DIR, 'unreliable_batch_worker.errors')
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+
+        with simulated_queue_client(lambda: fake_client):
+            worker = UnreliableBatchWorker()
+            worker.setup()
+            worker.start()
+
+        self.assertEqual(processed, [['good', 'fine'], ['back to normal']])
+        failed = [ujson.loads(line.split('\t')[1])["type"] for line in open(fn)]
+        self.assertEqual(failed, ['unexpected behaviour', 'bad batch'])
+
     def test_error_handling(self):
         # type: () -> None
         processed = []
@@ -602,6 +750,103 @@ class WorkerTest(TestCase):
         event = ujson.loads(line.split('\t')[1])
         self.assertEqual(event["type"], 'unexpected behaviour')
 
+    @override_settings(MISSED_MESSAGE_EMAIL_BATCH_SECONDS=120)
+    def test_MissedMessageWorker(self):
+        # type: () -> None
+        fake_client = self.FakeClient()
+        hamlet = get_user_profile_by_email('hamlet@zulip.com')
+        othello = get_user_profile_by_email('othello@zulip.com')
+
+        def send(user_profile, message_id):
+            # type: (UserProfile, int) -> None
+            fake_client.queue.append(('missedmessage_emails', dict(
+                user_profile_id=user_profile.id, message_id=message_id)))
+
+        with simulated_queue_client(lambda: fake_client), \
+                patch('zerver.worker.queue_processors.handle_missedmessage_emails_for_users') as mock_handle:
+            worker = queue_processors.MissedMessageWorker()
+            worker.setup()
+
+            send(hamlet, 1)
+            send(othello, 2)
+            worker.process_events(1000)
+            self.assertFalse(mock_handle.called)
+            self.assertEqual(worker.seconds_until_next_check(1000),
+                             worker.POLL_INTERVAL_SECONDS)
+            self.assertEqual(worker.seconds_until_next_check(1118), 2)
+
+            # Hamlet's later message joins the batch started by the
+            # first one; both batches are due at once, so they are
+            # sent together.
+            send(hamlet, 3)
+            worker.process_events(1060)
+            self.assertFalse(mock_handle.called)
+            worker.process_events(1120)
+            mock_handle.assert_called_once_with({
+                hamlet.id: [dict(user_profile_id=hamlet.id, message_id=1),
+                            dict(user_profile_id=hamlet.id, message_id=3)],
+                othello.id: [dict(user_profile_id=othello.id, message_id=2)],
+            })
+            mock_handle.reset_mock()
+
+            send(othello, 4)
+            worker.process_events(1130)
+            # Othello's new batch started at 1130; stopping the worker
+            # sends it early rather than dropping it.
+            worker.process_events(1200)
+            self.assertFalse(mock_handle.called)
+            worker.stop()
+            mock_handle.assert_called_once_with(
+                {othello.id: [dict(user_profile_id=othello.id, message_id=4)]})
+
+    def test_queue_stats(self):
+        # type: () -> None
+        processed = [] # type: List[Mapping[str, Any]]
+
+        @queue_processors.assign_queue('stats_worker')
+        class StatsWorker(queue_processors.QueueProcessingWorker):
+            def consume(self, data):
+                # type: (Mapping[str, Any]) -> None
+                if data["type"] == 'bad':
+                    raise Exception('Worker task not performing as expected!')
+                processed.append(data)
+
+            def _log_problem(self):
+                # type: () -> None
+                pass
+
+        event = {'type': 'good'}
+        stamped = stamp_enqueue_time(event)
+        self.assertNotIn('enqueued_at', event)
+        stamped['enqueued_at'] -= 2
+
+        fake_client = self.FakeClient()
+        fake_client.queue.append(('stats_worker', stamped))
+        fake_client.queue.append(('stats_worker', {'type': 'bad'}))
+
+        clear_queue_stats('stats_worker')
+        with simulated_queue_client(lambda: fake_client), \
+                patch('zerver.lib.queue_stats.statsd') as mock_statsd:
+            worker = StatsWorker()
+            worker.setup()
+            worker.start()
+            worker.stats.flush()
+
+        # The worker never sees the enqueue stamp.
+        self.assertEqual(processed, [{'type': 'good'}])
+        mock_statsd.incr.assert_any_call('queue_worker.stats_worker.errors', 1)
+        latency_ms = mock_statsd.timing.call_args_list[0][0][1]
+        self.assertTrue(2000 <= latency_ms < 3000)
+
+        stats = get_queue_stats('stats_worker')
+        self.assertEqual(stats['events'], 2)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['latency_count'], 1)
+        self.assertEqual(stats['latency_le_10000'], 1)
+        self.assertEqual(stats['consume_count'], 2)
+        self.assertEqual(histogram_percentile(stats, 'latency', 99), 10000)
+        clear_queue_stats('stats_worker')
+
     def test_worker_noname(self):
         # type: () -> None
         class TestWorker(queue_processors.QueueProcessingWorker):
@@ -627,6 +872,150 @@ class WorkerTest(TestCase):
             worker = TestWorker()
             worker.consume({})
 
+class QueuePublisherTest(TestCase):
+    def test_publish_order(self):
+        # type: () -> None
+        broker = InMemoryQueueClient()
+        publisher = QueuePublisher(lambda: broker)
+        publisher.publish_many([('queue_%d' % (i % 4,), str(i)) for i in range(100)])
+        for j in range(4):
+            self.assertEqual(broker.queues['queue_%d' % (j,)],
+                             [str(i) for i in range(j, 100, 4)])
+
+    def test_publish_retries(self):
+        # type: () -> None
+        class UnreliableBroker(InMemoryQueueClient):
+            attempts = 0
+
+            def publish_many(self, messages):
+                # type: (List[Tuple[str, str]]) -> None
+                self.attempts += 1
+                if self.attempts == 1 or ('queue', 'doomed') in messages:
+                    raise pika.exceptions.AMQPConnectionError()
+                super(UnreliableBroker, self).publish_many(messages)
+
+        broker = UnreliableBroker()
+        connections = [] # type: List[InMemoryQueueClient]
+
+        def connect():
+            # type: () -> InMemoryQueueClient
+            connections.append(broker)
+            return broker
+
+        publisher = QueuePublisher(connect)
+        with patch('logging.Logger.warning'), patch('logging.Logger.error') as mock_error:
+            publisher.publish_many([('queue', 'first'), ('queue', 'second')])
+            self.assertEqual(broker.queues['queue'], ['first', 'second'])
+            self.assertEqual(len(connections), 2)
+            self.assertEqual(mock_error.call_count, 0)
+
+            publisher.publish_many([('queue', 'doomed')])
+        self.assertEqual(broker.queues['queue'], ['first', 'second'])
+        self.assertEqual(broker.attempts, 2 + PUBLISH_ATTEMPTS)
+        self.assertEqual(mock_error.call_count, 1)
+
+    def test_transaction_not_reconnected_mid_batch(self):
+        # type: () -> None
+        with patch('pika.BlockingConnection') as mock_connection_class, \
+                patch.object(TransactionalQueueClient, '_get_parameters'):
+            connection = mock_connection_class.return_value
+            connection.is_open = True
+            channel = connection.channel.return_value
+            channel.is_open = True
+            client = TransactionalQueueClient()
+
+            def lose_connection(**kwargs):
+                # type: (**Any) -> None
+                connection.is_open = False
+            channel.basic_publish.side_effect = lose_connection
+
+            with self.assertRaises(pika.exceptions.AMQPConnectionError):
+                client.publish_many([('queue', 'first'), ('queue', 'second')])
+        # The transaction holding 'first' is gone, so we mustn't have
+        # carried on with 'second' over a new connection.
+        self.assertEqual(mock_connection_class.call_count, 1)
+        self.assertEqual(channel.basic_publish.call_count, 1)
+        self.assertFalse(channel.tx_commit.called)
+
+    def test_request_batching(self):
+        # type: () -> None
+        broker = InMemoryQueueClient()
+        publisher = QueuePublisher(lambda: broker)
+        with override_settings(USING_RABBITMQ=True), \
+                patch('zerver.lib.queue.get_queue_publisher', return_value=publisher), \
+                patch.object(broker, 'publish_many', wraps=broker.publish_many) as mock_publish:
+            start_publish_batch()
+            event = {'type': 'first'}
+            queue_json_publish('queue', event, lambda event: None)
+            event['type'] = 'modified'
+            queue_json_publish('other_queue', {'type': 'second'}, lambda event: None)
+            self.assertEqual(broker.queues['queue'], [])
+
+            flush_publish_batch()
+        # Everything is published, in one round trip, by the end of the request.
+        self.assertEqual(mock_publish.call_count, 1)
+        self.assertEqual([ujson.loads(body)['type'] for body in broker.queues['queue']],
+                         ['first'])
+        self.assertEqual([ujson.loads(body)['type'] for body in broker.queues['other_queue']],
+                         ['second'])
+        self.assertIn('enqueued_at', ujson.loads(broker.queues['queue'][0]))
+
+class QueueSupervisorTest(TestCase):
+    def test_desired_worker_count(self):
+        # type: () -> None
+        # A deep queue gets another worker, up to max_workers.
+        self.assertEqual(desired_worker_count(1, 500, 0, 0, 1, 4), 2)
+        self.assertEqual(desired_worker_count(4, 5000, 0, 0, 1, 4), 4)
+        # So does a shallow queue whose messages have been waiting a while.
+        self.assertEqual(desired_worker_count(2, 5, 30, 0, 1, 4), 3)
+        self.assertEqual(desired_worker_count(2, 5, 1, 0, 1, 4), 2)
+        # An idle queue loses workers, down to min_workers.
+        self.assertEqual(desired_worker_count(3, 0, 0, 120, 1, 4), 2)
+        self.assertEqual(desired_worker_count(3, 0, 0, 10, 1, 4), 3)
+        self.assertEqual(desired_worker_count(1, 0, 0, 120, 1, 4), 1)
+
+    def test_max_workers(self):
+        # type: () -> None
+        self.assertEqual(queue_processors.get_worker('embed_links').max_workers, 4)
+        self.assertEqual(queue_processors.get_worker('signups').max_workers, 1)
+        self.assertEqual(queue_processors.get_worker('message_sender').max_workers, 1)
+
+    def test_fixed_worker_count(self):
+        # type: () -> None
+        supervisor = QueueWorkerSupervisor(['embed_links', 'missedmessage_emails', 'message_sender'],
+                                           num_workers=4)
+        self.assertEqual(supervisor.worker_limits('embed_links'), (4, 4))
+        # Queues which need a single consumer keep it.
+        self.assertEqual(supervisor.worker_limits('missedmessage_emails'), (1, 1))
+        self.assertEqual(supervisor.worker_limits('message_sender'), (1, 1))
+
+    def test_queue_depth_error(self):
+        # type: () -> None
+        supervisor = QueueWorkerSupervisor(['signups'])
+        supervisor.q = MagicMock()
+        supervisor.q.get_queue_depth.side_effect = Exception("connection reset")
+        with patch.object(supervisor, 'spawn_worker') as spawn_worker, \
+                patch.object(supervisor.log, 'exception') as log_exception:
+            supervisor.scale('signups', time.time())
+        # We keep the minimum number of workers running.
+        spawn_worker.assert_called_once_with('signups')
+        self.assertTrue(log_exception.called)
+
+    def test_stop_gracefully(self):
+        # type: () -> None
+        worker = queue_processors.get_worker('signups')
+        worker.q = MagicMock()
+
+        worker.busy = True
+        worker.stop_gracefully()
+        self.assertFalse(worker.q.stop_consuming.called)
+        self.assertTrue(worker.stop_requested)
+
+        with patch.object(worker, 'consume'):
+            worker.consume_wrapper({})
+        self.assertFalse(worker.busy)
+        worker.q.stop_consuming.assert_called_once_with()
+
 class DocPageTest(ZulipTestCase):
         def _test(self, url, expected_content):
             # type: (str, str) -> None
@@ -2307,6 +2696,87 @@ class TestMissedMessages(ZulipTestCase):
         # type: () -> None
         self._extra_context_in_huddle_missed_stream_messages(False)
 
+    @patch('zerver.lib.email_mirror.generate_random_token')
+    def test_bulk_missed_message_emails(self, mock_random_token):
+        # type: (MagicMock) -> None
+        mock_random_token.side_effect = self._get_tokens()
+        emails = ['hamlet@zulip.com', 'iago@zulip.com', 'cordelia@zulip.com']
+        for email in emails:
+            self.subscribe_to_stream(email, 'Denmark')
+        for i in range(3):
+            self.send_message("othello@zulip.com", "Denmark", Recipient.STREAM, 'context %d' % (i,))
+        msg_id = self.send_message("othello@zulip.com", "Denmark", Recipient.STREAM, '@**all** look')
+        pm_id = self.send_message("othello@zulip.com", "iago@zulip.com", Recipient.PERSONAL,
+                                  'Extremely personal message!')
+
+        users = [get_user_profile_by_email(email) for email in emails]
+        for user in users:
+            user.last_reminder = None
+            user.save(update_fields=['last_reminder'])
+        events = {user.id: [{'message_id': msg_id}] for user in users}
+        events[users[1].id].append({'message_id': pm_id})
+        hamlet_events = {users[0].id: events[users[0].id]}
+
+        # Warm the caches first.
+        handle_missedmessage_emails_for_users(hamlet_events)
+        query_counts = []
+        for batch in [hamlet_events, events]:
+            del mail.outbox[:]
+            with queries_captured() as queries:
+                handle_missedmessage_emails_for_users(batch)
+            # Apart from a write per email for its unsubscribe link,
+            # the number of queries doesn't depend on the batch.
+            query_counts.append(len(queries) - len(mail.outbox))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+        self.assertEqual(sorted(msg.to[0] for msg in mail.outbox),
+                         ['cordelia@zulip.com', 'hamlet@zulip.com',
+                          'iago@zulip.com', 'iago@zulip.com'])
+        stream_body = ('Denmark > test Othello, the Moor of Venice '
+                       'context 0 context 1 context 2 @**all** look')
+        bodies = [self.normalize_string(msg.body) for msg in mail.outbox]
+        self.assertEqual(len([body for body in bodies if stream_body in body]), 3)
+        self.assertEqual(len([body for body in bodies if
+                              'You and Othello, the Moor of Venice Extremely personal message!' in body]), 1)
+        for user in users:
+            self.assertIsNotNone(get_user_profile_by_email(user.email).last_reminder)
+
+    def test_missed_message_email_failures_isolated(self):
+        # type: () -> None
+        emails = ['hamlet@zulip.com', 'iago@zulip.com', 'cordelia@zulip.com']
+        msg_id = self.send_message("othello@zulip.com", emails, Recipient.HUDDLE, 'huddle message')
+        users = [get_user_profile_by_email(email) for email in emails]
+        for user in users:
+            user.last_reminder = None
+            user.save(update_fields=['last_reminder'])
+
+        render = MissedMessageEmailRenderer.render
+
+        def render_or_fail(renderer, user_profile, missed_messages, message_count):
+            # type: (MissedMessageEmailRenderer, UserProfile, List[Message], int) -> Any
+            if user_profile.email == 'iago@zulip.com':
+                raise Exception("Rendering failed")
+            return render(renderer, user_profile, missed_messages, message_count)
+
+        del mail.outbox[:]
+        with patch.object(MissedMessageEmailRenderer, 'render', render_or_fail), \
+                patch('logging.exception') as mock_exception:
+            failed_user_ids = handle_missedmessage_emails_for_users(
+                {user.id: [{'message_id': msg_id}] for user in users})
+
+        # Iago's failure doesn't stop the others' emails, and only the
+        # users who were sent an email were reminded.
+        self.assertEqual(failed_user_ids, [users[1].id])
+        self.assertEqual(mock_exception.call_count, 1)
+        self.assertEqual(sorted(msg.to[0] for msg in mail.outbox),
+                         ['cordelia@zulip.com', 'hamlet@zulip.com'])
+        for user in users:
+            last_reminder = get_user_profile_by_email(user.email).last_reminder
+            if user.email == 'iago@zulip.com':
+                self.assertIsNone(last_reminder)
+            else:
+                self.assertIsNotNone(last_reminder)
+
 
 class TestOpenRealms(ZulipTestCase):
     def test_open_realm_logic(self):
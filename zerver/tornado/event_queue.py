@@ -1,5 +1,5 @@
 from __future__ import absolute_import
-from typing import cast, AbstractSet, Any, Optional, Iterable, Sequence, Mapping, MutableMapping, Callable, Union, Text
+from typing import cast, AbstractSet, Any, Dict, List, Optional, Iterable, Sequence, Mapping, MutableMapping, Callable, Union, Text
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
@@ -159,6 +159,33 @@ class ClientDescriptor(object):
             return self.narrow_filter(event)
         return True
 
+    def expand_event(self, event):
+        # type: (Mapping[str, Any]) -> List[Dict[str, Any]]
+        """The events to give this client for `event`.  peer_add events
+        list all of the new subscribers in `user_ids`, but only the
+        webapp (which ships with the server) understands that; other
+        clients, such as the mobile apps, get one event per new
+        subscriber, with its `user_id`, as before.
+
+        Likewise, stream and topic update_message_flags events apply to
+        every message up to `max_id`; the webapp doesn't need the
+        affected ids listed in `messages`, and other clients, which
+        need them, are told to reload when there were too many to list
+        (see do_update_message_flags)."""
+        if event["type"] == "subscription" and event.get("op") == "peer_add" and \
+                self.client_type_name != "website":
+            return [dict(type="subscription", op="peer_add",
+                         subscriptions=event["subscriptions"], user_id=user_id)
+                    for user_id in event["user_ids"]]
+        if event["type"] == "update_message_flags" and "max_id" in event and \
+                not event["all"]:
+            if self.client_type_name == "website":
+                return [dict(event, messages=[])]
+            if not event["messages"]:
+                return [dict(type="restart", server_generation=settings.SERVER_GENERATION,
+                             immediate=True)]
+        return [dict(event)]
+
     # TODO: Refactor so we don't need this function
     def accepts_messages(self):
         # type: () -> bool
@@ -223,6 +250,10 @@ def compute_full_event_type(event):
         if event["all"]:
             # Put the "all" case in its own category
             return "all_flags/%s/%s" % (event["flag"], event["operation"])
+        if "max_id" in event:
+            # Updates to a whole stream or topic apply to a range of
+            # messages, so they can't be merged with lists of message ids.
+            return "range_flags/%s/%s" % (event["flag"], event["operation"])
         return "flags/%s/%s" % (event["operation"], event["flag"])
     return event["type"]
 
@@ -777,7 +808,8 @@ def process_event(event, users):
     for user_profile_id in users:
         for client in get_client_descriptors_for_user(user_profile_id):
             if client.accepts_event(event):
-                client.add_event(dict(event))
+                for client_event in client.expand_event(event):
+                    client.add_event(client_event)
 
 def process_userdata_event(event_template, users):
     # type: (Mapping[str, Any], Iterable[Mapping[str, Any]]) -> None
@@ -794,6 +826,12 @@ def process_userdata_event(event_template, users):
 
 def process_notification(notice):
     # type: (Mapping[str, Any]) -> None
+    if 'notices' in notice:
+        # A batch of notices sent together via send_events.
+        for batched_notice in notice['notices']:
+            process_notification(batched_notice)
+        return
+
     event = notice['event'] # type: Mapping[str, Any]
     users = notice['users'] # type: Union[Iterable[int], Iterable[Mapping[str, Any]]]
     if event['type'] in ["update_message"]:
@@ -829,3 +867,29 @@ def send_event(event, users):
     queue_json_publish("notify_tornado",
                        dict(event=event, users=users),
                        send_notification_http)
+
+# Each notification sent by send_events carries at most this many
+# notices, for at most this many users in total, so that a bulk change
+# in a large realm doesn't become one huge message.
+SEND_EVENTS_MAX_NOTICES = 100
+SEND_EVENTS_MAX_USERS = 10000
+
+def send_events(notices):
+    # type: (Sequence[Mapping[str, Any]]) -> None
+    """Sends several events to Tornado in a few notifications.
+    `notices` is a list of dicts with `event` and `users` keys, in the
+    same format as the arguments to send_event; the events are
+    processed in order."""
+    chunk = [] # type: List[Mapping[str, Any]]
+    chunk_users = 0
+    for notice in notices:
+        num_users = len(notice['users'])
+        if chunk and (len(chunk) >= SEND_EVENTS_MAX_NOTICES or
+                      chunk_users + num_users > SEND_EVENTS_MAX_USERS):
+            queue_json_publish("notify_tornado", dict(notices=chunk), send_notification_http)
+            chunk = []
+            chunk_users = 0
+        chunk.append(notice)
+        chunk_users += num_users
+    if chunk:
+        queue_json_publish("notify_tornado", dict(notices=chunk), send_notification_http)
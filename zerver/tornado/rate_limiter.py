@@ -0,0 +1,157 @@
+from __future__ import absolute_import
+from __future__ import division
+
+from django.conf import settings
+from typing import Dict, Optional, Text, Tuple
+
+from zerver.lib.rate_limiter import client as redis_client, redis_key
+from zerver.lib.utils import statsd
+from zerver.models import UserProfile
+
+import logging
+import time
+import tornado.ioloop
+
+# How often each limiter picks up manual blocks from redis, and records
+# how often it throttled each user there.
+SYNC_INTERVAL_SECONDS = 10
+# How long we keep the counts of throttled requests in redis.
+THROTTLED_COUNTS_TTL_SECONDS = 24 * 60 * 60
+
+def throttled_counts_redis_key(domain):
+    # type: (Text) -> Text
+    return "tornado_throttled:%s" % (domain,)
+
+class TornadoRateLimiter(object):
+    """Limits each user's requests of one kind (`domain`) to this Tornado
+    process, with a token bucket per user, as configured in
+    settings.TORNADO_RATE_LIMITS.
+
+    A request which arrives when the user's bucket is empty reserves the
+    next token; the caller delays it until then (without blocking the
+    IOLoop), or if that's more than settings.TORNADO_RATE_LIMIT_MAX_DELAY
+    away, rejects it.  Since Tornado handles every request on a single
+    IOLoop, the buckets are only kept in this process, and checking a
+    request never waits on redis.  Instead, sync() makes a single round
+    trip every SYNC_INTERVAL_SECONDS, to pick up users blocked with
+    `./manage.py rate_limit --domain=<domain>`, and to record how often
+    each user was throttled."""
+
+    def __init__(self, domain):
+        # type: (Text) -> None
+        self.domain = domain
+        # user id -> (tokens, when we last refilled them)
+        self.buckets = {} # type: Dict[int, Tuple[float, float]]
+        # user id -> the user's redis blocking key, for the users we've seen
+        self.blocking_keys = {} # type: Dict[int, Text]
+        # user id -> when their manual block ends
+        self.blocked_until = {} # type: Dict[int, float]
+        # user id -> requests throttled since the last sync
+        self.throttled = {} # type: Dict[int, int]
+
+    def reserve(self, user_profile, now=None):
+        # type: (UserProfile, Optional[float]) -> Tuple[bool, float]
+        """Takes a token for one of the user's requests.  Returns (allowed,
+        delay): if allowed, the request should be processed after delay
+        seconds; otherwise, it should be rejected, and the user told to
+        retry after delay seconds."""
+        if now is None:
+            now = time.time()
+        user_id = user_profile.id
+        if user_id not in self.blocking_keys:
+            self.blocking_keys[user_id] = redis_key(user_profile, self.domain)[2]
+
+        blocked_until = self.blocked_until.get(user_id)
+        if blocked_until is not None:
+            if blocked_until > now:
+                self.record_throttled(user_id, 'rejected')
+                return False, blocked_until - now
+            del self.blocked_until[user_id]
+
+        capacity, refill_rate = settings.TORNADO_RATE_LIMITS[self.domain]
+        (tokens, last_refill) = self.buckets.get(user_id, (capacity, now))
+        tokens = min(capacity, tokens + (now - last_refill) * refill_rate)
+        if tokens >= 1:
+            self.buckets[user_id] = (tokens - 1, now)
+            return True, 0.0
+
+        delay = (1 - tokens) / refill_rate
+        if delay > settings.TORNADO_RATE_LIMIT_MAX_DELAY:
+            self.buckets[user_id] = (tokens, now)
+            self.record_throttled(user_id, 'rejected')
+            return False, delay
+
+        # Take the token the bucket will have after the delay, so that
+        # the next request waits for the one after it.
+        self.buckets[user_id] = (tokens - 1, now)
+        self.record_throttled(user_id, 'delayed')
+        return True, delay
+
+    def record_throttled(self, user_id, action):
+        # type: (int, str) -> None
+        statsd.incr("tornado.throttled.%s.%s" % (self.domain, action))
+        self.throttled[user_id] = self.throttled.get(user_id, 0) + 1
+
+    def sync(self):
+        # type: () -> None
+        now = time.time()
+        capacity, refill_rate = settings.TORNADO_RATE_LIMITS[self.domain]
+        # Forget the users whose buckets have refilled, unless they're
+        # blocked; we'll start them with a full bucket if they come back.
+        for user_id in list(self.blocking_keys.keys()):
+            if user_id in self.blocked_until:
+                continue
+            (tokens, last_refill) = self.buckets.get(user_id, (capacity, now))
+            if tokens + (now - last_refill) * refill_rate >= capacity:
+                self.buckets.pop(user_id, None)
+                del self.blocking_keys[user_id]
+
+        throttled = self.throttled
+        self.throttled = {}
+        user_ids = list(self.blocking_keys.keys())
+        if not user_ids and not throttled:
+            return
+
+        counts_key = throttled_counts_redis_key(self.domain)
+        with redis_client.pipeline() as pipe:
+            for user_id in user_ids:
+                pipe.ttl(self.blocking_keys[user_id])
+            for user_id, count in throttled.items():
+                pipe.hincrby(counts_key, user_id, count)
+            if throttled:
+                pipe.expire(counts_key, THROTTLED_COUNTS_TTL_SECONDS)
+            results = pipe.execute()
+
+        for user_id, ttl in zip(user_ids, results):
+            if ttl is None or ttl == -2:
+                # Not blocked.
+                self.blocked_until.pop(user_id, None)
+            elif ttl < 0:
+                # Blocked without an expiry; check again at the next sync.
+                self.blocked_until[user_id] = now + SYNC_INTERVAL_SECONDS
+            else:
+                self.blocked_until[user_id] = now + ttl
+
+        if throttled:
+            logging.info("Throttled %d %s requests from %d users" % (
+                sum(throttled.values()), self.domain, len(throttled)))
+
+    def start(self):
+        # type: () -> None
+        ioloop = tornado.ioloop.IOLoop.instance()
+        tornado.ioloop.PeriodicCallback(self.sync, SYNC_INTERVAL_SECONDS * 1000, ioloop).start()
+
+events_rate_limiter = TornadoRateLimiter('events')
+socket_rate_limiter = TornadoRateLimiter('socket')
+
+def setup_tornado_rate_limiters():
+    # type: () -> None
+    events_rate_limiter.start()
+    socket_rate_limiter.start()
+
+def get_throttled_counts(domain):
+    # type: (Text) -> Dict[int, int]
+    """How many requests of this kind we throttled for each user, over
+    (about) the last day."""
+    counts = redis_client.hgetall(throttled_counts_redis_key(domain))
+    return dict((int(user_id), int(count)) for user_id, count in counts.items())
@@ -30,6 +30,7 @@ from zerver.middleware import record_request_start_data, record_request_stop_dat
 from zerver.lib.redis_utils import get_redis_client
 from zerver.lib.session_user import get_session_user
 from zerver.tornado.event_queue import get_client_descriptor
+from zerver.tornado.rate_limiter import socket_rate_limiter
 
 logger = logging.getLogger('zulip.socket')
 
@@ -211,6 +212,30 @@ class SocketConnection(sockjs.tornado.SockJSConnection):
                                status_code=403, error_content=ujson.dumps(response))
                 return
 
+        if settings.RATE_LIMITING:
+            (allowed, delay) = socket_rate_limiter.reserve(self.session.user_profile)
+            if not allowed:
+                log_data['extra'] += ']'
+                response = {'result': 'error', 'retry_after': delay,
+                            'msg': "API usage exceeded rate limit, try again in %s secs" % (delay,)}
+                self.session.send_message({'req_id': msg['req_id'], 'type': 'response',
+                                           'response': response})
+                write_log_line(log_data, path='/socket/service_request', method='SOCKET',
+                               remote_ip=self.session.conn_info.ip,
+                               email=self.session.user_profile.email, client_name='?',
+                               status_code=429, error_content=ujson.dumps(response))
+                return
+            if delay > 0:
+                # Hold this request back until the user has a token,
+                # without blocking the IOLoop.
+                ioloop = tornado.ioloop.IOLoop.instance()
+                ioloop.add_timeout(time.time() + delay, lambda: self.send_request(msg, log_data))
+                return
+
+        self.send_request(msg, log_data)
+
+    def send_request(self, msg, log_data):
+        # type: (Dict[str, Any], Dict[str, Any]) -> None
         redis_key = req_redis_key(msg['req_id'])
         with redis_client.pipeline() as pipeline:
             pipeline.hmset(redis_key, {'status': 'received'})
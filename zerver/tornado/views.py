@@ -5,18 +5,27 @@ from django.http import HttpRequest, HttpResponse
 
 from zerver.models import get_client, UserProfile, Client
 
+from django.conf import settings
+
 from zerver.decorator import asynchronous, \
     authenticated_json_post_view, internal_notify_view, RespondAsynchronously, \
-    has_request_variables, REQ, _RespondAsynchronously
+    has_request_variables, REQ, _RespondAsynchronously, \
+    client_is_exempt_from_rate_limiting
+from zerver.exceptions import RateLimited
+from zerver.middleware import async_request_restart
 
 from zerver.lib.response import json_success, json_error
 from zerver.lib.validator import check_bool, check_list, check_string
 from zerver.tornado.event_queue import get_client_descriptor, \
     process_notification, fetch_events
+from zerver.tornado.handlers import clear_handler_by_id
+from zerver.tornado.rate_limiter import events_rate_limiter
 from django.core.handlers.base import BaseHandler
 
-from typing import Union, Optional, Iterable, Sequence, List, Text
+from typing import Any, Dict, Union, Optional, Iterable, Sequence, List, Text
+import logging
 import time
+import tornado.ioloop
 import ujson
 
 @internal_notify_view
@@ -79,6 +88,20 @@ def get_events_backend(request, user_profile, handler,
             last_connection_time = time.time(),
             narrow = narrow)
 
+    if settings.RATE_LIMITING and not client_is_exempt_from_rate_limiting(request):
+        (allowed, delay) = events_rate_limiter.reserve(user_profile)
+        if not allowed:
+            request._ratelimit_secs_to_freedom = delay
+            raise RateLimited()
+        if delay > 0:
+            # Hold this request back until the user has a token, without
+            # blocking the IOLoop.
+            handler._request = request
+            tornado.ioloop.IOLoop.instance().add_timeout(
+                time.time() + delay,
+                lambda: fetch_delayed_events(handler, request, events_query, apply_markdown))
+            return RespondAsynchronously
+
     result = fetch_events(events_query)
     if "extra_log_data" in result:
         request._log_data['extra'] = result["extra_log_data"]
@@ -89,3 +112,29 @@ def get_events_backend(request, user_profile, handler,
     if result["type"] == "error":
         return json_error(result["message"])
     return json_success(result["response"])
+
+def fetch_delayed_events(handler, request, events_query, apply_markdown):
+    # type: (BaseHandler, HttpRequest, Dict[str, Any], bool) -> None
+    """Finishes a get_events request which was delayed by rate limiting."""
+    try:
+        async_request_restart(request)
+        result = fetch_events(events_query)
+        if "extra_log_data" in result:
+            request._log_data['extra'] = result["extra_log_data"]
+
+        if result["type"] == "async":
+            # The request is now waiting on its event queue, which will
+            # finish it.
+            return
+        if result["type"] == "error":
+            response = dict(result='error', msg=result["message"])
+        else:
+            response = dict(result='success', msg='', **result["response"])
+        handler.zulip_finish(response, request, apply_markdown=apply_markdown)
+    except IOError as e:
+        # The client may have gone away while we were waiting.
+        if str(e) != 'Stream is closed':
+            logging.exception("Got error finishing delayed get_events request")
+    except Exception:
+        logging.exception("Got error finishing delayed get_events request")
+    clear_handler_by_id(handler.handler_id)
@@ -39,12 +39,13 @@ def events_register_backend(request, user_profile, apply_markdown=True,
                             all_public_streams=None,
                             event_types=REQ(validator=check_list(check_string), default=None),
                             narrow=REQ(validator=check_list(check_list(check_string, length=2)), default=[]),
-                            queue_lifespan_secs=REQ(converter=int, default=0)):
-    # type: (HttpRequest, UserProfile, bool, Optional[bool], Optional[Iterable[str]], Iterable[Sequence[Text]], int) -> HttpResponse
+                            queue_lifespan_secs=REQ(converter=int, default=0),
+                            state_version=REQ(validator=check_string, default=None)):
+    # type: (HttpRequest, UserProfile, bool, Optional[bool], Optional[Iterable[str]], Iterable[Sequence[Text]], int, Optional[Text]) -> HttpResponse
     all_public_streams = _default_all_public_streams(user_profile, all_public_streams)
     narrow = _default_narrow(user_profile, narrow)
 
     ret = do_events_register(user_profile, request.client, apply_markdown,
                              event_types, queue_lifespan_secs, all_public_streams,
-                             narrow=narrow)
+                             narrow=narrow, state_version=state_version)
     return json_success(ret)
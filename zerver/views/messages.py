@@ -510,7 +510,18 @@ def get_old_messages_backend(request, user_profile,
     include_history = ok_to_include_history(narrow, user_profile.realm)
 
     if include_history and not use_first_unread_anchor:
-        query = select([column("id").label("message_id")], None, "zerver_message")
+        # We LEFT OUTER JOIN against the user's UserMessage rows so
+        # that we get the flags for messages the user received in the
+        # same query; historical messages come back with NULL flags.
+        query = select([literal_column("zerver_message.id").label("message_id"),
+                        column("flags")],
+                       None,
+                       join("zerver_message", "zerver_usermessage",
+                            and_(literal_column("zerver_usermessage.message_id") ==
+                                 literal_column("zerver_message.id"),
+                                 literal_column("zerver_usermessage.user_profile_id") ==
+                                 literal(user_profile.id)),
+                            isouter=True))
         inner_msg_id_col = literal_column("zerver_message.id")
     elif narrow is None:
         query = select([column("message_id"), column("flags")],
@@ -614,43 +625,30 @@ def get_old_messages_backend(request, user_profile,
     query = query.prefix_with("/* get_old_messages */")
     query_result = list(sa_conn.execute(query).fetchall())
 
-    # The following is a little messy, but ensures that the code paths
-    # are similar regardless of the value of include_history.  The
-    # 'user_messages' dictionary maps each message to the user's
-    # UserMessage object for that message, which we will attach to the
-    # rendered message dict before returning it.  We attempt to
-    # bulk-fetch rendered message dicts from remote cache using the
-    # 'messages' list.
+    # The 'user_message_flags' dictionary maps each message to the
+    # user's flags for that message, which we will attach to the
+    # rendered message dict before returning it.  When we're including
+    # history, messages the user never received have NULL flags and
+    # are marked as read and historical.  We attempt to bulk-fetch
+    # rendered message dicts from remote cache using the 'message_ids'
+    # list.
     search_fields = dict() # type: Dict[int, Dict[str, Text]]
     message_ids = [] # type: List[int]
     user_message_flags = {} # type: Dict[int, List[str]]
-    if include_history:
-        message_ids = [row[0] for row in query_result]
-
-        # TODO: This could be done with an outer join instead of two queries
-        user_message_flags = dict((user_message.message_id, user_message.flags_list()) for user_message in
-                                  UserMessage.objects.filter(user_profile=user_profile,
-                                                             message__id__in=message_ids))
-        for row in query_result:
-            message_id = row[0]
-            if user_message_flags.get(message_id) is None:
-                user_message_flags[message_id] = ["read", "historical"]
-            if is_search:
-                (_, subject, rendered_content, content_matches, subject_matches) = row
-                search_fields[message_id] = get_search_fields(rendered_content, subject,
-                                                              content_matches, subject_matches)
-    else:
-        for row in query_result:
-            message_id = row[0]
-            flags = row[1]
+    for row in query_result:
+        message_id = row[0]
+        flags = row[1]
+        if flags is None:
+            user_message_flags[message_id] = ["read", "historical"]
+        else:
             user_message_flags[message_id] = parse_usermessage_flags(flags)
 
-            message_ids.append(message_id)
+        message_ids.append(message_id)
 
-            if is_search:
-                (_, _, subject, rendered_content, content_matches, subject_matches) = row
-                search_fields[message_id] = get_search_fields(rendered_content, subject,
-                                                              content_matches, subject_matches)
+        if is_search:
+            (_, _, subject, rendered_content, content_matches, subject_matches) = row
+            search_fields[message_id] = get_search_fields(rendered_content, subject,
+                                                          content_matches, subject_matches)
 
     cache_transformer = lambda row: MessageDict.build_dict_from_raw_db_row(row, apply_markdown)
     id_fetcher = lambda row: row['id']
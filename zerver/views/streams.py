@@ -343,6 +343,7 @@ def get_topics_backend(request, user_profile,
     result = get_topic_history_for_stream(
         user_profile=user_profile,
         recipient=recipient,
+        stream=stream,
     )
 
     # Our data structure here is a list of tuples of
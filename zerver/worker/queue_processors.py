@@ -1,5 +1,5 @@
 from __future__ import absolute_import
-from typing import Any, Callable, Mapping
+from typing import Any, Callable, Dict, List, Mapping, Optional, Set, Text, Tuple
 
 from django.conf import settings
 from django.core.handlers.wsgi import WSGIRequest
@@ -10,15 +10,16 @@ from zerver.models import get_user_profile_by_email, \
 from zerver.lib.context_managers import lockfile
 from zerver.lib.error_notify import do_report_error
 from zerver.lib.queue import SimpleQueueClient, queue_json_publish
+from zerver.lib.queue_stats import QueueStats
 from zerver.lib.timestamp import timestamp_to_datetime
-from zerver.lib.notifications import handle_missedmessage_emails, enqueue_welcome_emails, \
+from zerver.lib.notifications import handle_missedmessage_emails_for_users, enqueue_welcome_emails, \
     clear_followup_emails_queue, send_local_email_template_with_delay
 from zerver.lib.actions import do_send_confirmation_email, \
-    do_update_user_activity, do_update_user_activity_interval, do_update_user_presence, \
+    do_update_user_activities, do_update_user_activity_intervals, do_update_user_presence, \
     internal_send_message, check_send_message, extract_recipients, \
-    handle_push_notification, render_incoming_message, do_update_embedded_data
+    handle_push_notifications, render_incoming_message, bulk_update_embedded_data
 from zerver.lib.url_preview import preview as url_preview
-from zerver.lib.digest import handle_digest_email
+from zerver.lib.digest import handle_digest_email, handle_digest_emails
 from zerver.lib.email_mirror import process_message as mirror_email
 from zerver.decorator import JsonableError
 from zerver.tornado.socket import req_redis_key
@@ -31,8 +32,9 @@ from zerver.context_processors import common_context
 import os
 import sys
 import ujson
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 import email
+import heapq
 import time
 import datetime
 import logging
@@ -43,11 +45,17 @@ from six.moves import cStringIO as StringIO
 class WorkerDeclarationException(Exception):
     pass
 
-def assign_queue(queue_name, enabled=True):
-    # type: (str, bool) -> Callable[[QueueProcessingWorker], QueueProcessingWorker]
+def assign_queue(queue_name, enabled=True, max_workers=1):
+    # type: (str, bool, int) -> Callable[[QueueProcessingWorker], QueueProcessingWorker]
+    """`max_workers` is the most consumer processes the queue worker
+    supervisor (see zerver/worker/supervisor.py) will run for this
+    queue.  Workers which drain their queue on a timer, rather than
+    consuming it, must leave it at 1, as must queues whose events have
+    to be processed in the order they were sent."""
     def decorate(clazz):
         # type: (QueueProcessingWorker) -> QueueProcessingWorker
         clazz.queue_name = queue_name
+        clazz.max_workers = max_workers
         if enabled:
             register_worker(queue_name, clazz)
         return clazz
@@ -68,33 +76,84 @@ def get_active_worker_queues():
 
 class QueueProcessingWorker(object):
     queue_name = None # type: str
+    # Workers which set a batch_size are handed lists of up to that
+    # many events via consume_batch, waiting up to batch_max_wait
+    # seconds for a batch to fill, rather than one event at a time.
+    batch_size = None # type: Optional[int]
+    batch_max_wait = 1.0
+    max_workers = 1
 
     def __init__(self):
         # type: () -> None
         self.q = None # type: SimpleQueueClient
+        self.busy = False
+        self.stop_requested = False
         if self.queue_name is None:
             raise WorkerDeclarationException("Queue worker declared without queue_name")
+        self.stats = QueueStats(self.queue_name)
 
     def consume(self, data):
         # type: (Mapping[str, Any]) -> None
         raise WorkerDeclarationException("No consumer defined!")
 
+    def consume_batch(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        for event in events:
+            self.consume(event)
+
     def consume_wrapper(self, data):
         # type: (Mapping[str, Any]) -> None
+        self.busy = True
+        start = time.time()
+        self.stats.record_latency([data], start)
+        failed = False
         try:
             self.consume(data)
         except Exception:
-            self._log_problem()
-            if not os.path.exists(settings.QUEUE_ERROR_DIR):
-                os.mkdir(settings.QUEUE_ERROR_DIR)
-            fname = '%s.errors' % (self.queue_name,)
-            fn = os.path.join(settings.QUEUE_ERROR_DIR, fname)
-            line = u'%s\t%s\n' % (time.asctime(), ujson.dumps(data))
-            lock_fn = fn + '.lock'
-            with lockfile(lock_fn):
-                with open(fn, 'ab') as f:
-                    f.write(line.encode('utf-8'))
+            failed = True
+            self._handle_consume_exception([data])
+        finally:
+            self.busy = False
+        self.stats.record_consume(1, start, time.time(), failed)
+        reset_queries()
+        if self.stop_requested:
+            self.stop()
+
+    def consume_batch_wrapper(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        self.busy = True
+        start = time.time()
+        self.stats.record_latency(events, start)
+        failed = False
+        try:
+            self.consume_batch(events)
+        except Exception:
+            failed = True
+            self._handle_consume_exception(events)
+        finally:
+            self.busy = False
+        self.stats.record_consume(len(events), start, time.time(), failed)
         reset_queries()
+        if self.stop_requested:
+            self.stop()
+
+    def _handle_consume_exception(self, events):
+        # type: (List[Mapping[str, Any]]) -> None
+        self._log_problem()
+        self._save_failed_events(events)
+
+    def _save_failed_events(self, events):
+        # type: (List[Mapping[str, Any]]) -> None
+        if not os.path.exists(settings.QUEUE_ERROR_DIR):
+            os.mkdir(settings.QUEUE_ERROR_DIR)
+        fname = '%s.errors' % (self.queue_name,)
+        fn = os.path.join(settings.QUEUE_ERROR_DIR, fname)
+        lines = [u'%s\t%s\n' % (time.asctime(), ujson.dumps(event)) for event in events]
+        lock_fn = fn + '.lock'
+        with lockfile(lock_fn):
+            with open(fn, 'ab') as f:
+                for line in lines:
+                    f.write(line.encode('utf-8'))
 
     def _log_problem(self):
         # type: () -> None
@@ -106,13 +165,28 @@ class QueueProcessingWorker(object):
 
     def start(self):
         # type: () -> None
+        if self.batch_size is not None:
+            self.q.consume_json_batches(self.queue_name, self.consume_batch_wrapper,
+                                        self.batch_size, self.batch_max_wait)
+            return
         self.q.register_json_consumer(self.queue_name, self.consume_wrapper)
         self.q.start_consuming()
 
     def stop(self):
         # type: () -> None
+        self.stats.flush()
         self.q.stop_consuming()
 
+    def stop_gracefully(self):
+        # type: () -> None
+        """Stops consuming; if an event is being processed, we finish
+        processing it first, so it gets acknowledged rather than
+        redelivered to another worker."""
+        if self.busy:
+            self.stop_requested = True
+        else:
+            self.stop()
+
 @assign_queue('signups')
 class SignupWorker(QueueProcessingWorker):
     def consume(self, data):
@@ -159,23 +233,38 @@ class ConfirmationEmailWorker(QueueProcessingWorker):
             tags=["invitation-reminders"],
             sender={'email': settings.ZULIP_ADMINISTRATOR, 'name': 'Zulip'})
 
+# The activity workers hold events for a few seconds and coalesce
+# them, so that the number of writes is proportional to the number of
+# distinct keys rather than to the number of requests.
 @assign_queue('user_activity')
 class UserActivityWorker(QueueProcessingWorker):
-    def consume(self, event):
-        # type: (Mapping[str, Any]) -> None
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        client = get_client(event["client"])
-        log_time = timestamp_to_datetime(event["time"])
-        query = event["query"]
-        do_update_user_activity(user_profile, client, query, log_time)
+    batch_size = 1000
+    batch_max_wait = 5.0
+
+    def consume_batch(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        activities = {} # type: Dict[Tuple[int, int, Text], Tuple[int, datetime.datetime]]
+        for event in events:
+            key = (event["user_profile_id"], get_client(event["client"]).id, event["query"])
+            log_time = timestamp_to_datetime(event["time"])
+            if key in activities:
+                (count, last_visit) = activities[key]
+                activities[key] = (count + 1, max(last_visit, log_time))
+            else:
+                activities[key] = (1, log_time)
+        do_update_user_activities(activities)
 
 @assign_queue('user_activity_interval')
 class UserActivityIntervalWorker(QueueProcessingWorker):
-    def consume(self, event):
-        # type: (Mapping[str, Any]) -> None
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        log_time = timestamp_to_datetime(event["time"])
-        do_update_user_activity_interval(user_profile, log_time)
+    batch_size = 1000
+    batch_max_wait = 5.0
+
+    def consume_batch(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        log_times_by_user = defaultdict(list) # type: Dict[int, List[datetime.datetime]]
+        for event in events:
+            log_times_by_user[event["user_profile_id"]].append(timestamp_to_datetime(event["time"]))
+        do_update_user_activity_intervals(log_times_by_user)
 
 @assign_queue('user_presence')
 class UserPresenceWorker(QueueProcessingWorker):
@@ -190,29 +279,114 @@ class UserPresenceWorker(QueueProcessingWorker):
 
 @assign_queue('missedmessage_emails')
 class MissedMessageWorker(QueueProcessingWorker):
-    def start(self):
+    """Batches each user's missed messages into one email.  A user's
+    batch is started by the first missed message notice for them, and
+    sent MISSED_MESSAGE_EMAIL_BATCH_SECONDS later, to let the sender
+    finish sending a batch of messages.  The batches which are due at
+    the same check are sent together, so their emails are rendered and
+    sent in bulk."""
+    # How often we check the queue for new notices.
+    POLL_INTERVAL_SECONDS = 5.0
+
+    def __init__(self):
         # type: () -> None
-        while True:
-            missed_events = self.q.drain_queue("missedmessage_emails", json=True)
-            by_recipient = defaultdict(list) # type: Dict[int, List[Dict[str, Any]]]
+        super(MissedMessageWorker, self).__init__()
+        self.running = True
+        self.pending_events = {} # type: Dict[int, List[Dict[str, Any]]]
+        # A heap of (time the batch is due, user_profile_id).
+        self.batch_deadlines = [] # type: List[Tuple[float, int]]
 
-            for event in missed_events:
-                logging.info("Received event: %s" % (event,))
-                by_recipient[event['user_profile_id']].append(event)
+    def start(self):
+        # type: () -> None
+        while self.running:
+            self.busy = True
+            try:
+                self.process_events(time.time())
+            finally:
+                self.busy = False
+            if self.stop_requested:
+                self.stop()
+                break
+            time.sleep(self.seconds_until_next_check(time.time()))
 
-            for user_profile_id, events in by_recipient.items():
-                handle_missedmessage_emails(user_profile_id, events)
+    def stop(self):
+        # type: () -> None
+        # Rather than dropping the pending batches, send them early.
+        self.running = False
+        self.send_due_batches(time.time(), send_all=True)
+        self.stats.flush()
+
+    def seconds_until_next_check(self, now):
+        # type: (float) -> float
+        if self.batch_deadlines:
+            return max(0, min(self.POLL_INTERVAL_SECONDS, self.batch_deadlines[0][0] - now))
+        return self.POLL_INTERVAL_SECONDS
+
+    def process_events(self, now):
+        # type: (float) -> None
+        missed_events = self.q.drain_queue("missedmessage_emails", json=True)
+        self.stats.record_latency(missed_events, now)
+        for event in missed_events:
+            logging.info("Received event: %s" % (event,))
+            user_profile_id = event['user_profile_id']
+            if user_profile_id not in self.pending_events:
+                self.pending_events[user_profile_id] = []
+                heapq.heappush(self.batch_deadlines,
+                               (now + settings.MISSED_MESSAGE_EMAIL_BATCH_SECONDS, user_profile_id))
+            self.pending_events[user_profile_id].append(event)
+
+        self.send_due_batches(now)
+
+    def send_due_batches(self, now, send_all=False):
+        # type: (float, bool) -> None
+        events_by_user = OrderedDict() # type: Dict[int, List[Dict[str, Any]]]
+        while self.batch_deadlines and (send_all or self.batch_deadlines[0][0] <= now):
+            (deadline, user_profile_id) = heapq.heappop(self.batch_deadlines)
+            events_by_user[user_profile_id] = self.pending_events.pop(user_profile_id)
+        if not events_by_user:
+            return
 
-            reset_queries()
-            # Aggregate all messages received every 2 minutes to let someone finish sending a batch
-            # of messages
-            time.sleep(2 * 60)
+        events = [event for user_events in events_by_user.values() for event in user_events]
+        start = time.time()
+        failed = False
+        try:
+            failed_user_ids = handle_missedmessage_emails_for_users(events_by_user)
+        except Exception:
+            failed = True
+            self._handle_consume_exception(events)
+        else:
+            # The other users' emails were sent; these users' failures
+            # have been logged already.
+            if failed_user_ids:
+                failed = True
+                self._save_failed_events([event for user_profile_id in failed_user_ids
+                                          for event in events_by_user[user_profile_id]])
+        self.stats.record_consume(len(events), start, time.time(), failed)
+        reset_queries()
 
-@assign_queue('missedmessage_mobile_notifications')
+# Missed messages for the same user which arrive within a couple of
+# seconds of each other are sent as a single push notification.
+@assign_queue('missedmessage_mobile_notifications', max_workers=4)
 class PushNotificationsWorker(QueueProcessingWorker):
+    batch_size = 100
+    batch_max_wait = 2.0
+
     def consume(self, data):
         # type: (Mapping[str, Any]) -> None
-        handle_push_notification(data['user_profile_id'], data)
+        self.consume_batch([data])
+
+    def consume_batch(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        by_user = OrderedDict() # type: Dict[int, List[Dict[str, Any]]]
+        for event in events:
+            by_user.setdefault(event['user_profile_id'], []).append(event)
+
+        for user_profile_id, user_events in by_user.items():
+            try:
+                handle_push_notifications(user_profile_id, user_events)
+            except Exception:
+                # Don't hold up the other users' notifications.
+                self._handle_consume_exception(user_events)
 
 def make_feedback_client():
     # type: () -> Any # Should be zulip.Client, but not necessarily importable
@@ -291,6 +465,8 @@ class SlowQueryWorker(QueueProcessingWorker):
     def process_one_batch(self):
         # type: () -> None
         slow_queries = self.q.drain_queue("slow_queries", json=True)
+        start = time.time()
+        self.stats.record_latency(slow_queries, start)
 
         if settings.ERROR_BOT is None:
             return
@@ -305,9 +481,12 @@ class SlowQueryWorker(QueueProcessingWorker):
             error_bot_realm = get_user_profile_by_email(settings.ERROR_BOT).realm
             internal_send_message(error_bot_realm, settings.ERROR_BOT,
                                   "stream", "logs", topic, content)
+            self.stats.record_consume(len(slow_queries), start, time.time())
 
         reset_queries()
 
+# Messages a client sends over its socket must be sent in order, so
+# this queue has a single consumer.
 @assign_queue("message_sender")
 class MessageSenderWorker(QueueProcessingWorker):
     def __init__(self):
@@ -364,8 +543,13 @@ class DigestWorker(QueueProcessingWorker):
     # management command, not here.
     def consume(self, event):
         # type: (Mapping[str, Any]) -> None
-        logging.info("Received digest event: %s" % (event,))
-        handle_digest_email(event["user_profile_id"], event["cutoff"])
+        if "user_profile_ids" in event:
+            logging.info("Received digest event for %d users" % (len(event["user_profile_ids"]),))
+            handle_digest_emails(event["user_profile_ids"], event["cutoff"])
+        else:
+            # Queued by an older version, one user at a time.
+            logging.info("Received digest event: %s" % (event,))
+            handle_digest_email(event["user_profile_id"], event["cutoff"])
 
 @assign_queue('email_mirror')
 class MirrorWorker(QueueProcessingWorker):
@@ -390,31 +574,58 @@ class TestWorker(QueueProcessingWorker):
         with open(fn, 'a') as f:
             f.write(message + '\n')
 
-@assign_queue('embed_links')
+@assign_queue('embed_links', max_workers=4)
 class FetchLinksEmbedData(QueueProcessingWorker):
+    # Messages whose previews are fetched within a couple of seconds of
+    # each other are re-rendered and updated together.
+    batch_size = 50
+    batch_max_wait = 2.0
+
     def consume(self, event):
         # type: (Mapping[str, Any]) -> None
-        for url in event['urls']:
-            url_preview.get_link_embed_data(url)
-
-        message = Message.objects.get(id=event['message_id'])
-        # If the message changed, we will run this task after updating the message
-        # in zerver.views.messages.update_message_backend
-        if message.content != event['message_content']:
+        self.consume_batch([event])
+
+    def consume_batch(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        url_preview.get_link_embed_data_for_urls(
+            [url for event in events for url in event['urls']])
+
+        messages = Message.objects.select_related('sender').in_bulk(
+            [event['message_id'] for event in events])
+        realms = Realm.objects.in_bulk([event['message_realm_id'] for event in events])
+
+        # If a message changed, we will run this task after updating the
+        # message in zerver.views.messages.update_message_backend, so
+        # we only re-render messages which are still as the events saw
+        # them.
+        to_render = {} # type: Dict[int, Tuple[Message, Realm]]
+        for event in events:
+            message = messages.get(event['message_id'])
+            if message is None or message.content is None:
+                continue
+            if message.content != event['message_content']:
+                continue
+            # Fetch the realm whose settings we're using for rendering
+            to_render[message.id] = (message, realms[event['message_realm_id']])
+        if not to_render:
             return
-        if message.content is not None:
-            ums = UserMessage.objects.filter(
-                message=message.id).select_related("user_profile")
-            message_users = {um.user_profile for um in ums}
 
-            # Fetch the realm whose settings we're using for rendering
-            realm = Realm.objects.get(id=event['message_realm_id'])
-
-            # If rendering fails, the called code will raise a JsonableError.
-            rendered_content = render_incoming_message(
-                message,
-                message.content,
-                message_users,
-                realm)
-            do_update_embedded_data(
-                message.sender, message, message.content, rendered_content)
+        user_ids_by_message = defaultdict(set) # type: Dict[int, Set[int]]
+        for (message_id, user_profile_id) in UserMessage.objects.filter(
+                message_id__in=list(to_render.keys())).values_list('message_id', 'user_profile_id'):
+            user_ids_by_message[message_id].add(user_profile_id)
+
+        rendered_messages = [] # type: List[Tuple[Message, Text]]
+        for message_id, (message, realm) in sorted(to_render.items()):
+            try:
+                rendered_content = render_incoming_message(
+                    message,
+                    message.content,
+                    None,
+                    realm,
+                    message_user_ids=user_ids_by_message[message_id])
+            except JsonableError:
+                logging.warning("Unable to re-render message %d with link previews" % (message_id,))
+                continue
+            rendered_messages.append((message, rendered_content))
+        bulk_update_embedded_data(rendered_messages)
@@ -0,0 +1,198 @@
+from __future__ import absolute_import
+
+from django.conf import settings
+from types import FrameType
+from typing import Dict, List, Optional, Tuple
+
+from zerver.lib.queue import SimpleQueueClient
+from zerver.worker.queue_processors import worker_classes
+
+from collections import defaultdict
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+# A queue gets another consumer when it has more than this many
+# messages waiting per consumer, or when it has had messages waiting
+# for longer than SCALE_UP_BACKLOG_SECONDS (i.e. the consumers aren't
+# keeping up with it, so messages are waiting at least that long).
+SCALE_UP_MESSAGES_PER_WORKER = 100
+SCALE_UP_BACKLOG_SECONDS = 10.0
+# A queue loses a consumer once it has been empty for this long.
+SCALE_DOWN_IDLE_SECONDS = 60.0
+
+def desired_worker_count(current, depth, backlog_seconds, idle_seconds, min_workers, max_workers):
+    # type: (int, int, float, float, int, int) -> int
+    """`backlog_seconds` is how long the queue has continuously had
+    messages waiting, and `idle_seconds` how long it has continuously
+    been empty.  We scale by one worker at a time, so that the effect
+    of each change shows up in the next check."""
+    if depth > 0 and (depth > SCALE_UP_MESSAGES_PER_WORKER * current or
+                      backlog_seconds >= SCALE_UP_BACKLOG_SECONDS):
+        desired = current + 1
+    elif depth == 0 and idle_seconds >= SCALE_DOWN_IDLE_SECONDS:
+        desired = current - 1
+    else:
+        desired = current
+    return max(min_workers, min(max_workers, desired))
+
+class QueueWorkerSupervisor(object):
+    """Runs a pool of `process_queue` consumer processes for each of
+    the given queues.  With `num_workers`, every queue gets that many
+    consumers, or its max_workers (declared with assign_queue) if that
+    is fewer; otherwise each pool is scaled between 1 and max_workers,
+    based on the queue's depth.
+
+    On SIGHUP, fresh consumers (running the current code) are started,
+    and the old ones are sent SIGTERM, which makes them finish the
+    event they are processing and exit."""
+
+    def __init__(self, queue_names, num_workers=None, check_interval=5.0):
+        # type: (List[str], Optional[int], float) -> None
+        self.queue_names = queue_names
+        self.num_workers = num_workers
+        self.check_interval = check_interval
+        self.log = logging.getLogger('zulip.queue_supervisor')
+
+        self.workers = defaultdict(list) # type: Dict[str, List[subprocess.Popen]]
+        self.draining = [] # type: List[subprocess.Popen]
+        self.next_worker_num = defaultdict(int) # type: Dict[str, int]
+        self.backlog_since = {} # type: Dict[str, Optional[float]]
+        self.idle_since = {} # type: Dict[str, Optional[float]]
+
+        self.running = True
+        self.reload_requested = False
+        self.q = None # type: SimpleQueueClient
+
+    def worker_limits(self, queue_name):
+        # type: (str) -> Tuple[int, int]
+        max_workers = worker_classes[queue_name].max_workers
+        if self.num_workers is not None:
+            # Queues which must have a single consumer keep it.
+            num_workers = min(self.num_workers, max_workers)
+            return (num_workers, num_workers)
+        return (1, max_workers)
+
+    def spawn_worker(self, queue_name):
+        # type: (str) -> None
+        worker_num = self.next_worker_num[queue_name]
+        self.next_worker_num[queue_name] += 1
+        self.log.info("Starting worker %d for queue %s" % (worker_num, queue_name))
+        process = subprocess.Popen([sys.executable, os.path.join(settings.DEPLOY_ROOT, 'manage.py'),
+                                    'process_queue', '--queue_name=%s' % (queue_name,),
+                                    '--worker_num=%d' % (worker_num,)])
+        self.workers[queue_name].append(process)
+
+    def drain_worker(self, process):
+        # type: (subprocess.Popen) -> None
+        process.send_signal(signal.SIGTERM)
+        self.draining.append(process)
+
+    def reap_workers(self):
+        # type: () -> None
+        for queue_name in self.queue_names:
+            for process in list(self.workers[queue_name]):
+                if process.poll() is not None:
+                    self.log.warning("Worker for queue %s exited with status %d" % (
+                        queue_name, process.returncode))
+                    self.workers[queue_name].remove(process)
+        self.draining = [process for process in self.draining if process.poll() is None]
+
+    def scale(self, queue_name, now):
+        # type: (str, float) -> None
+        (min_workers, max_workers) = self.worker_limits(queue_name)
+        workers = self.workers[queue_name]
+        try:
+            depth = self.q.get_queue_depth(queue_name)
+        except Exception:
+            # We'll try again at the next check; until then, keep the
+            # workers we have (replacing any which have exited).
+            self.log.exception("Could not get the depth of queue %s" % (queue_name,))
+            for i in range(min_workers - len(workers)):
+                self.spawn_worker(queue_name)
+            return
+
+        if depth > 0:
+            self.idle_since[queue_name] = None
+            if self.backlog_since.get(queue_name) is None:
+                self.backlog_since[queue_name] = now
+        else:
+            self.backlog_since[queue_name] = None
+            if self.idle_since.get(queue_name) is None:
+                self.idle_since[queue_name] = now
+        backlog_since = self.backlog_since[queue_name]
+        idle_since = self.idle_since[queue_name]
+
+        desired = desired_worker_count(
+            len(workers), depth,
+            now - backlog_since if backlog_since is not None else 0,
+            now - idle_since if idle_since is not None else 0,
+            min_workers, max_workers)
+
+        if desired != len(workers):
+            self.log.info("Scaling queue %s from %d to %d workers (%d messages waiting)" % (
+                queue_name, len(workers), desired, depth))
+            # Restart the idle clock, so we scale down one step at a time.
+            if idle_since is not None:
+                self.idle_since[queue_name] = now
+        while len(workers) < desired:
+            self.spawn_worker(queue_name)
+        while len(workers) > desired:
+            self.drain_worker(workers.pop())
+
+    def reload(self):
+        # type: () -> None
+        self.log.info("Reloading: starting new workers and draining the old ones")
+        for queue_name in self.queue_names:
+            old_workers = self.workers[queue_name]
+            self.workers[queue_name] = []
+            for i in range(len(old_workers)):
+                self.spawn_worker(queue_name)
+            for process in old_workers:
+                self.drain_worker(process)
+
+    def shutdown(self):
+        # type: () -> None
+        self.log.info("Shutting down: draining all workers")
+        for queue_name in self.queue_names:
+            for process in self.workers[queue_name]:
+                self.drain_worker(process)
+            self.workers[queue_name] = []
+        for process in self.draining:
+            process.wait()
+
+    def run(self):
+        # type: () -> None
+        def request_reload(signum, frame):
+            # type: (int, FrameType) -> None
+            self.reload_requested = True
+
+        def request_shutdown(signum, frame):
+            # type: (int, FrameType) -> None
+            self.running = False
+
+        signal.signal(signal.SIGHUP, request_reload)
+        signal.signal(signal.SIGTERM, request_shutdown)
+        signal.signal(signal.SIGINT, request_shutdown)
+
+        try:
+            self.q = SimpleQueueClient()
+            for queue_name in self.queue_names:
+                for i in range(self.worker_limits(queue_name)[0]):
+                    self.spawn_worker(queue_name)
+
+            while self.running:
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload()
+                self.reap_workers()
+                now = time.time()
+                for queue_name in self.queue_names:
+                    self.scale(queue_name, now)
+                time.sleep(self.check_interval)
+        finally:
+            # However we exit, don't leave our workers behind.
+            self.shutdown()
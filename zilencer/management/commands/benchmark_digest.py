@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import datetime
+import random
+import time
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import transaction
+from django.utils import timezone
+from mock import patch
+
+from zerver.lib.bulk_create import bulk_create_streams, bulk_create_users
+from zerver.lib.digest import handle_digest_emails
+from zerver.lib.test_helpers import queries_captured
+from zerver.models import Message, Recipient, Stream, Subscription, UserProfile, \
+    get_client, get_realm
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = """Benchmark sending digest emails to everyone in a large realm.
+
+Creates the users and streams and a day's worth of stream traffic,
+times a single handle_digest_emails call for all of the users (without
+actually sending the emails), and reports the number of database
+queries.  Everything is done in a transaction which is rolled back at
+the end, so this leaves the database unchanged."""
+
+    def add_arguments(self, parser):
+        # type: (CommandParser) -> None
+        parser.add_argument('-r', '--realm',
+                            dest='string_id',
+                            type=str,
+                            default='zulip',
+                            help='The realm to create the users and streams in.')
+
+        parser.add_argument('--users',
+                            dest='num_users',
+                            type=int,
+                            default=10000,
+                            help='The number of users to send digests to.')
+
+        parser.add_argument('--streams',
+                            dest='num_streams',
+                            type=int,
+                            default=100,
+                            help='The number of streams to create.')
+
+        parser.add_argument('--streams-per-user',
+                            dest='streams_per_user',
+                            type=int,
+                            default=10,
+                            help='The number of those streams each user is subscribed to.')
+
+        parser.add_argument('--messages',
+                            dest='num_messages',
+                            type=int,
+                            default=20000,
+                            help='The number of stream messages sent since the cutoff.')
+
+    def handle(self, **options):
+        # type: (**Any) -> None
+        try:
+            with transaction.atomic():
+                self.run_benchmark(options['string_id'], options['num_users'],
+                                   options['num_streams'], options['streams_per_user'],
+                                   options['num_messages'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def run_benchmark(self, string_id, num_users, num_streams, streams_per_user, num_messages):
+        # type: (str, int, int, int, int) -> None
+        realm = get_realm(string_id)
+        random.seed(0)
+
+        emails = ['benchmark-digest-%d@%s' % (i, realm.domain) for i in range(num_users)]
+        bulk_create_users(realm, set((email, email, email, True) for email in emails))
+        users = list(UserProfile.objects.filter(email__in=emails))
+
+        stream_names = ['benchmark-digest-%d' % (i,) for i in range(num_streams)]
+        bulk_create_streams(realm, dict((name, {'description': '', 'invite_only': False})
+                                        for name in stream_names))
+        recipients = list(Recipient.objects.filter(
+            type=Recipient.STREAM,
+            type_id__in=Stream.objects.filter(realm=realm, name__in=stream_names).values('id')))
+        Subscription.objects.bulk_create(
+            [Subscription(user_profile=user, recipient=recipient)
+             for user in users
+             for recipient in random.sample(recipients, min(streams_per_user, len(recipients)))],
+            batch_size=10000)
+
+        client = get_client('website')
+        now = timezone.now()
+        Message.objects.bulk_create(
+            [Message(sender=random.choice(users), recipient=random.choice(recipients),
+                     subject='topic %d' % (random.randrange(20),),
+                     content='benchmark', rendered_content='<p>benchmark</p>',
+                     sending_client=client,
+                     pub_date=now - datetime.timedelta(seconds=random.randrange(24 * 3600)))
+             for i in range(num_messages)],
+            batch_size=10000)
+        cutoff = time.time() - 24 * 3600 - 60
+
+        with patch('zerver.lib.digest.send_future_email') as send_future_email, \
+                queries_captured() as queries:
+            start = time.time()
+            handle_digest_emails([user.id for user in users], cutoff)
+            elapsed = time.time() - start
+
+        print("Ran digests for %d users in %.3fs (%.2fms per user)" % (
+            len(users), elapsed, elapsed * 1000 / len(users)))
+        print("%d database queries" % (len(queries),))
+        print("%d digest emails rendered" % (send_future_email.call_count,))
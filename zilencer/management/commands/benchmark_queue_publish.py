@@ -0,0 +1,64 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import time
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.test import override_settings
+from mock import patch
+
+from zerver.lib.queue import InMemoryQueueClient, QueuePublisher, \
+    flush_publish_batch, queue_json_publish, start_publish_batch
+
+class Command(BaseCommand):
+    help = """Benchmark publishing queue events from requests, with and without batching.
+
+Simulates requests which each publish several events, against an
+in-memory stand-in for RabbitMQ with a configurable round trip time,
+and reports how long the requests spent publishing.  Unbatched, each
+event costs a round trip; batched, each request costs one."""
+
+    def add_arguments(self, parser):
+        # type: (CommandParser) -> None
+        parser.add_argument('--requests',
+                            dest='num_requests',
+                            type=int,
+                            default=1000,
+                            help='The number of requests to simulate.')
+
+        parser.add_argument('--events',
+                            dest='events_per_request',
+                            type=int,
+                            default=3,
+                            help='The number of events each request publishes.')
+
+        parser.add_argument('--latency',
+                            dest='latency_ms',
+                            type=float,
+                            default=0.5,
+                            help='The simulated broker round trip, in milliseconds.')
+
+    def handle(self, **options):
+        # type: (**Any) -> None
+        broker = InMemoryQueueClient(publish_latency=options['latency_ms'] / 1000)
+        publisher = QueuePublisher(lambda: broker)
+        num_events = options['num_requests'] * options['events_per_request']
+
+        with override_settings(USING_RABBITMQ=True), \
+                patch('zerver.lib.queue.get_queue_client', return_value=broker), \
+                patch('zerver.lib.queue.get_queue_publisher', return_value=publisher):
+            for batched in [False, True]:
+                start = time.time()
+                for i in range(options['num_requests']):
+                    if batched:
+                        start_publish_batch()
+                    for j in range(options['events_per_request']):
+                        queue_json_publish('benchmark_%d' % (j,), {'request': i}, lambda event: None)
+                    if batched:
+                        flush_publish_batch()
+                elapsed = time.time() - start
+
+                print("%s: requests spent %.3fs publishing %d events (%.3fms per request)" % (
+                    'batched' if batched else 'unbatched', elapsed, num_events,
+                    elapsed * 1000 / options['num_requests']))
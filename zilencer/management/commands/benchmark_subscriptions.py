@@ -0,0 +1,76 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import time
+from typing import Any, Dict, List
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import transaction
+
+from zerver.lib.actions import bulk_add_subscriptions, create_stream_if_needed
+from zerver.lib.bulk_create import bulk_create_users
+from zerver.lib.test_helpers import queries_captured, tornado_redirected_to_list
+from zerver.models import UserProfile, get_realm
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = """Benchmark subscribing many users to many streams at once.
+
+Creates the users and streams, times a single bulk_add_subscriptions
+call, and reports the number of database queries and events sent.
+Everything is done in a transaction which is rolled back at the end,
+so this leaves the database unchanged."""
+
+    def add_arguments(self, parser):
+        # type: (CommandParser) -> None
+        parser.add_argument('-r', '--realm',
+                            dest='string_id',
+                            type=str,
+                            default='zulip',
+                            help='The realm to create the users and streams in.')
+
+        parser.add_argument('--users',
+                            dest='num_users',
+                            type=int,
+                            default=10000,
+                            help='The number of users to subscribe.')
+
+        parser.add_argument('--streams',
+                            dest='num_streams',
+                            type=int,
+                            default=10,
+                            help='The number of streams to subscribe them to.')
+
+    def handle(self, **options):
+        # type: (**Any) -> None
+        try:
+            with transaction.atomic():
+                self.run_benchmark(options['string_id'], options['num_users'],
+                                   options['num_streams'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def run_benchmark(self, string_id, num_users, num_streams):
+        # type: (str, int, int) -> None
+        realm = get_realm(string_id)
+
+        emails = ['benchmark-subs-%d@%s' % (i, realm.domain) for i in range(num_users)]
+        bulk_create_users(realm, set((email, email, email, True) for email in emails))
+        users = list(UserProfile.objects.filter(email__in=emails))
+        streams = [create_stream_if_needed(realm, 'benchmark-subs-%d' % (i,))[0]
+                   for i in range(num_streams)]
+
+        events = [] # type: List[Dict[str, Any]]
+        with tornado_redirected_to_list(events):
+            with queries_captured() as queries:
+                start = time.time()
+                bulk_add_subscriptions(streams, users)
+                elapsed = time.time() - start
+
+        print("Subscribed %d users to %d streams in %.3fs" % (len(users), len(streams), elapsed))
+        print("%d database queries" % (len(queries),))
+        print("%d events, delivered to %d user queues" % (
+            len(events), sum(len(event['users']) for event in events)))
@@ -0,0 +1,78 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import random
+import time
+from typing import Any, Dict, List
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import transaction
+
+from zerver.lib.queue import InMemoryQueueClient
+from zerver.lib.test_helpers import queries_captured
+from zerver.models import UserProfile, get_realm
+from zerver.worker.queue_processors import UserActivityWorker
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = """Benchmark the user_activity queue worker, with and without batching.
+
+Feeds the same synthetic events to UserActivityWorker through an
+in-memory stand-in for the RabbitMQ queue, and reports throughput and
+database queries.  Each run is rolled back, so this leaves the database
+unchanged."""
+
+    def add_arguments(self, parser):
+        # type: (CommandParser) -> None
+        parser.add_argument('-r', '--realm',
+                            dest='string_id',
+                            type=str,
+                            default='zulip',
+                            help='The realm whose users generate the activity.')
+
+        parser.add_argument('--events',
+                            dest='num_events',
+                            type=int,
+                            default=10000,
+                            help='The number of user_activity events to process.')
+
+    def handle(self, **options):
+        # type: (**Any) -> None
+        realm = get_realm(options['string_id'])
+        user_ids = list(UserProfile.objects.filter(realm=realm, is_active=True).values_list('id', flat=True))
+        clients = ['website', 'ZulipAndroid', 'ZulipiOS']
+        queries = ['get_events_backend', 'send_message_backend', 'update_pointer_backend']
+        now = time.time()
+        events = [dict(user_profile_id=random.choice(user_ids),
+                       client=random.choice(clients),
+                       query=random.choice(queries),
+                       time=now + i * 0.001)
+                  for i in range(options['num_events'])]
+
+        for batch_size in [1, UserActivityWorker.batch_size]:
+            try:
+                with transaction.atomic():
+                    self.run_worker(events, batch_size)
+                    raise Rollback()
+            except Rollback:
+                pass
+
+    def run_worker(self, events, batch_size):
+        # type: (List[Dict[str, Any]], int) -> None
+        client = InMemoryQueueClient()
+        for event in events:
+            client.json_publish(UserActivityWorker.queue_name, event)
+
+        worker = UserActivityWorker()
+        worker.batch_size = batch_size
+        worker.q = client
+
+        with queries_captured() as queries:
+            start = time.time()
+            worker.start()
+            elapsed = time.time() - start
+
+        print("batch_size=%s: %d events in %.3fs (%.0f events/s), %d database queries" % (
+            batch_size, len(events), elapsed, len(events) / elapsed, len(queries)))
@@ -363,6 +363,12 @@ CAMO_URI = '/external_content/'
 # to use a remote Memcached instance, set MEMCACHED_LOCATION here.
 # Format HOST:PORT
 # MEMCACHED_LOCATION = 127.0.0.1:11211
+#
+# Each Zulip process can also keep a small cache of hot, rarely changing
+# objects (users, streams, clients, ...) in front of memcached, kept
+# consistent across processes over redis.  This saves many memcached
+# round trips per request.
+# LOCAL_CACHE_ENABLED = False
 
 # Redis configuration
 #
@@ -377,3 +383,9 @@ CAMO_URI = '/external_content/'
 
 # Controls whether Zulip will rate-limit user requests.
 # RATE_LIMITING = True
+
+# Lets each Zulip process serve a few requests from users who are far
+# below their rate limits without asking redis.  This saves a redis
+# round trip per request on busy servers, at the cost of the limits
+# being enforced slightly less precisely.
+# RATE_LIMITING_LOCAL_BUCKET = False
@@ -123,7 +123,9 @@ DEFAULT_SETTINGS = {'TWITTER_CONSUMER_KEY': '',
                     'RABBITMQ_HOST': 'localhost',
                     'RABBITMQ_USERNAME': 'zulip',
                     'MEMCACHED_LOCATION': '127.0.0.1:11211',
+                    'LOCAL_CACHE_ENABLED': False,
                     'RATE_LIMITING': True,
+                    'RATE_LIMITING_LOCAL_BUCKET': False,
                     'REDIS_HOST': '127.0.0.1',
                     'REDIS_PORT': 6379,
                     # The following bots only exist in non-VOYAGER installs
@@ -198,6 +200,9 @@ DEFAULT_SETTINGS = {'TWITTER_CONSUMER_KEY': '',
                     'ANALYTICS_LOCK_DIR': "/home/zulip/deployments/analytics-lock-dir",
                     'PASSWORD_MIN_LENGTH': 6,
                     'PASSWORD_MIN_ZXCVBN_QUALITY': 0.5,
+                    # How long after the first missed message we wait
+                    # for more before sending a user a notification email.
+                    'MISSED_MESSAGE_EMAIL_BATCH_SECONDS': 120,
                     }
 
 for setting_name, setting_val in six.iteritems(DEFAULT_SETTINGS):
@@ -320,7 +325,11 @@ TEMPLATES = [
 ]
 
 MIDDLEWARE_CLASSES = (
-    # Our logging middleware should be the first middleware item.
+    # Wraps all the others, so that the queue events they publish
+    # (including LogRequests' slow query reports) are batched too.
+    'zerver.middleware.QueuePublishBatching',
+    # Our logging middleware should be the first middleware item
+    # after that.
     'zerver.middleware.TagRequests',
     'zerver.middleware.LogRequests',
     'zerver.middleware.JsonErrorHandler',
@@ -461,6 +470,16 @@ RATE_LIMITING_RULES = [
     (60, 100),     # 100 requests max every minute
 ]
 DEBUG_RATE_LIMITING = DEBUG
+
+# Tornado limits each user's event queue polls and socket requests
+# separately, with token buckets of (burst size, requests per second).
+TORNADO_RATE_LIMITS = {
+    'events': (20, 2.0),
+    'socket': (20, 5.0),
+}
+# Requests over those limits are held back until the user has a token
+# if that's at most this many seconds away, and rejected otherwise.
+TORNADO_RATE_LIMIT_MAX_DELAY = 5
 REDIS_PASSWORD = get_secret('redis_password')
 
 ########################################################################